@@ -0,0 +1,87 @@
+import asyncio
+import base64
+import collections
+import hashlib
+import json
+import time
+import httpx
+
+
+# 录制时不保存的响应头，响应体已解码后保存，这些头在回放时会导致长度或编码不一致
+SKIPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection"}
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """
+    录制 / 回放 HTTP 交互的 httpx transport
+    record 模式下转发真实请求并把响应写入 cassette 文件（JSONL），replay 模式下完全离线地按请求返回录制的响应
+    请求以 (方法, 路径和查询参数, 请求体哈希) 为键，相同键的多次请求按录制顺序依次返回；不会保存请求头，避免泄露凭据
+    meta 为录制时的运行参数（仓库、PR、提示词等级等），写在 cassette 第一行，回放时据此还原运行环境
+    """
+
+    def __init__(self, path: str, mode: str, replay_latency: bool = False, meta: dict = None):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode:{mode}")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.meta = meta or {}
+        self.interactions = collections.defaultdict(collections.deque)
+        self.recorded = []
+        self.inner = httpx.AsyncHTTPTransport() if mode == "record" else None
+        if mode == "replay":
+            self.load()
+
+    @staticmethod
+    def key(request: httpx.Request, body: bytes) -> str:
+        # 不包含协议和主机，回放时服务地址可以不同
+        return f"{request.method} {request.url.raw_path.decode('ascii')} {hashlib.sha256(body).hexdigest()}"
+
+    def load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if "meta" in entry:
+                    self.meta = entry["meta"]
+                else:
+                    self.interactions[entry["key"]].append(entry)
+
+    def save(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"meta": self.meta}, ensure_ascii=False) + "\n")
+            for entry in self.recorded:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = self.key(request, body)
+
+        if self.mode == "replay":
+            if not self.interactions[key]:
+                raise RuntimeError(f"No recorded interaction for request:{request.method} {request.url}")
+            entry = self.interactions[key].popleft()
+            if self.replay_latency:
+                await asyncio.sleep(entry["elapsed"])
+            return httpx.Response(entry["status"], headers=entry["headers"],
+                                  content=base64.b64decode(entry["body"]), request=request)
+
+        start_time = time.monotonic()
+        response = await self.inner.handle_async_request(request)
+        content = await response.aread()
+        await response.aclose()
+        headers = [(name, value) for name, value in response.headers.items()
+                   if name.lower() not in SKIPPED_HEADERS]
+        self.recorded.append({
+            "key": key,
+            "status": response.status_code,
+            "headers": headers,
+            "body": base64.b64encode(content).decode("ascii"),
+            "elapsed": time.monotonic() - start_time
+        })
+        return httpx.Response(response.status_code, headers=headers, content=content, request=request)
+
+    async def aclose(self):
+        if self.inner is not None:
+            await self.inner.aclose()
@@ -0,0 +1,307 @@
+"""
+离线基准测试
+
+默认模式下启动本地的 DeepSeek / GitHub stub 服务，生成指定规模的合成 PR，完整运行 ai_code_reviewer.async_main，
+输出端到端耗时、大模型和 GitHub 调用次数、峰值内存以及各阶段延迟的 p50/p95/p99
+
+    python benchmark/run_benchmark.py --files 50 --functions-per-file 8 --llm-latency-ms 800
+
+--record 连接真实服务运行一次并录制到 cassette 文件（需要配置好 ai_code_reviewer 所需的全部环境变量），
+--replay 离线回放 cassette，配合 --baseline 可以和历史结果比较并在性能回退时返回非零退出码
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import httpx
+from cassette import CassetteTransport
+from stub_servers import StubGithubServer, StubLLMServer, StubProfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# 录制时写入 cassette 的运行参数，回放时用于还原请求路径和提示词
+CASSETTE_META_ENV = ("REPOSITORY_NAME", "REPOSITORY_OWNER", "PROMPT_LEVEL", "LLM_STREAM")
+
+
+# 合成代码模板，每个函数的函数体随文件和函数序号变化，保证内容互不相同
+def make_function(language: str, file_index: int, function_index: int, body_lines: int) -> list:
+    name = f"bench_func_{file_index}_{function_index}"
+    if language == "py":
+        body = [f"    total += value * {k} + {function_index}" for k in range(body_lines)]
+        return [f"def {name}(value):", f"    total = {file_index}", *body, "    return total", ""]
+    body = [f"        total += value * {k} + {function_index};" for k in range(body_lines)]
+    signature = f"    public static int {name}(int value) {{" if language == "java" else f"int {name}(int value) {{"
+    lines = [signature, f"        int total = {file_index};", *body, "        return total;", "    }" if language == "java" else "}", ""]
+    return lines
+
+
+def make_source(language: str, file_index: int, functions: int, body_lines: int) -> list:
+    lines = []
+    for function_index in range(functions):
+        lines.extend(make_function(language, file_index, function_index, body_lines))
+    if language == "java":
+        lines = [f"public class Bench{file_index} {{", *lines, "}"]
+    return lines
+
+
+# 将变更行号组织为只包含新增行的 patch
+def make_patch(lines: list, changed_lines: list) -> str:
+    hunks = []
+    for line in changed_lines:
+        if hunks and line == hunks[-1][-1] + 1:
+            hunks[-1].append(line)
+        else:
+            hunks.append([line])
+    patch = []
+    for hunk in hunks:
+        patch.append(f"@@ -{hunk[0]},0 +{hunk[0]},{len(hunk)} @@")
+        patch.extend(f"+{lines[line - 1]}" for line in hunk)
+    return "\n".join(patch)
+
+
+def generate_pr(repo_path: str, args) -> list:
+    rng = random.Random(args.seed)
+    languages = args.languages.split(",")
+    files = []
+    for file_index in range(args.files):
+        language = languages[file_index % len(languages)]
+        # 重复文件的内容与第一个同语言文件完全相同，用于衡量缓存和请求合并的效果
+        source_index = file_index % len(languages) if rng.random() < args.duplicate_ratio else file_index
+        lines = make_source(language, source_index, args.functions_per_file, args.function_lines)
+        file_name = f"bench/file_{file_index}.{language}"
+        os.makedirs(os.path.join(repo_path, "bench"), exist_ok=True)
+        with open(os.path.join(repo_path, file_name), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+        changed_lines = [line for line in range(1, len(lines) + 1) if rng.random() < args.changed_ratio]
+        files.append({"filename": file_name, "status": "modified", "patch": make_patch(lines, changed_lines)})
+    return files
+
+
+class StageTimer:
+    """
+    通过包装关键函数记录各阶段耗时
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    def wrap(self, owner, name: str, stage: str):
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        async def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                self.samples.setdefault(stage, []).append(time.perf_counter() - start_time)
+
+        setattr(owner, name, wrapper)
+
+    @staticmethod
+    def percentile(values: list, q: float) -> float:
+        # 与运行指标使用同一种分位数算法
+        from run_metrics import RunMetrics
+        return RunMetrics.percentile(sorted(values), q / 100)
+
+    def report(self) -> dict:
+        return {
+            stage: {
+                "count": len(values),
+                "p50_ms": round(self.percentile(values, 50) * 1000, 3),
+                "p95_ms": round(self.percentile(values, 95) * 1000, 3),
+                "p99_ms": round(self.percentile(values, 99) * 1000, 3)
+            }
+            for stage, values in sorted(self.samples.items()) if values
+        }
+
+
+def install_transport(ai_code_reviewer, transport):
+    # 在 analyzer 初始化后替换各个大模型接口和 GitHub 的 http client 的 transport，保留原有的请求头和超时设置
+    original_init = ai_code_reviewer.CppCodeAnalyzer.__init__
+
+    def init(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        for owner in (*self.ai_module.router.providers.values(), self.github_assistant):
+            client = owner.client
+            owner.client = httpx.AsyncClient(headers=client.headers, timeout=client.timeout, transport=transport)
+
+    ai_code_reviewer.CppCodeAnalyzer.__init__ = init
+
+
+def run_reviewer(pull_request_id: int, transport, timer: StageTimer):
+    os.chdir(SRC_DIR)
+    sys.path.insert(0, SRC_DIR)
+    import ai_code_reviewer
+    import ai_module
+    import github_assistant
+
+    timer.wrap(github_assistant.GithubAssistant, "send_github_request", "github_request")
+    timer.wrap(github_assistant.GithubAssistant, "submit_review", "submit_review")
+    timer.wrap(ai_code_reviewer.CppCodeAnalyzer, "extract_review_units", "parse")
+    timer.wrap(ai_code_reviewer.CppCodeAnalyzer, "review_unit", "review_unit")
+    timer.wrap(ai_module.DeepSeek, "call_deepseek_async", "llm_request")
+    if transport is not None:
+        install_transport(ai_code_reviewer, transport)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.perf_counter()
+    asyncio.run(ai_code_reviewer.async_main(pull_request_id))
+    wall_time = time.perf_counter() - start_time
+    # Linux 下 ru_maxrss 的单位为 KB
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return wall_time, rss_before * 1024, peak_rss * 1024
+
+
+# 读取 reviewer 自身导出的计数（token 数、重试次数、传输字节数等）
+def run_counters() -> dict:
+    import run_metrics
+    return run_metrics.metrics.to_dict()["counters"]
+
+
+def compare_with_baseline(result: dict, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = []
+    for metric in ("wall_time_s", "llm_calls", "github_calls", "peak_rss_bytes"):
+        if metric in baseline and metric in result and baseline[metric]:
+            if result[metric] > baseline[metric] * (1 + tolerance):
+                regressions.append(f"{metric}: {result[metric]} > baseline {baseline[metric]} (+{tolerance:.0%})")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ai_code_reviewer offline benchmark")
+    parser.add_argument("--files", type=int, default=20, help="number of changed files in the synthetic PR")
+    parser.add_argument("--functions-per-file", type=int, default=5)
+    parser.add_argument("--function-lines", type=int, default=10, help="body lines per synthetic function")
+    parser.add_argument("--languages", default="cpp,py,java", help="comma separated extensions to generate")
+    parser.add_argument("--changed-ratio", type=float, default=1.0, help="fraction of lines marked as added")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="fraction of files duplicating another file")
+    parser.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument("--llm-latency-ms", type=float, default=500.0, help="median LLM latency")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="log-normal sigma of LLM latency")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-rpm", type=int, default=0, help="LLM requests per minute before 429, 0 for unlimited")
+    parser.add_argument("--llm-output-tokens", type=int, default=60)
+    parser.add_argument("--empty-ratio", type=float, default=0.3, help="fraction of replies without suggestions")
+    parser.add_argument("--github-latency-ms", type=float, default=50.0)
+    parser.add_argument("--github-sigma", type=float, default=0.3)
+    parser.add_argument("--github-error-rate", type=float, default=0.0)
+    parser.add_argument("--github-rpm", type=int, default=0)
+
+    parser.add_argument("--record", metavar="CASSETTE", help="run against the real services and record a cassette")
+    parser.add_argument("--replay", metavar="CASSETTE", help="replay a recorded cassette without network access")
+    parser.add_argument("--replay-latency", action="store_true", help="sleep for the recorded latency on replay")
+    parser.add_argument("--pull-request-id", type=int, default=1)
+    parser.add_argument("--repo-path", help="local checkout used with --record / --replay")
+
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment variable for the reviewer, e.g. LLM_CONCURRENCY=16")
+    parser.add_argument("--output", help="write the result as JSON")
+    parser.add_argument("--baseline", help="baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression ratio against the baseline")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(prefix="ai_reviewer_bench_")
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+    # 每次运行使用独立的缓存和日志目录，避免不同运行之间相互影响
+    os.environ.setdefault("REVIEW_CACHE_DIR", os.path.join(work_dir, "review_cache"))
+    os.environ.setdefault("REVIEW_STATE_DIR", os.path.join(work_dir, "review_state"))
+    os.environ.setdefault("METRICS_DIR", os.path.join(work_dir, "metrics"))
+
+    servers = []
+    transport = None
+    if args.record or args.replay:
+        if not args.repo_path:
+            raise SystemExit("--repo-path is required with --record / --replay")
+        os.environ["REPOSITORY_PATH"] = os.path.abspath(args.repo_path)
+        meta = {name: os.environ.get(name) for name in CASSETTE_META_ENV}
+        meta["pull_request_id"] = args.pull_request_id
+        transport = CassetteTransport(args.record or args.replay, "record" if args.record else "replay",
+                                      args.replay_latency, meta)
+        if args.replay:
+            # 还原录制时的仓库、PR 和提示词设置，回放时不访问网络，凭据使用占位值即可
+            args.pull_request_id = transport.meta.get("pull_request_id", args.pull_request_id)
+            for name in CASSETTE_META_ENV:
+                if transport.meta.get(name):
+                    os.environ[name] = transport.meta[name]
+            for name in ("LLM_API_KEY", "GITHUB_TOKEN", "REPOSITORY_NAME", "REPOSITORY_OWNER"):
+                os.environ.setdefault(name, "replay-placeholder-value")
+            os.environ.setdefault("LLM_API_URL", "http://replay.invalid/v1/chat/completions")
+            os.environ.setdefault("PROMPT_LEVEL", "0")
+    else:
+        repo_path = os.path.join(work_dir, "repo")
+        files = generate_pr(repo_path, args)
+        llm = StubLLMServer(StubProfile(args.llm_latency_ms, args.llm_sigma, args.llm_error_rate,
+                                        args.llm_rpm, args.seed),
+                            args.llm_output_tokens, args.empty_ratio).start()
+        github = StubGithubServer(StubProfile(args.github_latency_ms, args.github_sigma, args.github_error_rate,
+                                              args.github_rpm, args.seed + 1), files).start()
+        servers = [llm, github]
+        os.environ.update({
+            "LLM_API_KEY": "stub-llm-api-key",
+            "LLM_API_URL": f"{llm.url}/v1/chat/completions",
+            "GITHUB_TOKEN": "stub-github-token",
+            "GITHUB_API_URL": github.url,
+            "REPOSITORY_NAME": "bench",
+            "REPOSITORY_OWNER": "bench",
+            "REPOSITORY_PATH": repo_path
+        })
+        os.environ.setdefault("PROMPT_LEVEL", "0")
+
+    timer = StageTimer()
+    try:
+        wall_time, rss_before, peak_rss = run_reviewer(args.pull_request_id, transport, timer)
+    finally:
+        for server in servers:
+            server.stop()
+        if args.record:
+            transport.save()
+
+    result = {
+        "wall_time_s": round(wall_time, 3),
+        "llm_calls": len(timer.samples.get("llm_request", [])),
+        "github_calls": len(timer.samples.get("github_request", [])),
+        "peak_rss_bytes": peak_rss,
+        "rss_before_run_bytes": rss_before,
+        "stages": timer.report(),
+        "counters": run_counters()
+    }
+    if servers:
+        llm, github = servers
+        result["stub"] = {
+            "llm_requests": len(llm.requests),
+            "llm_throttled": sum(1 for *_, status in llm.requests if status == 429),
+            "github_requests": len(github.requests),
+            "comments_posted": len(github.comments)
+        }
+
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        regressions = compare_with_baseline(result, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+@dataclass
+class StubProfile:
+    """
+    stub 服务的行为配置
+    延迟服从对数正态分布，median_ms 为中位数，sigma 越大长尾越明显
+    """
+    median_ms: float = 0.0
+    sigma: float = 0.5
+    error_rate: float = 0.0
+    requests_per_minute: int = 0
+    seed: int = 0
+    rng: random.Random = field(init=False)
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+
+    def sample_latency(self) -> float:
+        if self.median_ms <= 0:
+            return 0.0
+        return self.rng.lognormvariate(0, self.sigma) * self.median_ms / 1000
+
+
+class TokenBucket:
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.available = float(per_minute)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> bool:
+        if self.capacity <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.updated_at) * self.capacity / 60)
+            self.updated_at = now
+            if self.available < 1:
+                return False
+            self.available -= 1
+            return True
+
+
+class StubServer:
+    """
+    在后台线程中运行的 HTTP stub 服务，记录每个请求的路径和耗时
+    """
+
+    def __init__(self, profile: StubProfile):
+        self.profile = profile
+        self.bucket = TokenBucket(profile.requests_per_minute)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, method: str, path: str, status: int):
+        with self.lock:
+            self.requests.append((method, path, status))
+
+    # 按配置注入限流和错误，返回需要直接回复的状态码，None 表示正常处理
+    def injected_status(self):
+        if not self.bucket.take():
+            return 429
+        with self.lock:
+            failed = self.profile.rng.random() < self.profile.error_rate
+        return 503 if failed else None
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def read_json(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                return json.loads(body) if body else None
+
+            def send_json(self, status: int, payload, headers: dict = None):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_request(self, method: str):
+                payload = self.read_json() if method == "POST" else None
+                if (status := stub.injected_status()) is not None:
+                    stub.record(method, self.path, status)
+                    headers = {"Retry-After": "1"} if status == 429 else {}
+                    self.send_json(status, {"message": "stub injected error"}, headers)
+                    return
+                time.sleep(stub.profile.sample_latency())
+                stub.record(method, self.path, 200)
+                stub.handle(self, method, payload)
+
+            def do_GET(self):
+                self.handle_request("GET")
+
+            def do_POST(self):
+                self.handle_request("POST")
+
+        return Handler
+
+    def handle(self, handler, method: str, payload):
+        handler.send_json(404, {"message": "not found"})
+
+
+class StubLLMServer(StubServer):
+    """
+    OpenAI 兼容的 chat completions stub，支持流式（SSE）和非流式应答
+    empty_ratio 为回复 NO_SUGGESTIONS 的比例，批量请求按函数ID返回 JSON
+    模拟模型服务的前缀缓存：以 prefix_block 个字符为单位记录出现过的提示词前缀，命中部分计入 prompt_cache_hit_tokens
+    """
+
+    function_id_re = re.compile(r"^### (f[0-9a-f]+)$", re.M)
+
+    prefix_block = 256
+
+    def __init__(self, profile: StubProfile, output_tokens: int = 60, empty_ratio: float = 0.3):
+        super().__init__(profile)
+        self.output_tokens = output_tokens
+        self.empty_ratio = empty_ratio
+        self.seen_prefixes = set()
+
+    def cached_chars(self, prompt: str) -> int:
+        digest = hashlib.sha1()
+        cached = 0
+        with self.lock:
+            for start in range(0, len(prompt) - self.prefix_block + 1, self.prefix_block):
+                digest.update(prompt[start:start + self.prefix_block].encode("utf-8"))
+                key = digest.copy().digest()
+                if key in self.seen_prefixes and cached == start:
+                    cached = start + self.prefix_block
+                self.seen_prefixes.add(key)
+        return cached
+
+    def make_reply(self, prompt: str) -> str:
+        function_ids = self.function_id_re.findall(prompt)
+        with self.lock:
+            empty = self.profile.rng.random() < self.empty_ratio
+        if function_ids:
+            return json.dumps({fid: "" if empty else f"stub review for {fid}" for fid in function_ids})
+        if empty:
+            return "NO_SUGGESTIONS"
+        return " ".join(["stub"] * self.output_tokens)
+
+    def handle(self, handler, method: str, payload):
+        prompt = "\n".join(message.get("content", "") for message in payload.get("messages", []))
+        reply = self.make_reply(prompt)
+        cached = self.cached_chars(prompt)
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(reply) // 4,
+                 "prompt_cache_hit_tokens": cached // 4, "prompt_cache_miss_tokens": (len(prompt) - cached) // 4}
+        if not payload.get("stream"):
+            handler.send_json(200, {"choices": [{"message": {"content": reply}}], "usage": usage})
+            return
+
+        pieces = [reply[i:i + 8] for i in range(0, len(reply), 8)]
+        events = [{"choices": [{"delta": {"content": piece}}]} for piece in pieces]
+        events.append({"choices": [], "usage": usage})
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        for event in events:
+            self.write_chunk(handler, f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self.write_chunk(handler, b"data: [DONE]\n\n")
+        self.write_chunk(handler, b"")
+
+    @staticmethod
+    def write_chunk(handler, data: bytes):
+        handler.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        handler.wfile.flush()
+
+
+class StubGithubServer(StubServer):
+    """
+    GitHub pulls / files / comments / reviews 接口的 stub
+    files 为 PR 变更文件列表（包含 filename 和 patch），按 per_page 分页并返回 Link 头
+    """
+
+    def __init__(self, profile: StubProfile, files: list, head_sha: str = "0" * 40):
+        super().__init__(profile)
+        self.files = files
+        self.head_sha = head_sha
+        self.comments = []
+
+    def handle(self, handler, method: str, payload):
+        parts = urlsplit(handler.path)
+        path = parts.path.rstrip("/")
+        query = parse_qs(parts.query)
+
+        if method == "GET" and path.endswith("/files"):
+            per_page = int(query.get("per_page", ["30"])[0])
+            page = int(query.get("page", ["1"])[0])
+            items = self.files[(page - 1) * per_page:page * per_page]
+            headers = {}
+            if page * per_page < len(self.files):
+                headers["Link"] = f'<{self.url}{path}?per_page={per_page}&page={page + 1}>; rel="next"'
+            handler.send_json(200, items, headers)
+        elif method == "GET" and re.search(r"/pulls/\d+$", path):
+            handler.send_json(200, {"head": {"sha": self.head_sha}})
+        elif method == "POST" and path.endswith("/reviews"):
+            with self.lock:
+                self.comments.extend(payload.get("comments", []))
+            handler.send_json(200, {"id": len(self.comments)})
+        elif method == "POST" and path.endswith("/comments"):
+            with self.lock:
+                self.comments.append(payload)
+            handler.send_json(201, {"id": len(self.comments)})
+        else:
+            handler.send_json(404, {"message": "not found"})
@@ -1,18 +1,29 @@
-import tree_sitter_cpp
-import tree_sitter_python
-import tree_sitter_java
 import argparse
+import cProfile
 import os
 import asyncio
-import bisect
 import aiofiles
-import re
+import mmap
+import time
 import common_function
-import threading
-from tree_sitter import Language, Parser
+from concurrent.futures import ProcessPoolExecutor
 from ai_code_reviewer_logger import logger
-from ai_module import DeepSeek
+from ai_module import record_request_timings
 from github_assistant import GithubAssistant
+from local_diff import LocalGitDiff
+from review_cache import ReviewCache
+from review_unit import ReviewUnit
+from review_batcher import ReviewBatcher
+from run_summary import RunSummary
+from run_metrics import metrics
+from shared_resources import SharedResources
+from token_budget import TokenBudget, estimate_tokens
+from function_extractor import extract_file_in_worker
+from incremental_review import ReviewState, IncrementalDiff
+from review_filter import ReviewFilter
+from review_pipeline import ReviewPipeline
+from review_output import ReviewOutput
+from repository_scan import merge_results, parse_shard
 from typing import Optional
 
 class CppCodeAnalyzer:
@@ -26,213 +37,539 @@ class CppCodeAnalyzer:
         "PROMPT_LEVEL"
     )
     
-    # 待匹配的++文件的文件拓展名
-    cpp_extensions = re.compile(r".*\.(cpp|hpp|h|tpp|cxx)$")
-    python_extensions = re.compile(r".*\.py$")
-    java_extensions = re.compile(r".*\.java$")
-    
-    lock = threading.Lock()
+    # 离线模式只读取本地仓库并写入结果文件，不需要 GitHub 相关的配置
+    offline_require_env_vars = (
+        "LLM_API_KEY",
+        "LLM_API_URL",
+        "PROMPT_LEVEL"
+    )
     
-    semaphore = asyncio.Semaphore(os.cpu_count())
+    # 仅限制文件读取和语法解析的并发度，大模型调用由 llm_scheduler 单独调度
+    parse_semaphore = asyncio.Semaphore(os.cpu_count())
     
-    def __init__(self, pull_request_id: int):
+    def __init__(
+        self,
+        pull_request_id: int,
+        repository_owner: str = None,
+        repository_name: str = None,
+        shared: SharedResources = None,
+        review_output: ReviewOutput = None,
+        output_source: str = ""
+    ):
         
-        # 批量校验环境变量
-        missing_vars = [var for var in self.require_env_vars 
-                       if not os.environ.get(var)]
+        # 批量校验环境变量，仓库信息可以由调用方直接传入（常驻服务模式下来自 webhook）
+        provided = {"REPOSITORY_OWNER": repository_owner, "REPOSITORY_NAME": repository_name}
+        require_env_vars = self.require_env_vars if review_output is None else self.offline_require_env_vars
+        missing_vars = [var for var in require_env_vars 
+                       if not (provided.get(var) or os.environ.get(var))]
         if missing_vars:
             raise RuntimeError(f":Missing environment variables: {', '.join(missing_vars)}")
         
         common_function.log_init_check()
         
-        # llm_api_key 和 github_token 需要从环境变量中拿取
-        llm_api_key = os.environ.get("LLM_API_KEY")
-        llm_api_url = os.environ.get("LLM_API_URL")
+        # github_token 需要从环境变量中拿取
         github_token = os.environ.get("GITHUB_TOKEN")
-        repository_name = os.environ.get("REPOSITORY_NAME")
-        repository_owner = os.environ.get("REPOSITORY_OWNER")
+        repository_name = repository_name or os.environ.get("REPOSITORY_NAME")
+        repository_owner = repository_owner or os.environ.get("REPOSITORY_OWNER")
         
         try:
-            # 初始化ai模型(目前只支持deepseek)
-            self.ai_module = DeepSeek(llm_api_url, llm_api_key)
+            # 大模型客户端、连接池、解析器、调度器和缓存，未传入时自行创建并在 close 时释放
+            self.owns_shared = shared is None
+            self.shared = shared if shared is not None else SharedResources.from_env()
+            self.ai_module = self.shared.ai_module
+            
+            # 离线模式下审查本地的提交范围时不需要 GitHub，缺少 token 或仓库信息时不创建 github assistant
+            self.github_assistant = None
+            self._repository_path = os.environ.get("REPOSITORY_PATH", ".")
+            if review_output is None or (github_token and repository_owner and repository_name):
+                # 初始化github assistant
+                self.github_assistant = GithubAssistant(github_token, 
+                                                        repository_owner, 
+                                                        repository_name, pull_request_id,
+                                                        self.shared.github_client,
+                                                        self.shared.github_response_cache)
             
-            # 初始化github assistant
-            self.github_assistant = GithubAssistant(github_token, 
-                                                    repository_owner, 
-                                                    repository_name, pull_request_id)
+            # 配置了 LOCAL_DIFF_BASE 时直接在本地检出的仓库中计算变更行，不调用 GitHub files 接口
+            self.local_diff = None
+            if local_diff_base := os.environ.get("LOCAL_DIFF_BASE"):
+                self.local_diff = LocalGitDiff(self.repository_path,
+                                               local_diff_base,
+                                               os.environ.get("LOCAL_DIFF_HEAD", "HEAD"))
         except Exception as e:
             logger.exception(f"Init ai_code_reviewer failed: {e}")
             raise
         
-        # c++ 解析器
-        self._cpp_parser = None
-        # python 解析器
-        self._py_parser = None
-        # java 解析器
-        self._java_parser = None
+        self.review_cache = self.shared.review_cache
+        self.llm_scheduler = self.shared.llm_scheduler
+        self.extractor = self.shared.extractor
+        
+        # 本次运行的大模型请求记录（首 token 耗时、总耗时和用量）
+        self.request_timings = []
+        # 共享资源中的计数是累计值，记录起点以便汇总本次运行的增量
+        self.cache_hits_start = self.review_cache.hits
+        self.cache_misses_start = self.review_cache.misses
+        
+        # 使用内存映射读取源码的文件大小阈值
+        self.mmap_threshold = int(os.environ.get("SOURCE_MMAP_THRESHOLD_BYTES", str(1024 * 1024)))
+        
+        # 超过阈值的文件交给解析进程池，PARSE_PROCESS_WORKERS 为 0 时不启用
+        self.parse_workers = self.shared.parse_workers
+        self.parse_process_threshold = int(os.environ.get("PARSE_PROCESS_THRESHOLD_BYTES", str(256 * 1024)))
+        # 解析进程的应答超时（秒），超时的文件跳过审查
+        self.parse_process_timeout = float(os.environ.get("PARSE_PROCESS_TIMEOUT", "60"))
+        
+        self.price_per_1k_tokens = float(os.environ.get("LLM_PRICE_PER_1K_TOKENS", "0"))
+        self.token_budget = TokenBudget.from_limits(
+            int(os.environ.get("LLM_PR_TOKEN_BUDGET", "0")),
+            float(os.environ.get("LLM_PR_COST_BUDGET", "0")),
+            self.price_per_1k_tokens
+        )
+        self.summary = RunSummary()
+        
+        # 解析前的文件过滤，忽略列表从仓库根目录读取，常驻服务模式下仓库路径在创建之后才确定，因此懒加载
+        self._review_filter = None
+        
+        # 离线模式：审查结果写入文件而不是提交评论，output_source 标识本次审查的对象（PR 或提交范围）
+        self.review_output = review_output
+        self.output_source = output_source
+        
+        # 记录每个 PR 上一次审查的 head，后续推送只审查两次 head 之间改动过的函数；离线模式通过结果文件续跑，不使用
+        self.review_state = None
+        self.incremental_diff = None
+        if review_output is None and os.environ.get("INCREMENTAL_REVIEW", "1") == "1":
+            self.review_state = ReviewState(os.environ.get("REVIEW_STATE_DIR", "./.review_state"))
+        
+        # 小函数打包审查，默认关闭
+        self.review_batcher = None
+        self.batch_small_function_tokens = int(os.environ.get("LLM_BATCH_SMALL_FUNCTION_TOKENS", "200"))
+        if os.environ.get("LLM_BATCH", "0") == "1":
+            self.review_batcher = ReviewBatcher(
+                self.call_ai_model_batch,
+                self.call_ai_model,
+                int(os.environ.get("LLM_BATCH_MAX_TOKENS", "2000")),
+                float(os.environ.get("LLM_BATCH_LINGER", "0.2"))
+            )
+        
         logger.info("Init ai_code_reviewer success")
 
     
     @property
-    def cpp_parser(self) -> Parser:
-        try:
-            with self.lock: # 多线程安全
-                if self._cpp_parser is None:
-                    self._cpp_parser = Parser(Language(tree_sitter_cpp.language()))
-        except Exception as e:
-            raise RuntimeError(f"Failed to initialize C++ parser:{e}") from e
-        return self._cpp_parser
+    def parse_pool(self) -> ProcessPoolExecutor:
+        return self.shared.parse_pool
+    
+    
+    # 被审查仓库的本地路径，常驻服务和离线模式下指向临时工作树
+    @property
+    def repository_path(self) -> str:
+        if self.github_assistant is not None:
+            return self.github_assistant.repository_path
+        return self._repository_path
+    
+    
+    @repository_path.setter
+    def repository_path(self, path: str):
+        if self.github_assistant is not None:
+            self.github_assistant.repository_path = path
+        self._repository_path = path
+    
     
     @property
-    def py_parser(self) -> Parser:
+    def review_filter(self) -> ReviewFilter:
+        if self._review_filter is None:
+            self._review_filter = ReviewFilter.from_env(self.repository_path)
+        return self._review_filter
+    
+    
+    # 变更文件来源：本地 git diff 或 GitHub files 接口
+    def iter_diff_file_structs(self):
+        if self.local_diff is not None:
+            return self.local_diff.iter_diff_file_structs()
+        return self.github_assistant.iter_diff_file_structs()
+    
+    
+    async def close(self):
+        # 实现资源释放逻辑，共享资源由创建方负责释放
+        if self.review_batcher is not None:
+            await self.review_batcher.close()
+        if self.github_assistant is not None:
+            await self.github_assistant.close()
+        if self.owns_shared:
+            await self.shared.close()
+    
+    
+    # 文件上下文只用于辅助理解，不计入缓存 key，文件其他部分的改动不会使未改动函数的缓存失效
+    def cache_key(self, function_body: str) -> str:
+        prompt_level, prompt_text = self.ai_module.prompt_settings()
+        return ReviewCache.make_key(function_body, prompt_level, prompt_text, self.ai_module.model_for(function_body))
+    
+    
+    async def review_function(self, function_body: str, file_context: str = "") -> str:
+        # 优先从缓存获取，未命中时才调用大模型
+        model = self.ai_module.model_for(function_body)
+        key = self.cache_key(function_body)
+        
+        # 小函数交给 batcher 与同一文件、同一模型的其他小函数合并请求
+        if self.review_batcher and estimate_tokens(function_body) <= self.batch_small_function_tokens:
+            compute = lambda: self.review_batcher.submit(function_body, file_context, model)
+        else:
+            compute = lambda: self.call_ai_model(function_body, file_context)
+        
+        return await self.review_cache.get_or_compute(
+            key,
+            compute,
+            # 模型应答失败和被截断的意见不缓存，下次重新审查
+            should_store=lambda review: (review != self.ai_module.RESPONSE_ERROR
+                                         and not self.ai_module.is_truncated(review))
+        )
+    
+    
+    async def call_ai_model(self, function_body: str, file_context: str = "") -> str:
+        _, prompt_text = self.ai_module.prompt_settings()
+        estimated_tokens = estimate_tokens(prompt_text) + estimate_tokens(file_context) + estimate_tokens(function_body)
+        return await self.llm_scheduler.run(lambda: self.ai_module.call_ai_model(function_body, file_context),
+                                            estimated_tokens)
+    
+    
+    async def call_ai_model_batch(self, functions: dict, file_context: str = "") -> dict:
+        _, prompt_text = self.ai_module.prompt_settings()
+        estimated_tokens = (estimate_tokens(prompt_text) + estimate_tokens(file_context)
+                            + sum(estimate_tokens(body) for body in functions.values()))
+        return await self.llm_scheduler.run(lambda: self.ai_module.call_ai_model_batch(functions, file_context),
+                                            estimated_tokens)
+    
+    
+    async def review_unit(self, unit: ReviewUnit):
+        if self.review_output is not None:
+            return await self.review_unit_offline(unit)
         try:
-            with self.lock:
-                if self._py_parser is None:
-                    self._py_parser = Parser(Language(tree_sitter_python.language()))
+            response = await self.review_function(unit.function_body, unit.file_context)
+            self.summary.add("functions_reviewed")
+            # 模型应答失败只计数，不把错误信息作为评论发表
+            if response == self.ai_module.RESPONSE_ERROR:
+                self.summary.add("functions_failed")
+                return
+            if self.ai_module.is_truncated(response):
+                self.summary.add("reviews_truncated")
+            # 没有审查意见时不发表空评论
+            if not response.strip():
+                self.summary.add("reviews_empty")
+                return
+            self.github_assistant.add_comment(unit.file_name, unit.line, response)
+            self.summary.add("comments")
         except Exception as e:
-            raise RuntimeError(f"Failed to initialize Python parser:{e}") from e
-        return self._py_parser
-
+            # 单个函数审查失败不影响同文件的其他函数
+            self.summary.add("functions_failed")
+            logger.exception(f"AI processing failed, file:{unit.file_name}, line:{unit.line}, error:{e}")
     
-    @property
-    def java_parser(self) -> Parser:
+    
+    # 离线模式：跳过结果文件中已有的函数，审查结果（包括没有意见的函数）写入结果文件，失败的函数不写入以便续跑时重试
+    async def review_unit_offline(self, unit: ReviewUnit):
+        if self.review_output.is_done(self.output_source, unit):
+            self.summary.add("functions_resumed")
+            return
         try:
-            with self.lock:
-                if self._java_parser is None:
-                    self._java_parser = Parser(Language(tree_sitter_java.language()))
+            response = await self.review_function(unit.function_body, unit.file_context)
+            self.summary.add("functions_reviewed")
+            if response == self.ai_module.RESPONSE_ERROR:
+                self.summary.add("functions_failed")
+                return
+            if self.ai_module.is_truncated(response):
+                self.summary.add("reviews_truncated")
+            prompt_level, _ = self.ai_module.prompt_settings()
+            self.review_output.write(self.output_source, unit, response, prompt_level,
+                                     self.ai_module.model_for(unit.function_body))
+            self.summary.add("comments" if response.strip() else "reviews_empty")
         except Exception as e:
-            raise RuntimeError(f"Failed to initialize JAVA parser:{e}") from e
-        return self._java_parser
+            self.summary.add("functions_failed")
+            logger.exception(f"AI processing failed, file:{unit.file_name}, line:{unit.line}, error:{e}")
     
     
-    async def close(self):
-        # 实现资源释放逻辑
-        await asyncio.gather(self.ai_module.close(), self.github_assistant.close())
+    # 以字节形式读取源码，大文件使用内存映射，返回 (源码, 是否为 mmap)
+    async def read_source(self, file_path: str):
+        with metrics.span("read_source"):
+            if os.path.getsize(file_path) >= max(1, self.mmap_threshold):
+                with open(file_path, "rb") as f:
+                    source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                metrics.add("source_bytes_mapped", len(source))
+                return source, True
+            async with aiofiles.open(file_path, "rb") as f:
+                source = await f.read()
+            metrics.add("source_bytes_read", len(source))
+            return source, False
     
     
-    async def analyze_functions(self, node, lines, file_name):
-        new_lines = lines
-        
-        # python 和 c++ 的function node name 不同
-        function_node_name = "function_definition"
-        if file_name.endswith(".java"):
-            function_node_name = "method_declaration"
-
-        # 检查当前节点是否为函数定义
-        if node.type == function_node_name:
-            # 获取函数的开始和结束行
-            func_start_line = node.start_point[0] + 1  # start_point 是 (行, 列)，索引从 0 开始
-            func_end_line = node.end_point[0] + 1
-
-            # 使用二分查找快速定位范围
-            left = bisect.bisect_left(new_lines, func_start_line)
-            right = bisect.bisect_right(new_lines, func_end_line)
-            lines_to_process = new_lines[left:right]
+    # 第一阶段：读取并解析文件，提取待审查单元，受 CPU 并发度限制
+    async def extract_review_units(self, diff_file_struct) -> list:
+        wait_start = time.monotonic()
+        async with self.parse_semaphore:
+            metrics.observe("parse_queue_wait", time.monotonic() - wait_start)
+            # 进行文件过滤
+            file_name = diff_file_struct.file_name
+            if not self.extractor.is_supported(file_name):
+                return []
             
-            if lines_to_process:
-                try:
-                    # 业务处理
-                    function_body = self.extract_function_body(node)
-                    response = await self.ai_module.call_ai_model(function_body)
-                    # 将 comments 添加到该函数变更的第一行 
-                    self.github_assistant.add_comment(file_name, next(iter(lines_to_process), None), response)
-                except Exception as e:
-                    logger.exception(f"AI processing failed:{e}")
-                    raise
-
-            # 批量移除已处理行（维护有序性）
-            new_lines= lines[:left] + lines[right:]
+            # 统一处理逻辑
+            try:
+                logger.info(f"Start review file:{file_name}")
                 
-        # 递归地遍历子节点
-        for child in node.children:
-            await self.analyze_functions(child, new_lines, file_name)
+                file_path = diff_file_struct.file_path
+                # 忽略列表、生成代码、压缩代码和超大文件不解析
+                if reason := await self.review_filter.check(file_name, file_path):
+                    logger.info(f"Skip file:{file_name}, reason:{reason}")
+                    self.summary.add(f"files_filtered_{reason}")
+                    return []
+                
+                if self.incremental_diff is not None:
+                    result = await self.extract_incremental_units(diff_file_struct)
+                elif self.use_parse_process(file_path):
+                    result = await self.extract_in_worker(diff_file_struct)
+                else:
+                    # 以字节形式读取文件，只读取一次，不做解码和重新编码
+                    source, mapped = await self.read_source(file_path)
+                    try:
+                        with metrics.span("extract"):
+                            result = self.extractor.extract(file_name, source, diff_file_struct.diff_position)
+                    finally:
+                        if mapped:
+                            source.close()
+                
+                # 解析进程超时的文件已记为跳过
+                if result is None:
+                    return []
+                units, chunked, comment_only = result
+                if chunked:
+                    self.summary.add("functions_chunked", chunked)
+                if comment_only:
+                    self.summary.add("functions_comment_only", comment_only)
+                return units
+                
+            except IOError as e:
+                logger.exception(f"File read error:{file_name}, error: {e}")
+            except ValueError as e:
+                logger.exception(f"Parsing error{file_name}, error: {e}")
+            return []
     
-
-    # FIXME: 提取逻辑可能需要优化
-    def extract_function_body(self, node):
-        function_body = []        
-        # 递归遍历子节点，提取函数体的语法内容
-        for child in node.children:
-            text = getattr(child, "text", None)
-            if text is None:
-                continue  # 跳过无text属性的子节点
+    
+    def use_parse_process(self, file_path: str) -> bool:
+        return self.parse_workers > 0 and os.path.getsize(file_path) >= self.parse_process_threshold
+    
+    
+    # 大文件交给解析进程池，工作进程自行读取文件，只返回待审查单元
+    # 超时的文件记为跳过并返回 None，不在主进程中重新解析：工作进程仍在解析该文件，再解析一次只会同时占用事件循环
+    # hunks 不为 None 时在工作进程中做增量提取
+    async def extract_in_worker(self, diff_file_struct, hunks: list = None) -> Optional[tuple]:
+        # 工作进程内的 parse 耗时不会汇总到主进程，这里记录包含进程间通信的整体耗时
+        with metrics.span("extract_in_worker"):
+            future = asyncio.get_running_loop().run_in_executor(
+                self.parse_pool, extract_file_in_worker,
+                diff_file_struct.file_name, diff_file_struct.file_path, diff_file_struct.diff_position, hunks)
             try:
-                # 统一处理字节类型或字符串类型
-                decoded = text.decode("utf-8", errors="replace") if isinstance(text, bytes) else str(text)
-                function_body.append(decoded)
-            except Exception as e:
-                # FIXME: 简单的跳过解码失败的项可能导致函数提取不完整
-                continue  # 跳过解码失败的项
-        
-        return "\n".join(function_body)
-
-
+                return await asyncio.wait_for(future, self.parse_process_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Extract in parse process timeout, skip file:{diff_file_struct.file_name}")
+                self.summary.skip(diff_file_struct.file_name, None, "parse_timeout")
+                return None
     
-    async def analyze(self, diff_file_struct):
-        async with self.semaphore:
+    
+    # 只提取上一次审查之后改动过的函数，在两次 head 之间没有改动的文件直接跳过；解析进程超时时返回 None
+    async def extract_incremental_units(self, diff_file_struct) -> Optional[tuple[list, int, int]]:
+        file_name = diff_file_struct.file_name
+        hunks = self.incremental_diff.hunks.get(file_name)
+        if hunks is None:
+            self.summary.add("files_unchanged")
+            return [], 0, 0
+        
+        if self.use_parse_process(diff_file_struct.file_path):
+            result = await self.extract_in_worker(diff_file_struct, hunks)
+            if result is None:
+                return None
+            units, chunked, unchanged, comment_only = result
+        else:
+            source, mapped = await self.read_source(diff_file_struct.file_path)
             try:
-                # 进行文件过滤
-                file_name = diff_file_struct.file_name
-                if self.cpp_extensions.match(file_name):
-                    parser = self.cpp_parser
-                elif self.python_extensions.match(file_name):
-                    parser = self.py_parser
-                elif self.java_extensions.match(file_name):
-                    parser = self.java_parser
+                with metrics.span("extract"):
+                    units, chunked, unchanged, comment_only = self.extractor.extract_incremental(
+                        file_name, source, hunks, diff_file_struct.diff_position)
+            finally:
+                if mapped:
+                    source.close()
+        if unchanged:
+            self.summary.add("functions_unchanged", unchanged)
+        return units, chunked, comment_only
+    
+    
+    # 读取上一次审查的 head 并计算到当前 head 的变更，没有记录或计算失败时审查全部变更
+    async def load_incremental_diff(self) -> Optional[IncrementalDiff]:
+        if self.review_state is None:
+            return None
+        github_assistant = self.github_assistant
+        reviewed_sha = self.review_state.load(github_assistant.owner, github_assistant.repo,
+                                              github_assistant.pull_request_id)
+        if not reviewed_sha:
+            return None
+        try:
+            incremental_diff = IncrementalDiff(github_assistant.repository_path, reviewed_sha,
+                                               await github_assistant.get_commit_sha())
+            await incremental_diff.load()
+        except (RuntimeError, ValueError) as e:
+            logger.warning(f"Load incremental diff failed, review all changes:{e}")
+            return None
+        logger.info(f"Incremental review since last reviewed sha:{reviewed_sha}")
+        return incremental_diff
+    
+    
+    # 全部函数审查成功后记录本次审查的 head，存在失败或因预算跳过的函数时下次仍从上一次的 head 开始
+    async def save_review_state(self):
+        if self.review_state is None or self.summary.counters.get("functions_failed") or self.summary.skipped:
+            return
+        github_assistant = self.github_assistant
+        self.review_state.save(github_assistant.owner, github_assistant.repo,
+                               github_assistant.pull_request_id, await github_assistant.get_commit_sha())
+    
+    
+    # diff_file_structs 为异步可迭代对象，每拿到一个文件就立即开始审查，返回文件数量
+    # 获取文件、解析、审查和提交评论以有界队列串联，在途的文件、单元和内存都有上限
+    async def analyze_code(self, diff_file_structs) -> int:
+        if self.token_budget is not None:
+            return await self.analyze_code_with_budget(diff_file_structs)
+        
+        pipeline = ReviewPipeline.from_env(self.extract_review_units, self.review_unit)
+        with metrics.span("analyze"):
+            files = await pipeline.run(diff_file_structs)
+        self.summary.add("files", files)
+        return files
+    
+    
+    # 配置了 PR 级 token 上限时，需要先提取全部待审查单元，按变更行数从多到少分配预算
+    # 该模式不经过 ReviewPipeline，全部单元同时保留在内存中，也不受 PIPELINE_MEMORY_MB 限制
+    async def analyze_code_with_budget(self, diff_file_structs) -> int:
+        tasks = []
+        async for diff_file_struct in diff_file_structs:
+            tasks.append(asyncio.create_task(self.extract_review_units(diff_file_struct)))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.summary.add("files", len(tasks))
+        
+        units = []
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Extract review units failed:{result}")
+                continue
+            units.extend(result)
+        units.sort(key=lambda unit: len(unit.changed_lines), reverse=True)
+        
+        _, prompt_text = self.ai_module.prompt_settings()
+        prompt_tokens = estimate_tokens(prompt_text)
+        admitted = 0
+        reserved_keys = set()
+        running = set()
+        try:
+            for unit in units:
+                # 缓存命中、离线模式已完成以及本次运行中重复的函数不会请求模型，不占用预算
+                key = self.cache_key(unit.function_body)
+                if (key in reserved_keys or self.review_cache.contains(key)
+                        or (self.review_output is not None and self.review_output.is_done(self.output_source, unit))):
+                    running.add(asyncio.create_task(self.review_unit(unit)))
+                    admitted += 1
+                    continue
+                # 输出按上限预留，请求完成后按实际用量结算；额度不足时等待在途的请求结算后再尝试
+                tokens = (prompt_tokens + estimate_tokens(unit.file_context) + estimate_tokens(unit.function_body)
+                          + self.ai_module.max_output_tokens)
+                reserved = self.token_budget.try_reserve(tokens)
+                while not reserved and running:
+                    _, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    reserved = self.token_budget.try_reserve(tokens)
+                if reserved:
+                    reserved_keys.add(key)
+                    running.add(asyncio.create_task(self.review_unit_with_budget(unit, tokens)))
+                    admitted += 1
                 else:
-                    return
-                
-                # 统一处理逻辑
-                try:
-                    logger.info(f"Start review file:{file_name}")
-                    
-                    # 异步读取文件
-                    async with aiofiles.open(diff_file_struct.file_path, 'r') as f:
-                        code = await f.read()
-                    
-                    # 语法树解析
-                    tree = parser.parse(bytes(code, 'utf-8'))
-                    root_node = tree.root_node
-                    
-                    # AST遍历
-                    lines = diff_file_struct.diff_position
-                    lines.sort()
-                    await self.analyze_functions(
-                        root_node, 
-                        lines,
-                        file_name
-                    )
-                    
-                except IOError as e:
-                    logger.exception(f"File read error:{file_name}, error: {e}")
-                except ValueError as e:
-                    logger.exception(f"Parsing error{file_name}, error: {e}")                    
-            except Exception as e:
-                logger.exception(f"Unknown error: error: {file_name}, error: {e}")
-    
-    
-    async def analyze_code(self, diff_file_struct_list):
-        await asyncio.gather(*[self.analyze(f) for f in diff_file_struct_list], return_exceptions=True)
+                    self.summary.skip(unit.file_name, unit.line, "token_budget")
+            if running:
+                await asyncio.wait(running)
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+        
+        if admitted < len(units):
+            logger.warning(f"PR token budget exceeded, review {admitted}/{len(units)} functions")
+        return len(tasks)
+    
+    
+    async def review_unit_with_budget(self, unit: ReviewUnit, tokens: int):
+        try:
+            await self.review_unit(unit)
+        finally:
+            self.token_budget.release(tokens, TokenBudget.tokens_used(self.request_timings))
+    
+    
+    # 汇总本次运行的 token 消耗、缓存命中和跳过的函数
+    def report_summary(self):
+        self.summary.add_llm_usage(self.request_timings,
+                                   self.ai_module.cached_prompt_tokens, self.price_per_1k_tokens)
+        if self.token_budget is not None:
+            self.summary.counters["token_budget"] = self.token_budget.max_tokens
+            self.summary.counters["token_budget_used"] = self.token_budget.used
+        self.summary.counters["cache_hits"] = self.review_cache.hits - self.cache_hits_start
+        self.summary.counters["cache_misses"] = self.review_cache.misses - self.cache_misses_start
+        self.summary.report()
+
+        
+    # 完整的一次审查：获取变更文件、解析并审查、提交评论、输出汇总
+    async def run(self):
+        with record_request_timings(self.request_timings):
+            self.incremental_diff = await self.load_incremental_diff()
+            diff_files = self.iter_diff_file_structs()
+            if not await self.analyze_code(diff_files):
+                logger.warning(f"No files available for review")
+                await self.save_review_state()
+                return
+            # PR 已有更新的提交时不提交评论，也不记录审查状态，由新提交的审查负责
+            if await self.github_assistant.submit_review():
+                await self.save_review_state()
+            self.report_summary()
+    
+    
+    # 离线模式：只解析和审查，结果写入文件，不提交评论也不记录审查状态；token 消耗等由调用方统一汇总
+    async def run_offline(self) -> int:
+        with record_request_timings(self.request_timings):
+            return await self.analyze_code(self.iter_diff_file_structs())
 
         
 async def async_main(pull_request_id: int):
     analyzer = CppCodeAnalyzer(pull_request_id)
     try:
-        diff_files =  analyzer.github_assistant.get_diff_file_structs()
-        if not diff_files:
-            logger.warning(f"No files available for review")
-            return
-        await analyzer.analyze_code(diff_files)
+        await analyzer.run()
     except Exception as e:
         logger.exception(f"Unknown error:{e}")
         raise
     finally:
         await analyzer.close()
+        # 无论成功与否都导出本次运行的指标
+        metrics.write(analyzer.summary.to_dict())
         
 
 def validate_args(args) -> int:
     
-    if hasattr(args, 'pull_request_id'):
+    if (args.scan or args.merge) and not args.output:
+        raise ValueError("--scan and --merge require --output")
+    
+    # 离线模式从 --range / --pulls / --scan 获取审查对象，不需要 pull_request_id
+    if args.output:
+        if args.merge:
+            if args.range or args.pulls or args.pulls_file or args.scan:
+                raise ValueError("--merge cannot be combined with other offline targets")
+            return 0
+        # 扫描的吞吐统计按整个运行计算，不与其他审查对象混合
+        if args.scan and (args.range or args.pulls or args.pulls_file):
+            raise ValueError("--scan cannot be combined with --range, --pulls or --pulls-file")
+        if not (args.range or args.pulls or args.pulls_file or args.scan):
+            raise ValueError("Offline mode requires --range, --pulls, --pulls-file or --scan")
+        if args.jobs <= 0:
+            raise ValueError("Offline review jobs must be greater than 0")
+        return 0
+    
+    if args.pull_request_id is not None:
         if args.pull_request_id <= 0:
             raise ValueError("Pull request id must be greater than 0")
         return args.pull_request_id
@@ -242,21 +579,70 @@ def validate_args(args) -> int:
         
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("pull_request_id", type=int, help="pull request id")
+    parser.add_argument("pull_request_id", type=int, nargs="?", help="pull request id")
     parser.add_argument("--debug", type=bool, help="debug mode", required=False)
+    parser.add_argument("--profile", action="store_true", help="dump cProfile stats to METRICS_DIR/profile.pstats")
+    parser.add_argument("--output", help="offline mode: write reviews to this file instead of posting comments")
+    parser.add_argument("--format", choices=ReviewOutput.formats, default="jsonl", help="offline output format")
+    parser.add_argument("--repository", default=os.environ.get("REPOSITORY_PATH", "."),
+                        help="offline mode: local repository used by --range")
+    parser.add_argument("--range", action="append", default=[],
+                        help="offline mode: review changes of base...head, can be repeated")
+    parser.add_argument("--pulls", help="offline mode: comma separated pull request ids")
+    parser.add_argument("--pulls-file", help="offline mode: file with one pull request id per line")
+    parser.add_argument("--jobs", type=int, default=int(os.environ.get("OFFLINE_REVIEW_CONCURRENCY", "4")),
+                        help="offline mode: number of ranges / pull requests reviewed concurrently")
+    parser.add_argument("--scan", action="store_true",
+                        help="offline mode: review every function of --repository instead of a diff")
+    parser.add_argument("--shard", default="0/1",
+                        help="scan mode: review only shard i of N (i/N, 0-based), split by file path hash")
+    parser.add_argument("--merge", nargs="+", metavar="INPUT",
+                        help="merge partial JSONL results and scan stats of shards into --output")
     
     
     try:
         args = parser.parse_args()
         if (pr_id := validate_args(args)) is None:
             return
-            
-        logger.info(f"Start review pull request {pr_id}'s code")
         
-        if hasattr(args, 'debug') and args.debug:
-            asyncio.run(async_main(pr_id), debug=True)
+        if args.merge:
+            logger.info(f"Start merge review output, inputs:{len(args.merge)}, output:{args.output}")
+            merge_results(args.output, args.format, args.merge)
+            return
+        
+        if args.output:
+            import offline_review
+            pull_request_ids = offline_review.parse_pull_request_ids(args.pulls or "")
+            if args.pulls_file:
+                with open(args.pulls_file, "r", encoding="utf-8") as f:
+                    pull_request_ids.extend(offline_review.parse_pull_request_ids(f.read()))
+            ranges = [offline_review.parse_range(text) for text in args.range]
+            shard = parse_shard(args.shard) if args.scan else None
+            logger.info(f"Start offline review, ranges:{len(ranges)}, pull requests:{len(pull_request_ids)}, "
+                        f"scan shard:{args.shard if args.scan else None}, output:{args.output}")
+            # 以脚本运行时本模块为 __main__，传入分析器类而不是由 offline_review 再导入本模块
+            main_coroutine = offline_review.async_main_offline(CppCodeAnalyzer, args.output, args.format,
+                                                               args.repository, ranges, pull_request_ids,
+                                                               args.jobs, shard)
         else:
-            asyncio.run(async_main(pr_id))
+            logger.info(f"Start review pull request {pr_id}'s code")
+            main_coroutine = async_main(pr_id)
+        
+        profiler = cProfile.Profile() if args.profile else None
+        if profiler:
+            profiler.enable()
+        try:
+            if hasattr(args, 'debug') and args.debug:
+                asyncio.run(main_coroutine, debug=True)
+            else:
+                asyncio.run(main_coroutine)
+        finally:
+            if profiler:
+                profiler.disable()
+                os.makedirs(metrics.directory, exist_ok=True)
+                profile_path = os.path.join(metrics.directory, "profile.pstats")
+                profiler.dump_stats(profile_path)
+                logger.info(f"Write profile stats success, path:{profile_path}")
         
     except (ValueError, argparse.ArgumentError) as e:
         logger.exception(f"parameter error:{e}")
@@ -1,10 +1,63 @@
 # logger.py
+import atexit
+import os
+import queue
 import sys
 import logging
+import logging.handlers
+import multiprocessing
 import structlog
 
-# 配置文件日志 Handler（记录 DEBUG 及以上）
-file_handler = logging.FileHandler("app.log", mode="w")
+# 解析进程池以 spawn 方式启动，工作进程会重新导入本模块：不轮转日志、不启动后台线程，由 init_worker 配置日志
+IS_WORKER_PROCESS = multiprocessing.current_process().name != "MainProcess"
+
+# 日志文件路径、单个文件大小上限和保留的历史文件数
+LOG_FILE = os.environ.get("LOG_FILE", "app.log")
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "3"))
+# 全局最低日志级别，低于该级别的日志不会生成
+LOG_LEVEL = logging.getLevelName(os.environ.get("LOG_LEVEL", "DEBUG").upper())
+# 日志队列长度上限，队列满时丢弃 INFO 及以下的日志
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# 单条日志中提示词、应答等大段内容的最大字符数
+LOG_MAX_PAYLOAD_CHARS = int(os.environ.get("LOG_MAX_PAYLOAD_CHARS", "2000"))
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    只把日志记录放入有界队列，由后台线程写文件和终端，事件循环线程不会阻塞在磁盘 IO 上
+    队列满时丢弃 INFO 及以下的日志并计数，WARNING 及以上的日志最多等待 1 秒
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+
+    def enqueue(self, record):
+        try:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record, timeout=1)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BoundedQueueListener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # 队列满时等待后台线程腾出空间，保证已入队的日志全部写出
+        self.queue.put(self._sentinel)
+
+
+# 配置文件日志 Handler（记录 DEBUG 及以上），超过大小上限时轮转
+file_handler = logging.handlers.RotatingFileHandler(
+    LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8", delay=True
+)
+# 每次启动从新文件开始，上一次运行的日志保留为 app.log.1
+if not IS_WORKER_PROCESS and os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > 0:
+    file_handler.doRollover()
 file_handler.setLevel(logging.DEBUG)  # 记录所有日志
 file_handler.setFormatter(logging.Formatter(
     "%(asctime)s - %(filename)s:%(lineno)d - %(levelname)s - %(message)s"
@@ -17,10 +70,41 @@ console_handler.setFormatter(logging.Formatter(
     "%(asctime)s - %(filename)s:%(lineno)d - %(levelname)s - %(message)s"
 ))
 
+# 两个 Handler 都由后台线程驱动
+queue_handler = BoundedQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+# 入队前只保留消息本身，时间、文件名等由后台线程中的 Handler 格式化
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+listener = BoundedQueueListener(queue_handler.queue, file_handler, console_handler, respect_handler_level=True)
+if not IS_WORKER_PROCESS:
+    listener.start()
+
+
+def stop_listener():
+    # 退出前写完队列中剩余的日志
+    listener.stop()
+    if queue_handler.dropped:
+        file_handler.handle(logging.makeLogRecord({
+            "levelno": logging.WARNING, "levelname": "WARNING", "filename": __file__.rsplit(os.sep, 1)[-1],
+            "msg": f"Log queue full, dropped {queue_handler.dropped} records"
+        }))
+
+
+def configure_worker_logging():
+    # 解析进程没有后台线程，直接写文件和终端；轮转只由主进程执行，避免多个进程同时重命名日志文件
+    root = logging.getLogger()
+    root.removeHandler(queue_handler)
+    file_handler.maxBytes = 0
+    root.addHandler(file_handler)
+    root.addHandler(console_handler)
+
+
+if not IS_WORKER_PROCESS:
+    atexit.register(stop_listener)
+
 # 配置 logging 适配 structlog
 logging.basicConfig(
-    level=logging.DEBUG,  # 全局最低日志级别
-    handlers=[file_handler, console_handler],  # 添加两个 Handler
+    level=LOG_LEVEL,  # 全局最低日志级别
+    handlers=[queue_handler],
 )
 
 # 让 structlog 适配 logging
@@ -33,9 +117,22 @@ structlog.configure(
         ),
         structlog.processors.JSONRenderer(ensure_ascii=False),
     ],
-    wrapper_class=structlog.make_filtering_bound_logger(logging.DEBUG),
+    wrapper_class=structlog.make_filtering_bound_logger(LOG_LEVEL),
     logger_factory=structlog.stdlib.LoggerFactory(),
 )
 
 # 创建全局 logger ---
-logger = structlog.get_logger("global_logger")
\ No newline at end of file
+logger = structlog.get_logger("global_logger")
+
+
+# 大段内容只保留前 LOG_MAX_PAYLOAD_CHARS 个字符
+def truncate_payload(payload: any) -> str:
+    text = payload if isinstance(payload, str) else str(payload)
+    if len(text) <= LOG_MAX_PAYLOAD_CHARS:
+        return text
+    return f"{text[:LOG_MAX_PAYLOAD_CHARS]}...(truncated, total {len(text)} chars)"
+
+
+# 构造代价较高的调试日志前先判断 DEBUG 是否开启
+def debug_enabled() -> bool:
+    return logger.is_enabled_for(logging.DEBUG)
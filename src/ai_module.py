@@ -1,10 +1,26 @@
+import contextlib
+import contextvars
 import httpx
 import json
 import os
-import aiohttp
 import common_function
-from ai_code_reviewer_logger import logger
-from httpx import AsyncClient
+from ai_code_reviewer_logger import logger, debug_enabled, truncate_payload
+from llm_provider import LLMProvider, LLMRouter
+from run_metrics import metrics
+
+
+# 当前审查的请求记录列表：常驻服务中多个审查共用同一个大模型客户端，各审查在自己的上下文中记录，互不混入
+current_request_timings = contextvars.ContextVar("current_request_timings", default=None)
+
+
+# 在 with 块内（包括其中创建的任务）发起的大模型请求记录到 timings
+@contextlib.contextmanager
+def record_request_timings(timings: list):
+    token = current_request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        current_request_timings.reset(token)
 
 
 def read_json_file(file_path : str) -> dict: 
@@ -35,6 +51,26 @@ class DeepSeek:
                                   在给出意见时请保持语言的简洁，只需对可能导致程序严重错误的地方提出修改建议，无需给出示例代码。
                                   review 时不需要吹毛求疵，如果没有更好的优化建议，建议的内容可以为空"""
     
+    MODEL_NAME = "deepseek-r1-250120"
+    
+    RESPONSE_ERROR = "AI model response error"
+    
+    # 应答因输出 token 或耗时预算被截断时附加在审查意见末尾，带有该标记的意见不写入缓存
+    TRUNCATED_NOTE = "\n\n（审查意见超出输出预算被截断，可能不完整）"
+    
+    # 没有审查意见时要求模型只回复该标记，流式模式下读到该标记即可提前结束
+    NO_SUGGESTION_MARKER = "NO_SUGGESTIONS"
+    NO_SUGGESTION_INSTRUCTION = f"如果没有任何需要修改的建议，请只回复 {NO_SUGGESTION_MARKER}，不要输出其他内容。"
+    
+    # 批量审查时要求模型按函数ID返回 JSON
+    BATCH_INSTRUCTION = ("以下包含多个函数，每个函数以 `### 函数ID` 开头。请分别审查每个函数，"
+                         "并只输出一个 JSON 对象：key 为函数ID，value 为该函数的审查意见字符串，"
+                         "没有建议的函数 value 为空字符串。")
+    
+    # 文件上下文和待审查代码的标题，同一文件的请求在待审查代码之前的部分逐字节相同
+    FILE_CONTEXT_HEADER = "以下是待审查代码所在文件的上下文（导入、类声明和函数签名），仅供参考，不需要审查："
+    CODE_HEADER = "需要审查的代码："
+    
     def __init__(self, url:str, key:str):
         # 参数校验
         common_function.parameter_check(url, "url")
@@ -42,93 +78,164 @@ class DeepSeek:
         
         common_function.log_init_check()
         
-        # 安全赋值
-        self.api_url = url.strip()
-        # 私有变量保护敏感数据
-        self._api_key = key.strip()
+        self.prompt = read_json_file("./prompt_level_configure.json")
+        # 提示词在启动时确定一次，作为固定的 system 消息
+        self.prompt_level, self.prompt_text = self.resolve_prompt_settings()
         
-        # 这个超时时间给的比较长是因为LLM的应答速度可能较慢
-        try: 
-            self.client = AsyncClient(trust_env=False, proxy=None, timeout=1000)
-        except Exception as e:
-            logger.exception(f"Init async client error:{e}")
-            raise RuntimeError("Init async client error") from e
+        # 流式模式及单个函数的输出 token / 耗时预算
+        self.stream = os.environ.get("LLM_STREAM", "1") == "1"
+        self.max_output_tokens = int(os.environ.get("LLM_MAX_OUTPUT_TOKENS", "4096"))
+        self.max_wall_time = float(os.environ.get("LLM_MAX_WALL_TIME", "300"))
         
-        self.prompt = read_json_file("./prompt_level_configure.json")
+        # 模型路由：未配置 LLM_PROVIDERS_FILE 时只有 LLM_API_URL 对应的一个接口
+        if providers_file := os.environ.get("LLM_PROVIDERS_FILE"):
+            self.router = self.load_router(providers_file)
+        else:
+            self.router = LLMRouter({"deepseek": self.create_provider("deepseek", url, key, self.MODEL_NAME)})
 
         logger.info("Init ai model deepseek success")
-        
-        
-    # 这个函数貌似没真正生效
-    @property
-    def api_key(self):
-        # 对api key进行隐藏
-        if len(self._api_key) > 10:
-            return f"****{self._api_key[-4:]}" if self._api_key else None
-        return None
+    
+    
+    def create_provider(self, name: str, url: str, key: str, model: str) -> LLMProvider:
+        return LLMProvider(name, url, key, model, self.stream, self.max_output_tokens, self.max_wall_time,
+                           self.NO_SUGGESTION_MARKER, self.record_timing)
+    
+    
+    # 从配置文件加载多个接口、路由规则和对冲设置，api key 通过 api_key_env 指定的环境变量读取
+    def load_router(self, providers_file: str) -> LLMRouter:
+        config = read_json_file(providers_file)
+        providers = {}
+        for item in config.get("providers", []):
+            key = os.environ.get(item.get("api_key_env", "LLM_API_KEY"))
+            providers[item["name"]] = self.create_provider(item["name"], item["url"], key, item["model"])
+        try:
+            return LLMRouter(providers, config.get("routing"), config.get("hedging"))
+        except KeyError as e:
+            raise ValueError(f"Unknown llm provider in {providers_file}:{e}") from e
+    
     
     async def close(self):
-        # 释放api key，防止其在内存中驻留
-        self._api_key = None  # 主动清除敏感数据
-        await self.client.aclose() # 主动释放链接
-        self.client = None
-        
-
+        # 释放api key 和连接
+        await self.router.close()
     
-    async def call_deepseek_async(self, prompt: str) -> any:
-        # 步调用 DeepSeek API 并返回结果
-        headers = {
-            "Authorization": f"Bearer {self._api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": "deepseek-r1-250120",
-            "messages": [{"role": "user", "content": prompt}]
+    
+    @classmethod
+    def is_truncated(cls, review: str) -> bool:
+        return review.endswith(cls.TRUNCATED_NOTE)
+    
+    
+    # 根据函数内容选择的模型，用于区分不同模型的审查结果缓存
+    def model_for(self, code_content: str) -> str:
+        return self.router.route(code_content).model
+    
+    
+    async def call_deepseek_async(self, messages: list, provider: LLMProvider = None) -> any:
+        # 异步调用大模型接口并返回结果，未指定接口时使用默认接口
+        with metrics.span("llm_request"):
+            return await self.router.call(provider or self.router.default, messages)
+    
+    
+    def record_timing(self, provider_name, first_token_time, total_time, usage, truncated):
+        timing = {
+            "provider": provider_name,
+            "time_to_first_token": first_token_time,
+            "total_time": total_time,
+            "usage": usage,
+            "truncated": truncated
         }
+        if (request_timings := current_request_timings.get()) is not None:
+            request_timings.append(timing)
+        metrics.observe("llm_total_time", total_time)
+        if first_token_time is not None:
+            metrics.observe("llm_time_to_first_token", first_token_time)
+        if truncated:
+            metrics.add("llm_truncated")
+        for name in ("prompt_tokens", "completion_tokens"):
+            metrics.add(f"llm_{name}", (usage or {}).get(name) or 0)
+        cached_tokens = self.cached_prompt_tokens(usage)
+        metrics.add("llm_cached_prompt_tokens", cached_tokens)
+        ttft = f"{first_token_time:.3f}s" if first_token_time is not None else "none"
+        logger.info(f"AI model request finished, provider:{provider_name}, ttft:{ttft}, "
+                    f"total:{total_time:.3f}s, cached prompt tokens:{cached_tokens}, truncated:{truncated}")
 
-        try:
-            response = await self.client.post(
-                self.api_url,
-                json=payload,
-                headers=headers)
-    
-            response.raise_for_status()  # 自动触发HTTPError 
-            response_json = response.json()     # FIXME:相应体较大未考虑   
-            # await response.close()
-            return response_json
-        
-        except httpx.HTTPStatusError as e:
-            logger.exception(f"HTTP error:{e}")
-            raise
-        except httpx.RequestError as e:
-            logger.exception(f"Network error:{e}")
-            raise
-        except json.JSONDecodeError as e:
-            logger.exception(f"Invalid JSON response:{e}")
-            raise
-        except Exception as e:
-            logger.exception(f"Unknown Error:{e}")
-            raise
-        finally:
-            if response:
-                await response.aclose()
 
-    async def call_ai_model(self, code_content):
+    # 命中模型服务前缀缓存的输入 token 数：DeepSeek 为 prompt_cache_hit_tokens，OpenAI 兼容接口为 prompt_tokens_details.cached_tokens
+    @staticmethod
+    def cached_prompt_tokens(usage: dict) -> int:
+        usage = usage or {}
+        return usage.get("prompt_cache_hit_tokens") or (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+
+    # 根据 PROMPT_LEVEL 确定提示词等级和提示词内容
+    def resolve_prompt_settings(self) -> tuple[str, str]:
+        prompt_level = os.environ.get("PROMPT_LEVEL")
+        if isinstance(prompt_level, str) and prompt_level in self.prompt:
+            return prompt_level, f"{self.prompt[prompt_level]}\n{self.NO_SUGGESTION_INSTRUCTION}"
+        return "default", f"{self.DEFAULT_PROMPT}\n{self.NO_SUGGESTION_INSTRUCTION}"
+
+
+    # 返回当前生效的提示词等级和提示词内容
+    def prompt_settings(self) -> tuple[str, str]:
+        return self.prompt_level, self.prompt_text
+
+
+    # system 消息只包含提示词，user 消息依次为文件上下文和待审查代码，前缀可以在多次请求之间复用
+    def build_messages(self, code_content: str, file_context: str = "", instruction: str = None) -> list:
+        system_prompt = f"{self.prompt_text}\n{instruction}" if instruction else self.prompt_text
+        user_content = code_content
+        if file_context:
+            user_content = f"{self.FILE_CONTEXT_HEADER}\n{file_context}\n\n{self.CODE_HEADER}\n{code_content}"
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ]
+
+    async def call_ai_model(self, code_content, file_context: str = ""):
         logger.info("Start call ai model")
         
         #主函数，调用 DeepSeek 并输出结果
-        prompt_level = os.environ.get("PROMPT_LEVEL")
-        if isinstance(prompt_level, str) and prompt_level in self.prompt:
-            full_prompt = f"{self.prompt[prompt_level]}\n{code_content}"
-        else:
-            full_prompt = f"{self.DEFAULT_PROMPT}\n{code_content}"
+        messages = self.build_messages(code_content, file_context)
+        return await self.request_review(messages, self.router.route(code_content))
+    
+    
+    # 将同一文件的多个小函数打包进一次请求，functions 为 {函数ID: 函数体}，返回 {函数ID: 审查意见}
+    # 调用方保证一批函数路由到同一模型，与各函数缓存 key 中的模型一致
+    # 应答不是合法的 JSON 对象时抛出 ValueError，由调用方退化为逐个请求
+    async def call_ai_model_batch(self, functions: dict, file_context: str = "") -> dict:
+        logger.info(f"Start call ai model, batch size:{len(functions)}")
         
-        logger.debug(f"Request content:{full_prompt}")
+        blocks = "\n".join(f"### {function_id}\n{body}" for function_id, body in functions.items())
+        messages = self.build_messages(blocks, file_context, instruction=self.BATCH_INSTRUCTION)
         
+        response_str = await self.request_review(messages, self.router.route_all(functions.values()))
+        if response_str == self.RESPONSE_ERROR:
+            raise ValueError("AI model batch response error")
+        # 被截断的批量应答无法可靠地拆分，退化为逐个请求
+        if self.is_truncated(response_str):
+            raise ValueError("AI model batch response truncated")
+        # 所有函数都没有建议
+        if not response_str.strip():
+            return {function_id: "" for function_id in functions}
+        
+        text = response_str.strip()
+        # 去掉模型可能附带的 ```json 代码块标记
+        if text.startswith("```"):
+            text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+        result = json.loads(text)
+        if not isinstance(result, dict) or not all(isinstance(v, str) for v in result.values()):
+            raise ValueError("AI model batch response is not a JSON object of strings")
+        # 与单个请求一致，模型表示没有建议时视为空意见
+        return {function_id: "" if review.strip().startswith(self.NO_SUGGESTION_MARKER) else review
+                for function_id, review in result.items()}
+    
+    
+    async def request_review(self, messages: list, provider: LLMProvider = None) -> str:
+        if debug_enabled():
+            logger.debug(f"Request content:{truncate_payload(messages[-1]['content'])}")
         try:
-            response = await self.call_deepseek_async(full_prompt)
-            logger.debug(f"DeepSeek Response:{response}")
+            response = await self.call_deepseek_async(messages, provider)
+            if debug_enabled():
+                logger.debug(f"DeepSeek Response:{truncate_payload(response)}")
         except httpx.HTTPError as e:
             logger.exception(f"Call ai model error:{e}")
             raise
@@ -138,9 +245,14 @@ class DeepSeek:
         
         if  isinstance(response, dict) and ("choices" in response and response["choices"]):
             if len(response["choices"]) > 0:
-                response_str = response["choices"][0]["message"]["content"]
+                response_str = response["choices"][0]["message"]["content"] or ""
+                # 模型表示没有建议时返回空字符串，调用方不再发表评论
+                if response_str.strip().startswith(self.NO_SUGGESTION_MARKER):
+                    return ""
+                if response.get("truncated"):
+                    return f"{response_str}{self.TRUNCATED_NOTE}"
                 return response_str
             else:
-                return "AI model response error"
+                return self.RESPONSE_ERROR
         else:
-            return "AI model response error"
+            return self.RESPONSE_ERROR
@@ -1,3 +1,6 @@
+import asyncio
+import json
+import os
 from ai_code_reviewer_logger import logger
 
 # 参数校验
@@ -8,4 +11,41 @@ def parameter_check(item : any, item_name : str):
 # 校验日志模块是否正常启动
 def log_init_check():
     if not hasattr(logger, 'info'):
-        raise RuntimeError(f":log init error")
\ No newline at end of file
+        raise RuntimeError(f":log init error")
+
+
+# 执行 git 命令并返回标准输出，失败时抛出 RuntimeError
+async def run_git(*args, env: dict = None) -> bytes:
+    process = await asyncio.create_subprocess_exec(
+        "git", *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=env
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        # 跳过 -C <目录> 和 -c <配置> 等全局选项，日志中只显示子命令
+        index = 0
+        while index < len(args) - 1 and args[index] in ("-C", "-c"):
+            index += 2
+        raise RuntimeError(f"git {args[index] if args else ''} failed, return code:{process.returncode}, "
+                           f"error:{stderr.decode('utf-8', errors='replace').strip()}")
+    return stdout
+
+
+# 先写入临时文件再原子替换，防止并发写入时读到半个文件
+def write_json_atomic(path: str, data, indent: int = None):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
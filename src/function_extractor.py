@@ -0,0 +1,316 @@
+import mmap
+import os
+import threading
+from tree_sitter import Parser, Query
+from ai_code_reviewer_logger import configure_worker_logging, logger
+from language_registry import LanguageSpec, registry
+from review_unit import ReviewUnit
+from token_budget import estimate_tokens, split_oversized_function
+from line_ranges import to_ranges, assign_ranges, expand_ranges, line_start_offsets
+from run_metrics import metrics
+
+
+class FunctionExtractor:
+    """
+    解析源码并提取包含变更行的函数，只依赖源码字节和变更行号，不涉及任何网络请求
+    既可以在主进程中使用，也可以在解析进程池的工作进程中使用
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, function_context_lines: int, max_function_tokens: int, chunk_context_lines: int,
+                 file_context_tokens: int = 0):
+        self.function_context_lines = function_context_lines
+        self.max_function_tokens = max_function_tokens
+        self.chunk_context_lines = chunk_context_lines
+        # 文件上下文（导入、类声明和函数签名）的 token 上限，为 0 时不生成
+        self.file_context_tokens = file_context_tokens
+
+        # 各语言的解析器和编译好的查询，第一次遇到该语言的文件时创建
+        self._parsers = {}
+        self._function_queries = {}
+        self._context_queries = {}
+
+
+    def is_supported(self, file_name: str) -> bool:
+        return registry.spec_for(file_name) is not None
+
+
+    def parser(self, spec: LanguageSpec) -> Parser:
+        language = registry.language(spec)
+        with self.lock: # 多线程安全
+            if spec.name not in self._parsers:
+                self._parsers[spec.name] = Parser(language)
+        return self._parsers[spec.name]
+
+
+    # 提前加载已安装的全部语法和查询，用于常驻服务和解析进程启动时预热
+    def warm_up(self):
+        for spec in registry.installed_specs():
+            self.parser(spec)
+            self.function_query(spec)
+            if self.file_context_tokens > 0 and spec.context_query:
+                self.context_query(spec)
+
+
+    def function_query(self, spec: LanguageSpec) -> Query:
+        return self.compile_query(self._function_queries, spec, spec.function_query, "function")
+
+
+    def context_query(self, spec: LanguageSpec) -> Query:
+        return self.compile_query(self._context_queries, spec, spec.context_query, "context")
+
+
+    # 按语言懒加载并缓存编译好的查询
+    def compile_query(self, queries: dict, spec: LanguageSpec, query_source: str, kind: str) -> Query:
+        language = registry.language(spec)
+        try:
+            with self.lock:
+                if spec.name not in queries:
+                    queries[spec.name] = language.query(query_source)
+        except Exception as e:
+            raise RuntimeError(f"Failed to compile {spec.name} {kind} query:{e}") from e
+        return queries[spec.name]
+
+
+    # 解析源码并返回 (待审查单元列表, 被切片的超长函数数量, 变更只涉及注释和空白而跳过的函数数量)
+    def extract(self, file_name: str, source, diff_positions: list) -> tuple[list, int, int]:
+        spec = registry.spec_for(file_name)
+        if spec is None:
+            return [], 0, 0
+        parser = self.parser(spec)
+
+        # 语法树解析
+        with metrics.span("parse"):
+            tree = parser.parse(source)
+
+        # 查找函数并与变更区间求交
+        changed_ranges = to_ranges(diff_positions)
+        query = self.function_query(spec)
+        units, comment_only = self.collect_review_units(tree.root_node, changed_ranges, file_name, source, query)
+        units, chunked = self.split_oversized_units(units, source)
+        self.attach_file_context(units, spec, tree.root_node, source)
+        return units, chunked, comment_only
+
+
+    # 增量审查：解析当前源码，只保留字节范围与两次 head 之间的 hunk 相交的函数，
+    # 返回 (待审查单元列表, 被切片的超长函数数量, 未改动而跳过的函数数量, 变更只涉及注释和空白而跳过的函数数量)
+    def extract_incremental(self, file_name: str, source, hunks: list,
+                            diff_positions: list) -> tuple[list, int, int, int]:
+        spec = registry.spec_for(file_name)
+        if spec is None:
+            return [], 0, 0, 0
+        parser = self.parser(spec)
+
+        with metrics.span("parse"):
+            tree = parser.parse(source)
+
+        changed_ranges = to_ranges(diff_positions)
+        query = self.function_query(spec)
+        units, comment_only = self.collect_review_units(tree.root_node, changed_ranges, file_name, source, query)
+        edited_ranges = self.edited_ranges(source, hunks)
+        edited_units = [unit for unit in units
+                        if any(start <= unit.end_byte and end >= unit.start_byte for start, end in edited_ranges)]
+        skipped = len(units) - len(edited_units)
+        edited_units, chunked = self.split_oversized_units(edited_units, source)
+        self.attach_file_context(edited_units, spec, tree.root_node, source)
+        return edited_units, chunked, skipped, comment_only
+
+
+    # 将 --unified=0 的 hunk 转换为新源码中的字节范围 [(起点, 终点), ...]，只删除行的 hunk 为删除位置处的空范围
+    @staticmethod
+    def edited_ranges(source, hunks: list) -> list:
+        offsets = line_start_offsets(source)
+        offset = lambda line: offsets[min(line, len(offsets)) - 1]
+
+        edited_ranges = []
+        for _, _, new_start, new_count in hunks:
+            # 行数为 0 时表示在该行之后删除
+            new_line = new_start if new_count else new_start + 1
+            edited_ranges.append((offset(new_line), offset(new_line + new_count)))
+        return edited_ranges
+
+
+    # 同一文件的全部待审查单元共用一份文件上下文，保证同一文件的请求前缀逐字节相同，可以命中模型服务的前缀缓存
+    def attach_file_context(self, units: list, spec: LanguageSpec, root_node, source):
+        if not units or self.file_context_tokens <= 0 or not spec.context_query:
+            return
+        file_context = self.build_file_context(spec, root_node, source)
+        for unit in units:
+            unit.file_context = file_context
+
+
+    # 按源码顺序拼接导入、类型定义和各个类 / 函数的签名，超出 token 上限后截断
+    def build_file_context(self, spec: LanguageSpec, root_node, source) -> str:
+        captures = self.context_query(spec).captures(root_node)
+        nodes = sorted(((node, kind) for kind, nodes in captures.items() for node in nodes),
+                       key=lambda item: (item[0].start_byte, -item[0].end_byte))
+
+        lines = []
+        tokens = 0
+        last_end_byte = 0
+        for node, kind in nodes:
+            if node.start_byte < last_end_byte and kind == "import":
+                continue  # 已包含在上一段文本中
+            body = node.child_by_field_name("body") if kind == "declaration" else None
+            # 从所在行的行首开始以保留缩进，与上一段文本位于同一行时从节点起点开始
+            start = source.rfind(b"\n", 0, node.start_byte) + 1
+            if start < last_end_byte:
+                start = node.start_byte
+            end = body.start_byte if body is not None else node.end_byte
+            text = source[start:end].decode("utf-8", errors="replace").rstrip()
+            last_end_byte = end
+            if not text.strip():
+                continue
+            tokens += estimate_tokens(text)
+            if tokens > self.file_context_tokens:
+                lines.append("...")
+                break
+            lines.append(text)
+        return "\n".join(lines)
+
+
+    # 使用预编译的 Query 在原生代码中查找全部函数节点，只保留最外层函数（嵌套函数随外层函数一起审查）
+    @staticmethod
+    def find_functions(root_node, query) -> list:
+        nodes = [node for nodes in query.captures(root_node).values() for node in nodes]
+        nodes.sort(key=lambda node: (node.start_byte, -node.end_byte))
+
+        functions = []
+        last_end_byte = -1
+        for node in nodes:
+            if node.end_byte <= last_end_byte:
+                continue  # 被上一个函数包含
+            functions.append((node.start_point[0] + 1, node.end_point[0] + 1, node))  # start_point 是 (行, 列)，索引从 0 开始
+            last_end_byte = node.end_byte
+        return functions
+
+
+    # 将变更区间映射到函数，收集包含变更行的函数作为待审查单元
+    # 返回 (待审查单元列表, 变更行只包含注释和空白而跳过的函数数量)
+    def collect_review_units(self, root_node, changed_ranges, file_name, source, query) -> tuple[list, int]:
+        units = []
+        comment_only = 0
+        functions = self.find_functions(root_node, query)
+        for node, ranges in assign_ranges(functions, changed_ranges):
+            changed_lines = expand_ranges(ranges)
+            if self.is_comment_only_change(root_node, node, changed_lines, source):
+                comment_only += 1
+                continue
+            # 将 comments 添加到该函数变更的第一行
+            units.append(ReviewUnit(len(units), file_name, changed_lines[0],
+                                    self.extract_function_body(node, source, self.function_context_lines),
+                                    changed_lines, node.start_point[0] + 1, node.end_point[0] + 1,
+                                    node.start_byte, node.end_byte))
+        return units, comment_only
+
+
+    # 函数内的变更行是否全部为空行或注释：从每行第一个非空白字节开始，逐段跳过注释节点，遇到其他节点即为代码
+    @staticmethod
+    def is_comment_only_change(root_node, function_node, changed_lines: list, source) -> bool:
+        line = function_node.start_point[0] + 1
+        line_start = source.rfind(b"\n", 0, function_node.start_byte) + 1
+        for changed_line in changed_lines:
+            # 变更行有序，从函数起点向后逐行移动
+            while line < changed_line and line_start < len(source):
+                next_line = source.find(b"\n", line_start)
+                line_start = len(source) if next_line == -1 else next_line + 1
+                line += 1
+            line_end = source.find(b"\n", line_start)
+            line_end = len(source) if line_end == -1 else line_end
+
+            position = FunctionExtractor.skip_whitespace(source, line_start, line_end)
+            while position < line_end:
+                node = root_node.descendant_for_byte_range(position, position + 1)
+                # 跳过 // 等匿名记号，注释节点可能包含子节点（如 Rust 的文档注释），取最外层的注释节点
+                while node is not None and not node.is_named:
+                    node = node.parent
+                comment = None
+                while node is not None and "comment" in node.type:
+                    comment = node
+                    node = node.parent
+                if comment is None or comment.end_byte <= position:
+                    return False
+                position = FunctionExtractor.skip_whitespace(source, comment.end_byte, line_end)
+        return True
+
+
+    @staticmethod
+    def skip_whitespace(source, position: int, end: int) -> int:
+        while position < end and source[position:position + 1] in (b" ", b"\t", b"\r", b"\f", b"\v"):
+            position += 1
+        return position
+
+
+    # 超过单函数 token 上限的函数只发送变更 hunk 及其上下文，必要时切分为多个重叠窗口
+    def split_oversized_units(self, units: list, source) -> tuple[list, int]:
+        result = []
+        chunked = 0
+        for unit in units:
+            if estimate_tokens(unit.function_body) <= self.max_function_tokens:
+                result.append(unit)
+                continue
+
+            chunked += 1
+            line_start = source.rfind(b"\n", 0, unit.start_byte) + 1
+            function_lines = source[line_start:unit.end_byte].decode("utf-8", errors="replace").splitlines()
+            chunks = split_oversized_function(
+                function_lines,
+                unit.start_line,
+                unit.changed_lines,
+                self.max_function_tokens,
+                self.chunk_context_lines
+            )
+            logger.info(f"Function too large, split into {len(chunks)} chunks, "
+                        f"file:{unit.file_name}, line:{unit.start_line}")
+            for changed_lines, text in chunks:
+                # 每个片段只带自身范围内的变更行，评论锚定在片段内第一处变更
+                result.append(ReviewUnit(0, unit.file_name, changed_lines[0], text, changed_lines,
+                                         unit.start_line, unit.end_line, unit.start_byte, unit.end_byte))
+
+        for index, unit in enumerate(result):
+            unit.index = index
+        return result, chunked
+
+
+    # 直接按字节范围从源码中切出函数体，保留原始格式
+    # 起点对齐到所在行的行首，context_lines 大于 0 时额外附带前后若干行
+    @staticmethod
+    def extract_function_body(node, source, context_lines: int = 0) -> str:
+        start = source.rfind(b"\n", 0, node.start_byte) + 1
+        end = node.end_byte
+        for _ in range(context_lines):
+            if start == 0:
+                break
+            start = source.rfind(b"\n", 0, start - 1) + 1
+        for _ in range(context_lines):
+            if (next_end := source.find(b"\n", end + 1)) == -1:
+                end = len(source)
+                break
+            end = next_end
+        return source[start:end].decode("utf-8", errors="replace")
+
+
+# 以下为解析进程池使用的函数，每个工作进程持有一份预热好的 FunctionExtractor
+_worker_extractor = None
+
+
+def init_worker(function_context_lines: int, max_function_tokens: int, chunk_context_lines: int,
+                file_context_tokens: int):
+    global _worker_extractor
+    configure_worker_logging()
+    _worker_extractor = FunctionExtractor(function_context_lines, max_function_tokens, chunk_context_lines,
+                                          file_context_tokens)
+    _worker_extractor.warm_up()
+
+
+# 在工作进程中读取并解析文件，只把轻量的待审查单元返回给主进程
+# hunks 不为 None 时为增量审查，返回值与 extract_incremental 相同，否则与 extract 相同
+def extract_file_in_worker(file_name: str, file_path: str, diff_positions: list, hunks: list = None) -> tuple:
+    if os.path.getsize(file_path) == 0:
+        return ([], 0, 0) if hunks is None else ([], 0, 0, 0)
+    with open(file_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            if hunks is None:
+                return _worker_extractor.extract(file_name, source, diff_positions)
+            return _worker_extractor.extract_incremental(file_name, source, hunks, diff_positions)
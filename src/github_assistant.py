@@ -1,9 +1,15 @@
-import requests
+import asyncio
+import hashlib
+import httpx
 import json
+import os
 import re
 import urllib.parse
 import common_function
-from ai_code_reviewer_logger import logger
+from ai_code_reviewer_logger import logger, debug_enabled, truncate_payload
+from github_cache import GithubResponseCache
+from resilience import ResilientExecutor
+from run_metrics import metrics
 from dataclasses import dataclass
 from enum import Enum
 
@@ -16,6 +22,9 @@ class DiffFileStruct:
 
 class GithubAssistant:
     
+    # 单次 create review 请求中携带的最大评论数，超出后分批提交
+    max_comments_per_review = int(os.environ.get("GITHUB_REVIEW_CHUNK_SIZE", "50"))
+    
     hunk_header_re = re.compile(r'^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@')
     
     def __init__(
@@ -23,7 +32,9 @@ class GithubAssistant:
         github_token: str,
         repository_owner: str,
         repository_name: str,
-        pull_request_id: int
+        pull_request_id: int,
+        client: httpx.AsyncClient = None,
+        response_cache: GithubResponseCache = None
     ):
         common_function.parameter_check(github_token, "github token")
         common_function.parameter_check(repository_owner, "repository owner")
@@ -39,23 +50,64 @@ class GithubAssistant:
         self.pull_request_id = pull_request_id
         
         # 设置github api 请求头
-        self.headers = {
-        "Authorization": f"Bearer {self._github_token}",
-        "Accept": "application/vnd.github+json",
-        "X-GitHub-Api-Version":"2022-11-28"
-        }
+        self.headers = self.make_headers(self._github_token)
         
-        self.pr_base_url = f"https://api.github.com/repos/{self.owner}/{self.repo}/pulls/{self.pull_request_id}"
+        # GitHub Actions 中会自动设置 GITHUB_API_URL，GitHub Enterprise 或本地测试时指向对应地址
+        self.api_base_url = os.environ.get("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+        self.pr_base_url = f"{self.api_base_url}/repos/{self.owner}/{self.repo}/pulls/{self.pull_request_id}"
         
-        # 获取 commit SHA
+        # 被审查仓库在本地的检出目录，默认与工作流中的检出位置一致
+        self.repository_path = os.environ.get("REPOSITORY_PATH", f"../../{self.repo}")
         
+        # 复用连接池，避免每次请求重新建立连接；传入 client 时（常驻服务模式）由调用方负责关闭
+        self.owns_client = client is None
+        self.client = client if client is not None else self.create_client(self._github_token)
+        
+        # GET 请求的磁盘缓存（条件请求）和本次运行内的结果复用，同一地址在一次审查中只请求一次
+        self.response_cache = response_cache
+        self.get_memo = {}
+        
+        # 重试、熔断、配额感知和自适应并发控制
+        self.executor = ResilientExecutor.from_env("github", 4, 10)
+        
+        # 获取 commit SHA
         self._commit_sha = None
+        self._commit_sha_lock = asyncio.Lock()
+        
+        # 本次运行中待提交的评论，全部审查完成后统一提交
+        self.pending_comments = []
+        self._submit_lock = asyncio.Lock()
     
         logger.info("Init github assistant success")
     
     
+    @staticmethod
+    def make_headers(github_token: str) -> dict:
+        return {
+        "Authorization": f"Bearer {github_token}",
+        "Accept": "application/vnd.github+json",
+        "X-GitHub-Api-Version":"2022-11-28"
+        }
+    
+    
+    @classmethod
+    def create_client(cls, github_token: str) -> httpx.AsyncClient:
+        common_function.parameter_check(github_token, "github token")
+        try:
+            return httpx.AsyncClient(
+                headers=cls.make_headers(github_token),
+                timeout=10,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+            )
+        except Exception as e:
+            logger.exception(f"Init async client error:{e}")
+            raise RuntimeError("Init async client error") from e
+    
+    
     async def close(self):
         self._github_token = None  # 主动清除敏感数据    
+        if self.owns_client:
+            await self.client.aclose() # 主动释放链接
     
     
     # 对token进行保护
@@ -66,40 +118,121 @@ class GithubAssistant:
         return None
 
 
-    # 懒加载，需要时再获取
-    @property
-    def commit_sha(self) -> str | None:
-        if self._commit_sha is None:
-            response_json =  self.call_github_api("GET", self.pr_base_url)
-            if "head" not in response_json or "sha" not in response_json["head"]:
-                raise KeyError("Missing commit SHA in PR data")
-            self._commit_sha = response_json["head"]["sha"]
+    # 已知本次审查对应的提交时（例如来自 webhook）直接指定，评论将锚定在该提交上
+    def set_commit_sha(self, commit_sha: str):
+        self._commit_sha = commit_sha
+    
+    
+    # PR 的详细信息，包括 base / head 提交；GET 请求在一次运行中只发送一次
+    async def get_pull_request(self) -> dict:
+        return await self.call_github_api("GET", self.pr_base_url)
+    
+    
+    # 懒加载，需要时再获取，加锁保证并发调用时只请求一次
+    async def get_commit_sha(self) -> str | None:
+        async with self._commit_sha_lock:
+            if self._commit_sha is None:
+                response_json = await self.get_pull_request()
+                if "head" not in response_json or "sha" not in response_json["head"]:
+                    raise KeyError("Missing commit SHA in PR data")
+                self._commit_sha = response_json["head"]["sha"]
         
         return self._commit_sha
 
 
-    def call_github_api(self, request_method:str, url:str, payload:dict = None) -> any:
+    async def send_github_request(self, request_method:str, url:str, payload:dict = None) -> httpx.Response:
+        if request_method == "GET":
+            return await self.send_memoized_get(url)
+        return await self.send_uncached_request(request_method, url, payload)
+    
+    
+    # 同一地址在本次运行中只请求一次，并发的相同请求共用一个结果，失败的请求不复用
+    async def send_memoized_get(self, url: str) -> httpx.Response:
+        if url in self.get_memo:
+            metrics.add("github_memo_hits")
+        else:
+            self.get_memo[url] = asyncio.ensure_future(self.send_conditional_get(url))
+        task = self.get_memo[url]
         try:
-            with requests.request(request_method, url, headers=self.headers, timeout=10, json=payload) as response:
+            return await asyncio.shield(task)
+        except Exception:
+            if self.get_memo.get(url) is task:
+                del self.get_memo[url]
+            raise
+    
+    
+    # 携带缓存的 ETag / Last-Modified 发送条件请求，304 时使用缓存的应答
+    async def send_conditional_get(self, url: str) -> httpx.Response:
+        entry = self.response_cache.get(url) if self.response_cache is not None else None
+        response = await self.send_uncached_request("GET", url, headers=GithubResponseCache.conditional_headers(entry))
+        if response.status_code == 304 and entry is not None:
+            metrics.add("github_not_modified")
+            return self.response_cache.to_response(entry, response.request)
+        if self.response_cache is not None:
+            self.response_cache.put(url, response)
+        return response
+    
+    
+    async def send_uncached_request(self, request_method:str, url:str, payload:dict = None,
+                                    headers:dict = None) -> httpx.Response:
+        async def request():
+            with metrics.span("github_request"):
+                response = await self.client.request(request_method, url, json=payload, headers=headers)
+            metrics.add("github_requests")
+            metrics.add("github_bytes_sent", len(response.request.content))
+            metrics.add("github_bytes_received", len(response.content))
+            self.executor.observe_rate_limit(response.headers)
+            # 条件请求命中时返回 304，由调用方使用缓存的应答
+            if not (response.status_code == 304 and headers):
                 response.raise_for_status()  # 自动触发HTTPError
-                response_json = response.json()
-                logger.info(f"API success response, url:{url}, request_method:{request_method}")
-                logger.debug(f"response json:{response_json}")
-                return response_json
-        except requests.exceptions.RequestException as e:
+            return response
+        
+        try:
+            endpoint = f"{request_method} {urllib.parse.urlsplit(url).path}"
+            # POST 创建 review / 评论，不是幂等请求
+            response = await self.executor.call(endpoint, request, idempotent=request_method != "POST")
+            logger.info(f"API success response, url:{url}, request_method:{request_method}")
+            return response
+        except httpx.HTTPStatusError as e:
             logger.exception(f"API request failed:{e}")
             raise
-        except requests.exceptions.JSONDecodeError:
-            logger.exception("Failed to parse response JSON")
+        except httpx.RequestError as e:
+            logger.exception(f"Network error:{e}")
+            raise
         except Exception as e:
-            logger.exception("Unknown error:{e}")
+            logger.exception(f"Unknown error:{e}")
             raise
+
+
+    async def call_github_api(self, request_method:str, url:str, payload:dict = None) -> any:
+        response = await self.send_github_request(request_method, url, payload)
+        try:
+            response_json = response.json()
+            if debug_enabled():
+                logger.debug(f"response json:{truncate_payload(response_json)}")
+            return response_json
+        except json.JSONDecodeError:
+            logger.exception("Failed to parse response JSON")
         
     
-    # FIXME: 暂时不考虑分页
-    def get_pr_change_files(self):
-        url = f"https://api.github.com/repos/{self.owner}/{self.repo}/pulls/{self.pull_request_id}/files?per_page=100" # 目前最大支持单次100个文件的修改
-        return self.call_github_api("GET", url)
+    # 按 Link 头逐页获取 PR 的变更文件，每获取一页就立即返回给调用方
+    # GitHub 该接口最多返回 3000 个文件
+    async def iter_pr_change_files(self):
+        url = f"{self.pr_base_url}/files?per_page=100"
+        page = 0
+        while url:
+            with metrics.span("fetch_pr_files"):
+                response = await self.send_github_request("GET", url)
+            try:
+                files = response.json()
+            except json.JSONDecodeError:
+                logger.exception(f"Failed to parse response JSON, url:{url}")
+                raise
+            page += 1
+            logger.debug(f"Get pull request's change files page:{page}, count:{len(files)}")
+            for file in files:
+                yield file
+            url = response.links.get("next", {}).get("url")
 
     
     # FIXME:这个函数需要进一步测试其准确性
@@ -135,33 +268,134 @@ class GithubAssistant:
         return positions
     
 
-    # 发送评论
+    # 记录评论，不会立即发送，由 submit_review 提交
     def add_comment(self, filename, position, comment_text):
-        comment_url = f"{self.pr_base_url}/comments"
-        
-        payload = {
+        metrics.add("comments_added")
+        self.pending_comments.append({
             "body": comment_text,
-            "commit_id": self.commit_sha,  # PR 的最新 commit SHA (需提前获取)
             "path": filename,
             "side":"RIGHT", # 暂时只关注新增行
             "line": position 
-        }
-        self.call_github_api("POST", comment_url, payload)
+        })
+    
+    
+    # 将本次运行收集到的评论通过 create review 接口批量提交
+    # PR 的 head 已经更新时丢弃评论并返回 False，过时的评论不会出现在 PR 上
+    async def submit_review(self) -> bool:
+        async with self._submit_lock:
+            if not self.pending_comments:
+                logger.info("No review comments to submit")
+                return True
+            
+            if await self.is_superseded():
+                metrics.add("github_review_superseded")
+                logger.warning(f"Pull request has newer commits, drop {len(self.pending_comments)} review comments")
+                self.pending_comments = []
+                return False
+            
+            comments, self.pending_comments = self.pending_comments, []
+            await self.submit_comments(comments)
+            return True
+    
+    
+    # 重新读取 PR 的 head（不使用缓存和本次运行内的复用），与本次审查的提交比较
+    async def is_superseded(self) -> bool:
+        commit_sha = await self.get_commit_sha()
+        response = await self.send_uncached_request("GET", self.pr_base_url)
+        head_sha = (response.json().get("head") or {}).get("sha")
+        return bool(head_sha) and head_sha != commit_sha
+    
+    
+    async def submit_comments(self, comments: list):
+        # 各函数的审查并发完成，提交前按文件和行号排序保证顺序稳定
+        comments = sorted(comments, key=lambda c: (c["path"], c["line"]))
+        commit_sha = await self.get_commit_sha()  # PR 的最新 commit SHA
+        review_url = f"{self.pr_base_url}/reviews"
+        
+        for start in range(0, len(comments), self.max_comments_per_review):
+            chunk = comments[start:start + self.max_comments_per_review]
+            marker = self.review_marker(commit_sha, chunk)
+            payload = {
+                "commit_id": commit_sha,
+                "event": "COMMENT",
+                # 不可见的标记，用于确认结果不明的提交是否已经被 GitHub 接受
+                "body": marker,
+                "comments": chunk
+            }
+            try:
+                await self.post_review(review_url, payload, marker)
+            except httpx.HTTPStatusError as e:
+                # 422 通常是个别评论行号不在 diff 中导致整批失败，退化为逐条提交
+                if e.response.status_code != 422:
+                    raise
+                logger.warning(f"Submit review chunk failed, fallback to single comments:{e}")
+                await self.submit_single_comments(commit_sha, chunk)
+        
+        logger.info(f"Submit {len(comments)} review comments success")
+    
+    
+    # 创建 review 不是幂等请求，执行器不会在 5xx / 超时后重试；先确认 review 没有被创建，再按退避时间重试
+    async def post_review(self, review_url: str, payload: dict, marker: str):
+        for attempt in range(self.executor.max_attempts):
+            try:
+                with metrics.span("submit_review"):
+                    return await self.call_github_api("POST", review_url, payload)
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code < 500:
+                    raise
+                error, response = e, e.response
+            except httpx.TransportError as e:
+                error, response = e, None
+            if await self.review_exists(marker):
+                return None
+            if attempt + 1 >= self.executor.max_attempts:
+                raise error
+            delay = self.executor.retry_delay(attempt, response)
+            logger.warning(f"Review was not created, retry in {delay:.1f}s, attempt:{attempt + 1}")
+            await asyncio.sleep(delay)
+    
+    
+    @staticmethod
+    def review_marker(commit_sha: str, comments: list) -> str:
+        content = json.dumps([commit_sha, comments], ensure_ascii=False, sort_keys=True)
+        return f"<!-- ai-code-review:{hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]} -->"
+    
+    
+    # 创建 review 的请求失败但可能已被服务端处理时（5xx、超时），查询 PR 的 review 确认是否已经创建，避免重试时重复提交
+    async def review_exists(self, marker: str) -> bool:
+        url = f"{self.pr_base_url}/reviews?per_page=100"
+        while url:
+            # 不使用条件请求缓存，需要最新的结果
+            response = await self.send_uncached_request("GET", url)
+            if any(marker in (review.get("body") or "") for review in response.json()):
+                logger.warning("Submit review failed but the review was already created, skip retry")
+                metrics.add("github_review_already_created")
+                return True
+            url = response.links.get("next", {}).get("url")
+        return False
+    
+    
+    async def submit_single_comments(self, commit_sha, comments):
+        comment_url = f"{self.pr_base_url}/comments"
+        for comment in comments:
+            try:
+                await self.call_github_api("POST", comment_url, {**comment, "commit_id": commit_sha})
+            except httpx.HTTPError as e:
+                logger.error(f"Submit comment failed, path:{comment['path']}, line:{comment['line']}, error:{e}")
 
     
-    def get_diff_file_structs(self):
+    # 以异步生成器的形式返回变更文件，分页获取的同时即可开始解析和审查
+    async def iter_diff_file_structs(self):
         
         logger.info("Start get pull request's change files")
-        # 遍历所有文件并添加评论
-        files = self.get_pr_change_files()
-        diff_file_struct_list = []
-        
-        for file in files:
+        async for file in self.iter_pr_change_files():
             if "filename" in file:
                 filename = file.get("filename")
-                filepath = f"../../{self.repo}/{filename}"
+                filepath = os.path.join(self.repository_path, filename)
                 patch = file.get("patch", "")
                 positions = self.get_comment_positions(patch)
-                diff_file_struct_list.append(DiffFileStruct(filename, filepath, positions)) 
-
-        return diff_file_struct_list
+                yield DiffFileStruct(filename, filepath, positions)
+    
+    
+    async def get_diff_file_structs(self):
+        return [diff_file_struct async for diff_file_struct in self.iter_diff_file_structs()]
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import time
+import httpx
+import common_function
+from ai_code_reviewer_logger import logger
+
+
+class GithubResponseCache:
+    """
+    GitHub GET 请求的磁盘缓存，保存应答体以及 ETag / Last-Modified
+    再次请求同一地址时携带 If-None-Match / If-Modified-Since，GitHub 返回 304 时直接使用缓存的应答，304 不消耗主速率限制
+    默认位于 review 缓存目录下，与 review 结果一起在多次运行之间保存，并由 ReviewCache.evict 统一淘汰
+    """
+
+    # 需要随应答体一起保存的响应头，分页依赖 link
+    kept_headers = ("content-type", "link", "etag", "last-modified")
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        logger.info(f"Init github response cache success, cache dir:{self.cache_dir}")
+
+
+    def _entry_path(self, url: str) -> str:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+
+    def get(self, url: str) -> dict | None:
+        path = self._entry_path(url)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            # 更新访问时间，淘汰时按最近使用排序
+            os.utime(path)
+            return entry if entry.get("url") == url else None
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Read github response cache entry failed:{path}, error:{e}")
+            return None
+
+
+    # 条件请求需要携带的请求头，没有缓存时返回空字典
+    @staticmethod
+    def conditional_headers(entry: dict | None) -> dict:
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+
+    # 只缓存带有 ETag 或 Last-Modified 的成功应答
+    def put(self, url: str, response: httpx.Response):
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        if response.status_code != 200 or not (etag or last_modified):
+            return
+        path = self._entry_path(url)
+        entry = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "headers": {name: response.headers[name] for name in self.kept_headers if name in response.headers},
+            "body": response.text,
+            "created": time.time()
+        }
+        try:
+            common_function.write_json_atomic(path, entry)
+        except OSError as e:
+            logger.warning(f"Write github response cache entry failed:{path}, error:{e}")
+
+
+    # 304 时由缓存条目重建完整的应答
+    def to_response(self, entry: dict, request: httpx.Request) -> httpx.Response:
+        self.hits += 1
+        return httpx.Response(200, headers=entry["headers"], content=entry["body"].encode("utf-8"), request=request)
@@ -0,0 +1,101 @@
+import json
+import os
+import re
+import time
+import common_function
+from ai_code_reviewer_logger import logger
+from local_diff import LocalGitDiff
+
+
+class ReviewState:
+    """
+    每个 PR 上一次完成审查的 head SHA，以 JSON 文件保存在本地
+    GitHub Actions 中与 review 缓存一起通过 actions/cache 保留，常驻服务模式下保存在服务的工作目录中
+    """
+
+    def __init__(self, state_dir: str):
+        self.state_dir = state_dir
+
+
+    def _state_path(self, owner: str, repo: str, pull_request_id: int) -> str:
+        return os.path.join(self.state_dir, owner, repo, f"{pull_request_id}.json")
+
+
+    def load(self, owner: str, repo: str, pull_request_id: int) -> str | None:
+        path = self._state_path(owner, repo, pull_request_id)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f).get("reviewed_sha")
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Read review state failed:{path}, error:{e}")
+            return None
+
+
+    def save(self, owner: str, repo: str, pull_request_id: int, reviewed_sha: str):
+        path = self._state_path(owner, repo, pull_request_id)
+        try:
+            common_function.write_json_atomic(path, {"reviewed_sha": reviewed_sha, "updated": time.time()})
+            logger.info(f"Save review state success, pull request:{pull_request_id}, sha:{reviewed_sha}")
+        except OSError as e:
+            logger.warning(f"Write review state failed:{path}, error:{e}")
+
+
+class IncrementalDiff:
+    """
+    上一次审查的 head 与当前 head 之间的变更，按文件保存 --unified=0 的 hunk
+    hunk 为 (旧文件起始行, 旧文件行数, 新文件起始行, 新文件行数)，不在 hunks 中的文件在两次 head 之间没有改动
+    """
+
+    hunk_header_re = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+    def __init__(self, repository_path: str, old_sha: str, new_sha: str):
+        for name, sha in (("old", old_sha), ("new", new_sha)):
+            # 防止把参数当作 git 选项解析
+            if not sha or sha.startswith("-"):
+                raise ValueError(f"Invalid incremental diff {name} sha:{sha}")
+        self.repository_path = repository_path
+        self.old_sha = old_sha
+        self.new_sha = new_sha
+        # 文件名 -> [hunk, ...]
+        self.hunks = {}
+
+
+    async def git(self, *args) -> bytes:
+        return await common_function.run_git("-C", self.repository_path, *args)
+
+
+    # 浅克隆中可能缺少上一次审查的提交，按 SHA 单独拉取
+    async def ensure_commit(self, sha: str):
+        try:
+            await self.git("cat-file", "-e", f"{sha}^{{commit}}")
+        except RuntimeError:
+            logger.info(f"Commit not found locally, fetch:{sha}")
+            await self.git("fetch", "--quiet", "--depth=1", "--no-tags", "origin", sha)
+
+
+    async def load(self):
+        for sha in (self.old_sha, self.new_sha):
+            await self.ensure_commit(sha)
+        # 重命名视为删除加新增，新路径下的函数全部视为改动
+        output = await self.git("-c", "core.quotePath=false", "diff", "--unified=0", "--no-color",
+                                "--no-ext-diff", "--no-renames", "--diff-filter=d",
+                                self.old_sha, self.new_sha, "--")
+        file_name = None
+        for line in output.decode("utf-8", errors="replace").splitlines():
+            if line.startswith("diff --git "):
+                file_name = None
+            elif line.startswith("+++ ") and file_name is None:
+                file_name = LocalGitDiff.parse_file_name(line[len("+++ "):])
+                self.hunks[file_name] = []
+            elif line.startswith("@@") and file_name is not None:
+                if match := self.hunk_header_re.match(line):
+                    old_start, old_count, new_start, new_count = match.groups()
+                    self.hunks[file_name].append((
+                        int(old_start), 1 if old_count is None else int(old_count),
+                        int(new_start), 1 if new_count is None else int(new_count)
+                    ))
+                else:
+                    logger.error(f"Hunk header analyze failed:{line}")
+        logger.info(f"Load incremental diff success, range:{self.old_sha}..{self.new_sha}, files:{len(self.hunks)}")
@@ -0,0 +1,173 @@
+import importlib
+import importlib.util
+import os
+import threading
+from dataclasses import dataclass
+from tree_sitter import Language
+from ai_code_reviewer_logger import logger
+
+
+@dataclass(frozen=True)
+class LanguageSpec:
+    # 语言名，同时用作解析器和查询的缓存 key
+    name: str
+    # 文件后缀（包含点号，区分大小写）
+    extensions: tuple
+    # tree-sitter 语法所在的模块，第一次遇到该语言的文件时才导入
+    grammar_module: str
+    # 各语言中视为一个审查单元的函数节点（包括类方法、构造函数和 lambda）
+    function_query: str
+    # 模块中返回语法指针的函数名
+    grammar_function: str = "language"
+    # 文件上下文：@import 节点原样保留（导入、类型定义、函数声明），@declaration 节点只保留函数体之前的签名部分
+    context_query: str = ""
+
+
+TYPESCRIPT_FUNCTION_QUERY = """
+    (function_declaration) @function
+    (generator_function_declaration) @function
+    (method_definition) @function
+    (function_expression) @function
+    (arrow_function) @function
+"""
+
+TYPESCRIPT_CONTEXT_QUERY = """
+    (import_statement) @import
+    (type_alias_declaration) @import
+    (class_declaration) @declaration
+    (abstract_class_declaration) @declaration
+    (interface_declaration) @declaration
+    (function_declaration) @declaration
+    (method_definition) @declaration
+"""
+
+# 内置支持的语言，新增语言只需在此声明并在 requirements.txt 中加入对应的语法包
+BUILTIN_LANGUAGES = (
+    LanguageSpec("cpp", (".cpp", ".hpp", ".h", ".tpp", ".cxx"), "tree_sitter_cpp",
+                 "(function_definition) @function (lambda_expression) @function",
+                 context_query="""
+                     (preproc_include) @import
+                     (using_declaration) @import
+                     (alias_declaration) @import
+                     (declaration declarator: (function_declarator)) @import
+                     (field_declaration declarator: (function_declarator)) @import
+                     (namespace_definition) @declaration
+                     (class_specifier) @declaration
+                     (struct_specifier) @declaration
+                     (function_definition) @declaration
+                 """),
+    LanguageSpec("python", (".py",), "tree_sitter_python", "(function_definition) @function",
+                 context_query="""
+                     (import_statement) @import
+                     (import_from_statement) @import
+                     (class_definition) @declaration
+                     (function_definition) @declaration
+                 """),
+    LanguageSpec("java", (".java",), "tree_sitter_java", """
+        (method_declaration) @function
+        (constructor_declaration) @function
+        (compact_constructor_declaration) @function
+        (lambda_expression) @function
+    """, context_query="""
+        (package_declaration) @import
+        (import_declaration) @import
+        (class_declaration) @declaration
+        (interface_declaration) @declaration
+        (enum_declaration) @declaration
+        (record_declaration) @declaration
+        (method_declaration) @declaration
+        (constructor_declaration) @declaration
+    """),
+    LanguageSpec("go", (".go",), "tree_sitter_go",
+                 "(function_declaration) @function (method_declaration) @function (func_literal) @function",
+                 context_query="""
+                     (package_clause) @import
+                     (import_declaration) @import
+                     (type_declaration) @import
+                     (function_declaration) @declaration
+                     (method_declaration) @declaration
+                 """),
+    LanguageSpec("rust", (".rs",), "tree_sitter_rust", "(function_item) @function (closure_expression) @function",
+                 context_query="""
+                     (use_declaration) @import
+                     (function_signature_item) @import
+                     (struct_item) @declaration
+                     (enum_item) @declaration
+                     (trait_item) @declaration
+                     (impl_item) @declaration
+                     (mod_item) @declaration
+                     (function_item) @declaration
+                 """),
+    LanguageSpec("typescript", (".ts", ".mts", ".cts"), "tree_sitter_typescript", TYPESCRIPT_FUNCTION_QUERY,
+                 "language_typescript", TYPESCRIPT_CONTEXT_QUERY),
+    LanguageSpec("tsx", (".tsx",), "tree_sitter_typescript", TYPESCRIPT_FUNCTION_QUERY,
+                 "language_tsx", TYPESCRIPT_CONTEXT_QUERY),
+)
+
+
+class LanguageRegistry:
+    """
+    文件后缀到语言的映射，以及按需加载的 tree-sitter 语法
+    判断文件是否支持只需一次字典查找，语法模块在第一次解析该语言的文件时才导入，
+    只包含 Python 文件的 PR 不会加载其他语言的语法
+    """
+
+    def __init__(self, specs=()):
+        # 语言名 -> LanguageSpec
+        self.languages = {}
+        # 文件后缀 -> LanguageSpec
+        self.by_suffix = {}
+        # 语言名 -> 已加载的 Language
+        self._loaded = {}
+        # 语法模块名 -> 是否已安装
+        self._installed = {}
+        self.lock = threading.Lock()
+        for spec in specs:
+            self.register(spec)
+
+
+    def register(self, spec: LanguageSpec):
+        self.languages[spec.name] = spec
+        for extension in spec.extensions:
+            self.by_suffix[extension] = spec
+
+
+    # 根据文件后缀返回对应的语言，不支持或未安装语法的文件返回 None
+    def spec_for(self, file_name: str) -> LanguageSpec | None:
+        spec = self.by_suffix.get(os.path.splitext(file_name)[1])
+        if spec is None or not self.is_installed(spec):
+            return None
+        return spec
+
+
+    # 只查找模块而不导入，未安装的语法包对应的文件直接跳过
+    def is_installed(self, spec: LanguageSpec) -> bool:
+        installed = self._installed.get(spec.grammar_module)
+        if installed is None:
+            installed = importlib.util.find_spec(spec.grammar_module) is not None
+            self._installed[spec.grammar_module] = installed
+            if not installed:
+                logger.warning(f"Grammar module not installed, skip {spec.name} files:{spec.grammar_module}")
+        return installed
+
+
+    # 懒加载语法，多线程安全
+    def language(self, spec: LanguageSpec) -> Language:
+        try:
+            with self.lock:
+                if spec.name not in self._loaded:
+                    module = importlib.import_module(spec.grammar_module)
+                    self._loaded[spec.name] = Language(getattr(module, spec.grammar_function)())
+                    logger.info(f"Load grammar success:{spec.name}")
+        except Exception as e:
+            raise RuntimeError(f"Failed to load {spec.name} grammar:{e}") from e
+        return self._loaded[spec.name]
+
+
+    # 已安装语法的全部语言，用于预热
+    def installed_specs(self) -> list:
+        return [spec for spec in self.languages.values() if self.is_installed(spec)]
+
+
+# 全局语言注册表，与 metrics 一样在各模块中直接导入使用
+registry = LanguageRegistry(BUILTIN_LANGUAGES)
@@ -0,0 +1,50 @@
+# 变更行以有序、合并后的闭区间 [(起始行, 结束行), ...] 表示，避免逐行保存和拼接列表
+
+
+def to_ranges(lines) -> list:
+    # 全仓库扫描时整个文件都是变更行，以 range 传入，不逐行展开
+    if isinstance(lines, range) and lines.step == 1:
+        return [(lines.start, lines.stop - 1)] if lines else []
+    ranges = []
+    for line in sorted(set(lines)):
+        if ranges and line == ranges[-1][1] + 1:
+            ranges[-1][1] = line
+        else:
+            ranges.append([line, line])
+    return [tuple(r) for r in ranges]
+
+
+# 一次双指针扫描，将变更区间分配给各个函数
+# functions 为按起始行排序且互不嵌套的 (起始行, 结束行, 附带数据)
+# 返回 [(附带数据, 与该函数相交并裁剪后的区间列表), ...]，不包含没有变更的函数
+def assign_ranges(functions, ranges) -> list:
+    result = []
+    first = 0
+    for start, end, item in functions:
+        # 跳过完全位于当前函数之前的区间，后续函数的起始行只会更大
+        while first < len(ranges) and ranges[first][1] < start:
+            first += 1
+        overlaps = []
+        index = first
+        while index < len(ranges) and ranges[index][0] <= end:
+            overlaps.append((max(start, ranges[index][0]), min(end, ranges[index][1])))
+            index += 1
+        if overlaps:
+            result.append((item, overlaps))
+    return result
+
+
+def expand_ranges(ranges) -> list:
+    return [line for start, end in ranges for line in range(start, end + 1)]
+
+
+# 每一行在源码中的起始字节偏移，末尾追加源码长度，第 n 行（从 1 开始）的起点为 offsets[n - 1]
+def line_start_offsets(source) -> list:
+    offsets = [0]
+    position = source.find(b"\n")
+    while position != -1:
+        offsets.append(position + 1)
+        position = source.find(b"\n", position + 1)
+    if offsets[-1] != len(source):
+        offsets.append(len(source))
+    return offsets
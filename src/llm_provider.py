@@ -0,0 +1,351 @@
+import asyncio
+import collections
+import httpx
+import json
+import os
+import re
+import time
+import common_function
+from ai_code_reviewer_logger import logger
+from httpx import AsyncClient
+from resilience import ResilientExecutor
+from run_metrics import metrics
+from token_budget import estimate_tokens
+
+
+class LLMProvider:
+    """
+    单个 OpenAI 兼容的 chat completions 接口（地址 + 模型）
+    每个接口拥有独立的连接池、重试 / 熔断 / 并发控制，并记录最近的请求耗时用于计算对冲请求的触发时间
+    """
+
+    # 用于计算耗时分位数的最近样本数
+    latency_window = 200
+
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        key: str,
+        model: str,
+        stream: bool,
+        max_output_tokens: int,
+        max_wall_time: float,
+        stop_marker: str,
+        on_timing
+    ):
+        # 参数校验
+        common_function.parameter_check(url, "url")
+        common_function.parameter_check(key, "api key")
+        common_function.parameter_check(model, "model")
+
+        self.name = name
+        # 安全赋值
+        self.api_url = url.strip()
+        # 私有变量保护敏感数据
+        self._api_key = key.strip()
+        self.model = model
+
+        # 这个超时时间给的比较长是因为LLM的应答速度可能较慢
+        try:
+            self.client = AsyncClient(trust_env=False, proxy=None, timeout=1000)
+        except Exception as e:
+            logger.exception(f"Init async client error:{e}")
+            raise RuntimeError("Init async client error") from e
+
+        # 流式模式及单个函数的输出 token / 耗时预算
+        self.stream = stream
+        self.max_output_tokens = max_output_tokens
+        self.max_wall_time = max_wall_time
+        # 流式模式下读到该标记即可提前结束
+        self.stop_marker = stop_marker
+        # 记录每次请求的首 token 耗时和总耗时的回调
+        self.on_timing = on_timing
+
+        # 最近成功请求的总耗时
+        self.latencies = collections.deque(maxlen=self.latency_window)
+
+        # 重试、熔断和自适应并发控制，并发上限不超过 LLM_CONCURRENCY
+        self.executor = ResilientExecutor.from_env(name, 4, int(os.environ.get("LLM_CONCURRENCY", "8")))
+
+        logger.info(f"Init llm provider success, name:{name}, model:{model}")
+
+
+    @property
+    def api_key(self):
+        # 对api key进行隐藏
+        if self._api_key and len(self._api_key) > 10:
+            return f"****{self._api_key[-4:]}"
+        return None
+
+
+    async def close(self):
+        # 释放api key，防止其在内存中驻留
+        self._api_key = None  # 主动清除敏感数据
+        await self.client.aclose() # 主动释放链接
+
+
+    # 最近请求耗时的分位数，样本不足时返回 None
+    def latency_quantile(self, quantile: float, min_samples: int) -> float | None:
+        if len(self.latencies) < max(1, min_samples):
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+    async def call(self, messages: list) -> dict:
+        headers = {
+            "Authorization": f"Bearer {self._api_key}",
+            "Content-Type": "application/json"
+        }
+
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": self.max_output_tokens
+        }
+
+        if self.stream:
+            payload["stream"] = True
+            payload["stream_options"] = {"include_usage": True}
+            request = lambda: self.call_stream_async(payload, headers)
+        else:
+            request = lambda: self.call_once_async(payload, headers)
+        start_time = time.monotonic()
+        response = await self.executor.call(self.api_url, request)
+        self.latencies.append(time.monotonic() - start_time)
+        return response
+
+
+    async def call_once_async(self, payload: dict, headers: dict) -> dict:
+        response = None
+        start_time = time.monotonic()
+        try:
+            response = await self.client.post(
+                self.api_url,
+                json=payload,
+                headers=headers)
+
+            response.raise_for_status()  # 自动触发HTTPError
+            response_json = response.json()     # FIXME:相应体较大未考虑
+            elapsed = time.monotonic() - start_time
+            # 非流式接口因 max_tokens 截断时 finish_reason 为 length
+            choices = response_json.get("choices") or [{}]
+            truncated = choices[0].get("finish_reason") == "length"
+            response_json["truncated"] = truncated
+            self.on_timing(self.name, elapsed, elapsed, response_json.get("usage"), truncated)
+            return response_json
+
+        except httpx.HTTPStatusError as e:
+            logger.exception(f"HTTP error:{e}")
+            raise
+        except httpx.RequestError as e:
+            logger.exception(f"Network error:{e}")
+            raise
+        except json.JSONDecodeError as e:
+            logger.exception(f"Invalid JSON response:{e}")
+            raise
+        except Exception as e:
+            logger.exception(f"Unknown Error:{e}")
+            raise
+        finally:
+            if response:
+                self.record_transfer(response, len(response.content))
+                await response.aclose()
+
+
+    # 以 SSE 方式增量读取应答，超出 token 或耗时预算、或模型表示没有建议时提前结束
+    # 返回与非流式接口相同结构的 dict
+    async def call_stream_async(self, payload: dict, headers: dict) -> dict:
+        content = []
+        usage = None
+        response = None
+        output_tokens = 0
+        # 尚未确定是否以 stop_marker 开头的正文前缀，确定后置为 None
+        leading = ""
+        first_token_time = None
+        truncated = False
+        start_time = time.monotonic()
+
+        try:
+            async with asyncio.timeout(self.max_wall_time):
+                async with self.client.stream("POST", self.api_url, json=payload, headers=headers) as response:
+                    response.raise_for_status()  # 自动触发HTTPError
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            break
+
+                        chunk = json.loads(data)
+                        usage = chunk.get("usage") or usage
+                        if not chunk.get("choices"):
+                            continue
+
+                        delta = chunk["choices"][0].get("delta") or {}
+                        # 推理模型会先输出 reasoning_content，同样计入输出预算
+                        piece = delta.get("content") or ""
+                        reasoning = delta.get("reasoning_content") or ""
+                        if piece or reasoning:
+                            # 一个 chunk 可能包含多个 token，按文本估算；服务端返回了用量时以用量为准
+                            output_tokens += estimate_tokens(piece) + estimate_tokens(reasoning)
+                            if first_token_time is None:
+                                first_token_time = time.monotonic() - start_time
+                        if usage and usage.get("completion_tokens"):
+                            output_tokens = max(output_tokens, usage["completion_tokens"])
+                        if piece:
+                            content.append(piece)
+                            # 只检查一次正文开头，读够标记长度后不再拼接
+                            if leading is not None:
+                                leading = (leading + piece).lstrip()
+                                if len(leading) >= len(self.stop_marker):
+                                    if leading.startswith(self.stop_marker):
+                                        logger.info("AI model has no suggestions, stop streaming early")
+                                        break
+                                    leading = None
+
+                        # 服务端按 max_tokens 截断时最后一个 chunk 的 finish_reason 为 length
+                        if chunk["choices"][0].get("finish_reason") == "length":
+                            truncated = True
+                            logger.warning("AI model output truncated by max_tokens")
+
+                        if output_tokens >= self.max_output_tokens:
+                            truncated = True
+                            logger.warning(f"Output token budget exceeded:{self.max_output_tokens}")
+                            break
+
+        except TimeoutError:
+            truncated = True
+            logger.warning(f"Wall time budget exceeded:{self.max_wall_time}s")
+        except httpx.HTTPStatusError as e:
+            logger.exception(f"HTTP error:{e}")
+            raise
+        except httpx.RequestError as e:
+            logger.exception(f"Network error:{e}")
+            raise
+        except json.JSONDecodeError as e:
+            logger.exception(f"Invalid JSON response:{e}")
+            raise
+        except Exception as e:
+            logger.exception(f"Unknown Error:{e}")
+            raise
+        finally:
+            if response is not None:
+                self.record_transfer(response, response.num_bytes_downloaded)
+
+        total_time = time.monotonic() - start_time
+        # 提前结束读取时服务端不会返回用量，按请求和已收到的输出估算，避免预算结算和汇总漏计
+        if usage is None:
+            usage = {"prompt_tokens": sum(estimate_tokens(message.get("content") or "")
+                                          for message in payload["messages"]),
+                     "completion_tokens": output_tokens}
+        self.on_timing(self.name, first_token_time, total_time, usage, truncated)
+
+        # 被截断且还没有输出正文时视为失败；已有正文时带上 truncated 标记，由调用方决定如何处理
+        if truncated and not content:
+            return {}
+        return {"choices": [{"message": {"content": "".join(content)}}], "usage": usage, "truncated": truncated}
+
+
+    @staticmethod
+    def record_transfer(response: httpx.Response, bytes_received: int):
+        metrics.add("llm_attempts")
+        metrics.add("llm_bytes_sent", len(response.request.content))
+        metrics.add("llm_bytes_received", bytes_received)
+
+
+class LLMRouter:
+    """
+    按函数规模和复杂度选择模型，并可选地对慢请求发起对冲请求
+    小而简单的改动交给 small 对应的快速模型，其余交给 default；涉及并发、锁等关键字的函数始终使用 default
+    开启对冲时，请求耗时超过主接口最近耗时的分位数（默认 p95）后向备用接口再发一次，取先返回的结果并取消另一个
+    """
+
+    # 分支和逻辑运算，粗略估算圈复杂度
+    branch_re = re.compile(r"\b(if|elif|for|while|case|catch|except|switch)\b|&&|\|\||\?")
+    # 并发相关的关键字，这类函数即使很短也交给默认模型
+    concurrency_re = re.compile(r"\b(mutex|lock|unlock|atomic|thread|threading|async|await|synchronized|"
+                                r"volatile|condition_variable|future|promise|semaphore)\b", re.IGNORECASE)
+
+    def __init__(self, providers: dict, routing: dict = None, hedging: dict = None):
+        if not providers:
+            raise ValueError("At least one llm provider is required")
+        routing = routing or {}
+        hedging = hedging or {}
+        self.providers = providers
+        self.default = providers[routing.get("default", next(iter(providers)))]
+        self.small = providers[routing["small"]] if routing.get("small") else None
+        self.small_function_tokens = int(routing.get("small_function_tokens", 300))
+        self.max_complexity = int(routing.get("max_complexity", 4))
+
+        # 对冲请求：主接口名 -> 备用接口名
+        self.hedge_enabled = bool(hedging.get("enabled", False))
+        self.hedge_to = {name: providers[target] for name, target in (hedging.get("hedge_to") or {}).items()}
+        self.hedge_quantile = float(hedging.get("quantile", 0.95))
+        self.hedge_min_samples = int(hedging.get("min_samples", 20))
+        # 样本不足时使用的触发时间（秒）
+        self.hedge_initial_deadline = float(hedging.get("initial_deadline", 60))
+
+
+    def complexity(self, text: str) -> int:
+        return len(self.branch_re.findall(text))
+
+
+    def route(self, text: str) -> LLMProvider:
+        if self.small is None:
+            return self.default
+        if (estimate_tokens(text) <= self.small_function_tokens
+                and self.complexity(text) <= self.max_complexity
+                and not self.concurrency_re.search(text)):
+            return self.small
+        return self.default
+
+
+    # 批量请求中只要有一个函数需要默认模型，整批都使用默认模型
+    def route_all(self, texts) -> LLMProvider:
+        providers = {self.route(text) for text in texts}
+        return self.small if providers == {self.small} else self.default
+
+
+    def hedge_deadline(self, provider: LLMProvider) -> float:
+        deadline = provider.latency_quantile(self.hedge_quantile, self.hedge_min_samples)
+        return deadline if deadline is not None else self.hedge_initial_deadline
+
+
+    async def call(self, provider: LLMProvider, messages: list) -> dict:
+        metrics.add(f"llm_route_{provider.name}")
+        backup = self.hedge_to.get(provider.name) if self.hedge_enabled else None
+        if backup is None or backup is provider:
+            return await provider.call(messages)
+
+        primary = asyncio.create_task(provider.call(messages))
+        hedged = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.hedge_deadline(provider))
+            if done:
+                return primary.result()
+
+            metrics.add("llm_hedges")
+            logger.info(f"LLM request exceeds hedge deadline, send hedged request:{provider.name} -> {backup.name}")
+            hedged = asyncio.create_task(backup.call(messages))
+            pending = {primary, hedged}
+            error = None
+            # 取先成功返回的结果；一方失败时继续等待另一方
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedged:
+                            metrics.add("llm_hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in (primary, hedged):
+                if task is not None and not task.done():
+                    task.cancel()
+
+
+    async def close(self):
+        await asyncio.gather(*(provider.close() for provider in self.providers.values()))
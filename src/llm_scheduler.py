@@ -0,0 +1,63 @@
+import asyncio
+import time
+from ai_code_reviewer_logger import logger
+from run_metrics import metrics
+
+
+class RateLimiter:
+    """
+    令牌桶限流，limit_per_minute 为每分钟允许消耗的配额，0 表示不限流
+    """
+
+    def __init__(self, limit_per_minute: int):
+        self.capacity = limit_per_minute
+        self.rate = limit_per_minute / 60
+        self.available = float(limit_per_minute)
+        self.updated_at = time.monotonic()
+        # 保证等待者按先来后到获取配额
+        self.lock = asyncio.Lock()
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+
+    async def acquire(self, amount: int = 1):
+        if self.capacity <= 0:
+            return
+        # 单次请求超过桶容量时按桶容量计算，避免永远等待
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.available < amount:
+                await asyncio.sleep((amount - self.available) / self.rate)
+                self._refill()
+            self.available -= amount
+
+
+class LLMScheduler:
+    """
+    大模型调用的独立工作池，与文件解析的并发度解耦
+    concurrency 控制同时在途的请求数，requests_per_minute / tokens_per_minute 控制速率
+    """
+
+    def __init__(self, concurrency: int, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        if concurrency <= 0:
+            raise ValueError("LLM concurrency must be greater than 0")
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.request_limiter = RateLimiter(requests_per_minute)
+        self.token_limiter = RateLimiter(tokens_per_minute)
+        logger.info(f"Init llm scheduler success, concurrency:{concurrency}, "
+                    f"rpm:{requests_per_minute}, tpm:{tokens_per_minute}")
+
+
+    async def run(self, call, estimated_tokens: int = 0):
+        # call 为发起大模型请求的协程函数
+        start_time = time.monotonic()
+        async with self.semaphore:
+            await self.request_limiter.acquire(1)
+            await self.token_limiter.acquire(estimated_tokens)
+            metrics.observe("llm_queue_wait", time.monotonic() - start_time)
+            return await call()
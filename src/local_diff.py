@@ -0,0 +1,101 @@
+import asyncio
+import codecs
+import os
+import re
+from ai_code_reviewer_logger import logger
+from github_assistant import DiffFileStruct
+
+
+class LocalGitDiff:
+    """
+    直接在本地检出的仓库中执行 git diff 计算变更行，不调用 GitHub files 接口
+    不受接口 3000 个文件的上限限制，也不会因为 GitHub 省略大文件的 patch 而漏掉变更
+    base 与 head 按 base...head 比较，即 head 相对于两者合并基点的变更，与 PR 的 diff 一致
+    """
+
+    # --unified=0 时 hunk 头中的新文件行号和行数，行数省略时为 1，为 0 时表示只删除了行
+    hunk_header_re = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+    # 单行输出的读取上限，diff 中个别超长的代码行不会导致读取失败
+    stream_limit = 16 * 1024 * 1024
+
+    def __init__(self, repository_path: str, base: str, head: str = "HEAD"):
+        for name, ref in (("base", base), ("head", head)):
+            if not (isinstance(ref, str) and ref.strip()):
+                raise ValueError(f"Local diff {name} must be a non-empty string")
+            # 防止把参数当作 git 选项解析
+            if ref.startswith("-"):
+                raise ValueError(f"Invalid local diff {name}:{ref}")
+        self.repository_path = repository_path
+        self.base = base.strip()
+        self.head = head.strip()
+        logger.info(f"Init local git diff success, range:{self.base}...{self.head}")
+
+
+    # 以流式方式读取 git diff 的输出，每解析完一个文件就立即返回
+    async def iter_diff_file_structs(self):
+        logger.info(f"Start get local change files, range:{self.base}...{self.head}")
+        process = await asyncio.create_subprocess_exec(
+            "git", "-C", self.repository_path,
+            "-c", "core.quotePath=false",
+            "diff", "--unified=0", "--no-color", "--no-ext-diff", "--diff-filter=d",
+            f"{self.base}...{self.head}", "--",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=self.stream_limit
+        )
+
+        file_name = None
+        positions = []
+        count = 0
+        try:
+            async for raw_line in process.stdout:
+                line = raw_line.decode("utf-8", errors="replace").rstrip("\n")
+                if line.startswith("diff --git "):
+                    if file_name is not None:
+                        count += 1
+                        yield self.make_diff_file_struct(file_name, positions)
+                    file_name, positions = None, []
+                elif line.startswith("+++ ") and file_name is None:
+                    file_name = self.parse_file_name(line[len("+++ "):])
+                elif line.startswith("@@") and file_name is not None:
+                    positions.extend(self.parse_hunk_header(line))
+            if file_name is not None:
+                count += 1
+                yield self.make_diff_file_struct(file_name, positions)
+        finally:
+            # 调用方提前结束迭代时终止 git 进程
+            if not process.stdout.at_eof():
+                process.kill()
+            stderr = await process.stderr.read()
+            return_code = await process.wait()
+
+        if return_code != 0:
+            raise RuntimeError(f"git diff failed, return code:{return_code}, "
+                               f"error:{stderr.decode('utf-8', errors='replace').strip()}")
+        logger.info(f"Get local change files success, count:{count}")
+
+
+    def make_diff_file_struct(self, file_name: str, positions: list) -> DiffFileStruct:
+        return DiffFileStruct(file_name, os.path.join(self.repository_path, file_name), positions)
+
+
+    # 去掉 git 添加的 b/ 前缀，包含控制字符、引号或反斜杠的路径会被 git 加上引号并以 C 风格转义
+    # 包含空格的路径末尾会被 git 追加一个制表符
+    @staticmethod
+    def parse_file_name(path: str) -> str:
+        path = path.rstrip("\t")
+        if path.startswith('"') and path.endswith('"'):
+            path = codecs.escape_decode(path[1:-1].encode("utf-8"))[0].decode("utf-8", errors="replace")
+        return path[2:] if path.startswith("b/") else path
+
+
+    @classmethod
+    def parse_hunk_header(cls, line: str) -> list:
+        match = cls.hunk_header_re.match(line)
+        if not match:
+            logger.error(f"Hunk header analyze failed:{line}")
+            return []
+        start = int(match.group(1))
+        length = int(match.group(2)) if match.group(2) is not None else 1
+        return list(range(start, start + length))
@@ -0,0 +1,169 @@
+import asyncio
+import os
+import time
+from ai_code_reviewer_logger import logger
+from local_diff import LocalGitDiff
+from repository_scan import RepositoryScan, write_stats
+from repository_workspace import RepositoryWorkspace, ReviewJob
+from review_output import ReviewOutput
+from run_metrics import metrics
+from run_summary import RunSummary
+from shared_resources import SharedResources
+
+
+class OfflineReview:
+    """
+    离线回填：对本地仓库的提交范围或一组历史 PR 运行完整的解析和审查流程，结果写入 JSONL / SARIF 文件，不调用任何 GitHub 写接口
+    各审查对象共用大模型连接池、解析器和缓存，并发执行，单个对象的尾部等待不会让大模型请求空闲
+    PR 通过 GitHub 读取 base / head 提交，在 SERVER_WORKSPACE_DIR 中创建临时工作树，与常驻服务共用同一套本地副本
+    """
+
+    # analyzer_class 为 CppCodeAnalyzer，由入口模块传入
+    def __init__(self, analyzer_class, review_output: ReviewOutput, concurrency: int):
+        if concurrency <= 0:
+            raise ValueError("Offline review concurrency must be greater than 0")
+        self.analyzer_class = analyzer_class
+        self.review_output = review_output
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.summary = RunSummary()
+        # 各审查对象的大模型请求记录，结束时统一汇总
+        self.request_timings = []
+        self.shared = None
+        self.repository_owner = os.environ.get("REPOSITORY_OWNER")
+        self.repository_name = os.environ.get("REPOSITORY_NAME")
+        self.workspace = RepositoryWorkspace(
+            os.environ.get("SERVER_WORKSPACE_DIR", "./.workspace"),
+            os.environ.get("GITHUB_TOKEN"),
+            os.environ.get("SERVER_CLONE_URL_TEMPLATE", "https://github.com/{owner}/{repo}.git")
+        )
+
+
+    # ranges 为 [(base, head), ...]，按 base...head 计算变更；pull_request_ids 为历史 PR 编号；scan 为全仓库扫描
+    async def run(self, repository_path: str, ranges: list, pull_request_ids: list,
+                  scan: RepositoryScan | None = None):
+        self.shared = SharedResources.from_env()
+        ai_module = self.shared.ai_module
+        review_cache = self.shared.review_cache
+        cache_hits_start, cache_misses_start = review_cache.hits, review_cache.misses
+        self.review_output.open()
+        try:
+            tasks = [self.review_target(f"{base}...{head}", self.review_range, repository_path, base, head)
+                     for base, head in ranges]
+            tasks += [self.review_target(f"pr/{pull_request_id}", self.review_pull_request, pull_request_id)
+                      for pull_request_id in pull_request_ids]
+            if scan is not None:
+                tasks.append(self.review_target(f"scan/{scan.shard_index}/{scan.shard_count}", self.review_scan, scan))
+            await asyncio.gather(*tasks)
+        finally:
+            self.review_output.close()
+            self.summary.add_llm_usage(self.request_timings, ai_module.cached_prompt_tokens,
+                                       float(os.environ.get("LLM_PRICE_PER_1K_TOKENS", "0")))
+            self.summary.counters["cache_hits"] = review_cache.hits - cache_hits_start
+            self.summary.counters["cache_misses"] = review_cache.misses - cache_misses_start
+            self.summary.report()
+            await self.shared.close()
+
+
+    # 单个审查对象失败时记录并继续处理其他对象
+    async def review_target(self, source: str, review, *args):
+        async with self.semaphore:
+            try:
+                logger.info(f"Start offline review:{source}")
+                await review(*args)
+                self.summary.add("targets_reviewed")
+            except Exception as e:
+                self.summary.add("targets_failed")
+                logger.exception(f"Offline review failed:{source}, error:{e}")
+
+
+    async def review_range(self, repository_path: str, base: str, head: str):
+        analyzer = self.analyzer_class(0, self.repository_owner, self.repository_name, self.shared,
+                                         self.review_output, f"{base}...{head}")
+        try:
+            analyzer.repository_path = repository_path
+            analyzer.local_diff = LocalGitDiff(repository_path, base, head)
+            await analyzer.run_offline()
+        finally:
+            self.summary.merge(analyzer.summary)
+            self.request_timings.extend(analyzer.request_timings)
+            await analyzer.close()
+
+
+    async def review_scan(self, scan: RepositoryScan):
+        # 记录来源使用提交而不是分片编号，调整分片数后各分片已有的结果仍可合并去重
+        commit_sha = await scan.commit_sha()
+        source = f"scan/{commit_sha}" if commit_sha else "scan"
+        analyzer = self.analyzer_class(0, self.repository_owner, self.repository_name, self.shared,
+                                         self.review_output, source)
+        try:
+            analyzer.repository_path = scan.repository_path
+            # RepositoryScan 与 LocalGitDiff 一样提供 iter_diff_file_structs
+            analyzer.local_diff = scan
+            await analyzer.run_offline()
+        finally:
+            self.summary.merge(analyzer.summary)
+            self.request_timings.extend(analyzer.request_timings)
+            await analyzer.close()
+
+
+    async def review_pull_request(self, pull_request_id: int):
+        analyzer = self.analyzer_class(pull_request_id, self.repository_owner, self.repository_name, self.shared,
+                                         self.review_output, f"pr/{pull_request_id}")
+        worktree = None
+        job = None
+        try:
+            # 只读取 PR 信息，不提交评论
+            pull_request = await analyzer.github_assistant.get_pull_request()
+            job = ReviewJob(self.repository_owner, self.repository_name, pull_request_id,
+                            pull_request["head"]["sha"], pull_request["base"]["sha"])
+            worktree = await self.workspace.checkout(job)
+            analyzer.repository_path = worktree
+            analyzer.local_diff = LocalGitDiff(worktree, job.base_sha, job.head_sha)
+            await analyzer.run_offline()
+        finally:
+            self.summary.merge(analyzer.summary)
+            self.request_timings.extend(analyzer.request_timings)
+            await analyzer.close()
+            if worktree is not None:
+                await self.workspace.remove_worktree(job, worktree)
+
+
+# 解析以逗号、空白或换行分隔的 PR 编号，# 开头的行为注释
+def parse_pull_request_ids(text: str) -> list:
+    pull_request_ids = []
+    for line in text.splitlines():
+        line = line.split("#", 1)[0]
+        for item in line.replace(",", " ").split():
+            pull_request_id = int(item)
+            if pull_request_id <= 0:
+                raise ValueError(f"Pull request id must be greater than 0:{item}")
+            pull_request_ids.append(pull_request_id)
+    return pull_request_ids
+
+
+# 解析 base...head 形式的提交范围
+def parse_range(text: str) -> tuple[str, str]:
+    base, separator, head = text.partition("...")
+    if not separator or not base.strip() or not head.strip():
+        raise ValueError(f"Range must be in the form base...head:{text}")
+    return base.strip(), head.strip()
+
+
+async def async_main_offline(analyzer_class, output: str, output_format: str, repository_path: str,
+                             ranges: list, pull_request_ids: list, concurrency: int,
+                             shard: tuple[int, int] | None = None):
+    if pull_request_ids:
+        missing_vars = [var for var in ("GITHUB_TOKEN", "REPOSITORY_OWNER", "REPOSITORY_NAME")
+                        if not os.environ.get(var)]
+        if missing_vars:
+            raise RuntimeError(f":Missing environment variables: {', '.join(missing_vars)}")
+    offline_review = OfflineReview(analyzer_class, ReviewOutput(output, output_format), concurrency)
+    # shard 不为 None 时为全仓库扫描，只审查属于该分片的文件
+    scan = RepositoryScan(repository_path, *shard) if shard is not None else None
+    start_time = time.monotonic()
+    try:
+        await offline_review.run(repository_path, ranges, pull_request_ids, scan)
+    finally:
+        metrics.write(offline_review.summary.to_dict())
+        if scan is not None:
+            write_stats(output, scan.stats(offline_review.summary, time.monotonic() - start_time))
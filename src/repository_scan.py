@@ -0,0 +1,177 @@
+import asyncio
+import hashlib
+import json
+import os
+import common_function
+from ai_code_reviewer_logger import logger
+from github_assistant import DiffFileStruct
+from language_registry import registry
+from review_filter import ReviewFilter
+from review_output import ReviewOutput
+from run_summary import RunSummary
+
+
+# 解析 i/N 形式的分片参数，i 从 0 开始
+def parse_shard(text: str) -> tuple[int, int]:
+    index, separator, count = text.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"Shard must be in the form i/N:{text}") from None
+    if not separator or count <= 0 or not 0 <= index < count:
+        raise ValueError(f"Shard index must be in [0, N):{text}")
+    return index, count
+
+
+# 按文件路径的哈希分片，与文件的遍历顺序和运行环境无关，各 runner 在同一提交上得到互不重叠的分片
+def shard_of(file_name: str, shard_count: int) -> int:
+    digest = hashlib.sha256(file_name.encode("utf-8", errors="replace")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+def count_lines(file_path: str) -> tuple[int, int]:
+    with open(file_path, "rb") as f:
+        source = f.read()
+    return source.count(b"\n") + (1 if source and not source.endswith(b"\n") else 0), len(source)
+
+
+class RepositoryScan:
+    """
+    全仓库扫描：遍历检出目录中受支持语言的全部文件，把每个文件的全部行视为变更行，复用解析和审查流程审查每一个函数
+    文件列表来自 git ls-files（不是 git 仓库时遍历目录），按路径哈希分片，只处理属于本分片的文件
+    与 LocalGitDiff 一样提供 iter_diff_file_structs，可以直接作为 CppCodeAnalyzer 的变更文件来源
+    """
+
+    def __init__(self, repository_path: str, shard_index: int = 0, shard_count: int = 1):
+        self.repository_path = repository_path
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        # 忽略列表中的文件（第三方目录等）不读取，也不计入统计
+        self.review_filter = ReviewFilter.from_env(repository_path)
+        # 本分片的文件数、行数和字节数，用于统计吞吐和调整分片
+        self.files = 0
+        self.lines = 0
+        self.bytes = 0
+
+
+    async def git(self, *args) -> bytes:
+        return await common_function.run_git("-C", self.repository_path, *args)
+
+
+    # 当前检出的提交，作为结果记录的来源标识；不是 git 仓库时返回 None
+    async def commit_sha(self) -> str | None:
+        try:
+            return (await self.git("rev-parse", "HEAD")).decode("utf-8").strip()
+        except RuntimeError:
+            return None
+
+
+    async def list_files(self) -> list:
+        try:
+            output = await self.git("-c", "core.quotePath=false", "ls-files", "-z")
+            return sorted(name for name in output.decode("utf-8", errors="replace").split("\0") if name)
+        except RuntimeError as e:
+            logger.warning(f"List files with git failed, walk directory instead:{e}")
+        files = []
+        for root, dirs, names in os.walk(self.repository_path):
+            # 跳过 .git 等隐藏目录
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for name in names:
+                files.append(os.path.relpath(os.path.join(root, name), self.repository_path).replace(os.sep, "/"))
+        return sorted(files)
+
+
+    async def iter_diff_file_structs(self):
+        files = await self.list_files()
+        logger.info(f"Start scan repository:{self.repository_path}, shard:{self.shard_index}/{self.shard_count}, "
+                    f"files:{len(files)}")
+        for file_name in files:
+            if shard_of(file_name, self.shard_count) != self.shard_index or registry.spec_for(file_name) is None:
+                continue
+            if self.review_filter.is_ignored(file_name):
+                continue
+            file_path = os.path.join(self.repository_path, file_name)
+            try:
+                lines, size = await asyncio.to_thread(count_lines, file_path)
+            except OSError as e:
+                # git ls-files 会列出未检出的子模块等不是普通文件的路径
+                logger.warning(f"Read file failed, skip:{file_name}, error:{e}")
+                continue
+            self.files += 1
+            self.lines += lines
+            self.bytes += size
+            # 全部行都视为变更行，文件中的每个函数都会被审查
+            yield DiffFileStruct(file_name, file_path, range(1, lines + 1))
+        logger.info(f"Scan repository finished, shard files:{self.files}, lines:{self.lines}")
+
+
+    # 本分片的吞吐统计，合并时用于比较各分片的耗时并调整分片数
+    def stats(self, summary: RunSummary, wall_time: float) -> dict:
+        counters = summary.counters
+        functions = counters.get("functions_reviewed", 0) + counters.get("functions_resumed", 0)
+        return {
+            "shard": f"{self.shard_index}/{self.shard_count}",
+            "files": self.files,
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "functions": functions,
+            "llm_requests": counters.get("llm_requests", 0),
+            "prompt_tokens": counters.get("prompt_tokens", 0),
+            "completion_tokens": counters.get("completion_tokens", 0),
+            "wall_time_s": round(wall_time, 3),
+            "lines_per_second": round(self.lines / wall_time, 2) if wall_time > 0 else 0,
+            "functions_per_second": round(functions / wall_time, 2) if wall_time > 0 else 0,
+            "counters": dict(sorted(counters.items()))
+        }
+
+
+def stats_path(output: str) -> str:
+    return f"{output}.stats.json"
+
+
+def write_stats(output: str, stats: dict):
+    path = stats_path(output)
+    common_function.write_json_atomic(path, stats, indent=2)
+    logger.info(f"Write scan stats success:{path}")
+
+
+# 合并各分片的结果文件（按 key 去重）和吞吐统计，输出 JSONL 或 SARIF
+def merge_results(output: str, output_format: str, inputs: list) -> dict:
+    review_output = ReviewOutput(output, output_format)
+    review_output.open()
+    shards = []
+    try:
+        for input_path in inputs:
+            records = 0
+            for record in ReviewOutput(input_path).read_records():
+                if record["key"] not in review_output.done:
+                    review_output.write_record(record)
+                    records += 1
+            logger.info(f"Merge review output success:{input_path}, new records:{records}")
+            try:
+                with open(stats_path(input_path), "r", encoding="utf-8") as f:
+                    shards.append(json.load(f))
+            except FileNotFoundError:
+                logger.warning(f"Scan stats not found:{stats_path(input_path)}")
+    finally:
+        review_output.close()
+
+    merged = {"shards": shards}
+    if shards:
+        wall_times = [shard["wall_time_s"] for shard in shards]
+        mean_wall_time = sum(wall_times) / len(wall_times)
+        merged.update({
+            "files": sum(shard["files"] for shard in shards),
+            "lines": sum(shard["lines"] for shard in shards),
+            "functions": sum(shard["functions"] for shard in shards),
+            "llm_requests": sum(shard["llm_requests"] for shard in shards),
+            "max_wall_time_s": max(wall_times),
+            # 最慢分片与平均耗时之比，越接近 1 分片越均衡
+            "imbalance": round(max(wall_times) / mean_wall_time, 3) if mean_wall_time > 0 else 1.0
+        })
+        for shard in shards:
+            logger.info(f"Shard {shard['shard']}: files:{shard['files']}, lines:{shard['lines']}, "
+                        f"functions:{shard['functions']}, wall time:{shard['wall_time_s']}s, "
+                        f"lines/s:{shard['lines_per_second']}")
+        write_stats(output, merged)
+    return merged
@@ -0,0 +1,94 @@
+import asyncio
+import base64
+import collections
+import os
+import shutil
+import urllib.parse
+from dataclasses import dataclass
+import common_function
+from ai_code_reviewer_logger import logger
+from run_metrics import metrics
+
+
+@dataclass
+class ReviewJob:
+    owner: str
+    repo: str
+    pull_request_id: int
+    head_sha: str
+    base_sha: str
+
+    # 同一个 PR 的审查任务使用相同的 key，新的提交会取代旧的任务
+    @property
+    def key(self) -> tuple:
+        return self.owner, self.repo, self.pull_request_id
+
+    @property
+    def name(self) -> str:
+        return f"{self.owner}/{self.repo}#{self.pull_request_id}@{self.head_sha[:12]}"
+
+
+class RepositoryWorkspace:
+    """
+    在本地为每个仓库维护一个 bare 仓库，每次审查按需拉取 base / head 提交并创建临时工作树
+    同一个仓库的 git 操作串行执行，不同仓库之间互不影响
+    """
+
+    def __init__(self, root: str, github_token: str, clone_url_template: str):
+        self.root = os.path.abspath(root)
+        self._github_token = github_token
+        self.clone_url_template = clone_url_template
+        self.locks = collections.defaultdict(asyncio.Lock)
+
+
+    def clone_url(self, job: ReviewJob) -> str:
+        return self.clone_url_template.format(owner=job.owner, repo=job.repo)
+
+
+    # 通过环境变量传递认证头，token 不会出现在命令行参数和 git 配置文件中
+    def git_env(self, clone_url: str) -> dict:
+        env = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        parts = urllib.parse.urlsplit(clone_url)
+        if parts.scheme in ("http", "https") and self._github_token:
+            credential = base64.b64encode(f"x-access-token:{self._github_token}".encode("utf-8")).decode("ascii")
+            env.update({
+                "GIT_CONFIG_COUNT": "1",
+                "GIT_CONFIG_KEY_0": f"http.{parts.scheme}://{parts.netloc}/.extraheader",
+                "GIT_CONFIG_VALUE_0": f"AUTHORIZATION: basic {credential}"
+            })
+        return env
+
+
+    # 拉取任务需要的提交并在 head 提交上创建工作树，返回工作树路径
+    async def checkout(self, job: ReviewJob) -> str:
+        mirror = os.path.join(self.root, job.owner, f"{job.repo}.git")
+        worktree = os.path.join(self.root, "worktrees",
+                                f"{job.owner}-{job.repo}-{job.pull_request_id}-{job.head_sha[:12]}")
+        clone_url = self.clone_url(job)
+        async with self.locks[(job.owner, job.repo)]:
+            with metrics.span("server_checkout"):
+                if not os.path.isdir(mirror):
+                    await common_function.run_git("init", "--bare", "--quiet", mirror)
+                # 计算 base...head 需要两者的合并基点，因此拉取完整历史
+                await common_function.run_git("-C", mirror, "fetch", "--quiet", "--no-tags", clone_url,
+                                              job.base_sha, job.head_sha, env=self.git_env(clone_url))
+                if os.path.exists(worktree):
+                    await self.release(worktree, mirror)
+                await common_function.run_git("-C", mirror, "worktree", "add", "--quiet", "--detach",
+                                              worktree, job.head_sha)
+        return worktree
+
+
+    async def remove_worktree(self, job: ReviewJob, worktree: str):
+        mirror = os.path.join(self.root, job.owner, f"{job.repo}.git")
+        async with self.locks[(job.owner, job.repo)]:
+            await self.release(worktree, mirror)
+
+
+    async def release(self, worktree: str, mirror: str):
+        try:
+            await common_function.run_git("-C", mirror, "worktree", "remove", "--force", worktree)
+        except RuntimeError as e:
+            logger.warning(f"Remove worktree failed, fallback to delete directly:{e}")
+            shutil.rmtree(worktree, ignore_errors=True)
+            await common_function.run_git("-C", mirror, "worktree", "prune")
@@ -0,0 +1,260 @@
+import asyncio
+import email.utils
+import os
+import random
+import time
+import httpx
+from ai_code_reviewer_logger import logger
+from run_metrics import metrics
+
+
+# 可重试的 HTTP 状态码，429 表示被限流，其余为服务端临时错误
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# 请求尚未发出的网络错误，非幂等请求也可以安全重试
+UNSENT_REQUEST_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    单个接口的熔断器
+    连续失败达到阈值后熔断，reset_timeout 秒后放行一个探测请求，成功则恢复
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+
+    # 返回本次请求是否为半开状态下的探测请求
+    def check(self) -> bool:
+        if self.opened_at is None:
+            return False
+        if time.monotonic() - self.opened_at < self.reset_timeout or self.probing:
+            raise CircuitOpenError(f"Circuit breaker is open:{self.name}")
+        # 半开状态，只放行一个探测请求
+        self.probing = True
+        return True
+
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit breaker closed:{self.name}")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+
+    def release_probe(self):
+        # 探测请求既未成功也未失败（例如被限流），允许下一个请求继续探测
+        self.probing = False
+
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"Circuit breaker opened:{self.name}, failures:{self.failures}")
+            self.opened_at = time.monotonic()
+
+
+class AdaptiveLimiter:
+    """
+    AIMD 自适应并发控制
+    每次成功并发上限加性增长（每轮约 +1），被限流时乘性减半，使吞吐逼近服务端允许的上限
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.last_decrease = 0.0
+
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+
+    def on_throttle(self):
+        # 同一批并发请求同时被限流时只减半一次
+        now = time.monotonic()
+        if now - self.last_decrease < 1.0:
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+        logger.warning(f"Throttled, decrease concurrency limit to {int(self.limit)}")
+
+
+class ResilientExecutor:
+    """
+    大模型和 GitHub 调用共用的容错层
+    提供带抖动的指数退避重试、Retry-After / X-RateLimit-* 头处理、按接口熔断以及 AIMD 并发控制
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limiter: AdaptiveLimiter,
+        max_attempts: int = 4,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0
+    ):
+        self.name = name
+        self.limiter = limiter
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        # 因配额耗尽需要等待到的时间点
+        self.blocked_until = 0.0
+        self.retries = 0
+
+
+    @classmethod
+    def from_env(cls, name: str, initial_concurrency: int, max_concurrency: int):
+        return cls(
+            name,
+            AdaptiveLimiter(initial_concurrency, 1, max_concurrency),
+            max_attempts=int(os.environ.get("RETRY_MAX_ATTEMPTS", "4")),
+            base_delay=float(os.environ.get("RETRY_BASE_DELAY", "1")),
+            max_delay=float(os.environ.get("RETRY_MAX_DELAY", "60")),
+            failure_threshold=int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5")),
+            reset_timeout=float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "30"))
+        )
+
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(f"{self.name} {endpoint}",
+                                                     self.failure_threshold, self.reset_timeout)
+        return self.breakers[endpoint]
+
+
+    async def call(self, endpoint: str, request, idempotent: bool = True):
+        # request 为发起一次请求的协程函数，失败时应抛出 httpx 异常
+        # 非幂等请求（如创建 review）在 5xx 或请求可能已经发出的网络错误后不重试，避免服务端已处理时重复创建
+        breaker = self.breaker(endpoint)
+        for attempt in range(self.max_attempts):
+            if (wait := self.blocked_until - time.time()) > 0:
+                logger.warning(f"Rate limit exhausted, wait {wait:.1f}s before calling {endpoint}")
+                await asyncio.sleep(wait)
+
+            probe = breaker.check()
+            try:
+                wait_start = time.monotonic()
+                async with self.limiter:
+                    metrics.observe(f"{self.name}_limiter_wait", time.monotonic() - wait_start)
+                    try:
+                        result = await request()
+                    except httpx.HTTPStatusError as e:
+                        response = e.response
+                        throttled = self.is_throttled(response)
+                        if throttled:
+                            self.limiter.on_throttle()
+                            breaker.release_probe()
+                        elif response.status_code >= 500:
+                            breaker.record_failure()
+                        else:
+                            # 其他 4xx 说明服务本身可用，不计入熔断
+                            breaker.record_success()
+                        if not (throttled or response.status_code in RETRYABLE_STATUS_CODES):
+                            raise
+                        if not (throttled or idempotent):
+                            raise
+                        if attempt + 1 >= self.max_attempts:
+                            raise
+                        delay = self.retry_delay(attempt, response)
+                    except httpx.TransportError as e:
+                        breaker.record_failure()
+                        if attempt + 1 >= self.max_attempts:
+                            raise
+                        if not (idempotent or isinstance(e, UNSENT_REQUEST_ERRORS)):
+                            raise
+                        delay = self.retry_delay(attempt, None)
+                    else:
+                        self.limiter.on_success()
+                        breaker.record_success()
+                        return result
+            finally:
+                # 探测请求被取消（如被对冲请求取代）或抛出其他异常时也要释放，否则熔断器永远不会恢复
+                if probe and breaker.probing:
+                    breaker.release_probe()
+
+            self.retries += 1
+            metrics.add(f"{self.name}_retries")
+            logger.warning(f"Retry {endpoint} in {delay:.1f}s, attempt:{attempt + 1}/{self.max_attempts}")
+            await asyncio.sleep(delay)
+
+
+    @staticmethod
+    def is_throttled(response: httpx.Response) -> bool:
+        if response.status_code == 429:
+            return True
+        # GitHub 配额耗尽时返回 403 并带有 X-RateLimit-Remaining: 0，触发二级限流时带有 Retry-After
+        return response.status_code == 403 and (response.headers.get("X-RateLimit-Remaining") == "0"
+                                                 or "Retry-After" in response.headers)
+
+
+    def retry_delay(self, attempt: int, response: httpx.Response | None) -> float:
+        if response is not None:
+            if (retry_after := self.parse_retry_after(response.headers.get("Retry-After"))) is not None:
+                return min(retry_after, self.max_delay)
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                reset = response.headers.get("X-RateLimit-Reset")
+                if reset and reset.isdigit():
+                    return min(max(0.0, int(reset) - time.time()) + 1, self.max_delay)
+        # full jitter 指数退避
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+    @staticmethod
+    def parse_retry_after(value: str | None) -> float | None:
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+    def observe_rate_limit(self, headers):
+        # 根据 GitHub 返回的 X-RateLimit-* 头，在配额即将耗尽前主动降低并发，耗尽后等待重置
+        remaining = headers.get("X-RateLimit-Remaining")
+        limit = headers.get("X-RateLimit-Limit")
+        reset = headers.get("X-RateLimit-Reset")
+        if not (remaining and remaining.isdigit()):
+            return
+        if remaining == "0" and reset and reset.isdigit():
+            self.blocked_until = max(self.blocked_until, float(reset))
+        elif limit and limit.isdigit() and int(remaining) < int(limit) * 0.05:
+            self.limiter.on_throttle()
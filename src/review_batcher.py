@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+from ai_code_reviewer_logger import logger
+from token_budget import estimate_tokens
+
+
+class ReviewBatcher:
+    """
+    将小函数打包成一次大模型请求
+    同一文件（文件上下文相同）且路由到同一模型的函数才打包在一起：请求携带该文件的上下文，审查结果也确实来自缓存 key 中的模型
+    提交的函数会在 linger 秒内等待更多函数加入，累计 token 达到 max_batch_tokens 时立即发送
+    review_batch 接收 ({函数ID: 函数体}, 文件上下文) 并返回 {函数ID: 审查意见}，失败或缺少结果时由 review_single 逐个补齐
+    """
+
+    max_batch_size = 20
+
+    def __init__(self, review_batch, review_single, max_batch_tokens: int, linger: float):
+        self.review_batch = review_batch
+        self.review_single = review_single
+        self.max_batch_tokens = max_batch_tokens
+        self.linger = linger
+
+        # {(文件上下文, 模型): {函数ID: (函数体, [future, ...])}}
+        self.pending = {}
+        # 各分组的累计 token 数和等待计时器
+        self.pending_tokens = {}
+        self.timers = {}
+        self.tasks = set()
+
+        self.batches = 0
+        self.fallbacks = 0
+
+
+    @staticmethod
+    def function_id(function_body: str) -> str:
+        # 由函数内容生成稳定的ID，相同函数体得到相同ID
+        return "f" + hashlib.sha1(function_body.encode("utf-8", errors="replace")).hexdigest()[:12]
+
+
+    async def submit(self, function_body: str, file_context: str = "", model: str = "") -> str:
+        group = (file_context, model)
+        function_id = self.function_id(function_body)
+        future = asyncio.get_running_loop().create_future()
+        functions = self.pending.setdefault(group, {})
+        if function_id in functions:
+            functions[function_id][1].append(future)
+        else:
+            functions[function_id] = (function_body, [future])
+            self.pending_tokens[group] = self.pending_tokens.get(group, 0) + estimate_tokens(function_body)
+
+        if self.pending_tokens[group] >= self.max_batch_tokens or len(functions) >= self.max_batch_size:
+            self.flush(group)
+        elif group not in self.timers:
+            self.timers[group] = asyncio.get_running_loop().call_later(self.linger, self.flush, group)
+        return await future
+
+
+    def flush(self, group: tuple):
+        if (timer := self.timers.pop(group, None)) is not None:
+            timer.cancel()
+        batch = self.pending.pop(group, None)
+        self.pending_tokens.pop(group, None)
+        if not batch:
+            return
+
+        task = asyncio.create_task(self.run_batch(batch, group[0]))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+    async def run_batch(self, batch: dict, file_context: str):
+        try:
+            results = {}
+            if len(batch) > 1:
+                try:
+                    self.batches += 1
+                    results = await self.review_batch({fid: body for fid, (body, _) in batch.items()}, file_context)
+                except Exception as e:
+                    logger.warning(f"Batch review failed, fallback to single review, size:{len(batch)}, error:{e}")
+
+            # 先返回打包请求已有的结果，不等待缺失函数的逐个补齐
+            for fid, review in results.items():
+                if fid in batch:
+                    for future in batch[fid][1]:
+                        if not future.done():
+                            future.set_result(review)
+
+            missing = [fid for fid in batch if fid not in results]
+            if missing and len(batch) > 1:
+                self.fallbacks += len(missing)
+            await asyncio.gather(*[self.resolve_single(fid, batch[fid], file_context) for fid in missing])
+        except asyncio.CancelledError:
+            # 审查被取消时，等待结果的调用方也一并取消
+            for _, futures in batch.values():
+                for future in futures:
+                    future.cancel()
+            raise
+
+
+    async def resolve_single(self, function_id: str, entry, file_context: str):
+        function_body, futures = entry
+        try:
+            review = await self.review_single(function_body, file_context)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in futures:
+            if not future.done():
+                future.set_result(review)
+
+
+    # 取消尚未发送和正在进行的打包请求，审查被新的提交取代或被取消时调用，避免继续消耗 token
+    async def close(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        for functions in self.pending.values():
+            for _, futures in functions.values():
+                for future in futures:
+                    future.cancel()
+        self.pending.clear()
+        self.pending_tokens.clear()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
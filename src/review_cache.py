@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import common_function
+from ai_code_reviewer_logger import logger
+
+
+class ReviewCache:
+    """
+    基于内容寻址的 review 结果缓存
+    key 由函数体、提示词等级、提示词内容和模型名共同哈希得到，内容不变即可直接复用上一次的审查结果
+    缓存目录可以作为 GitHub Actions cache 在多次运行之间保存
+    """
+
+    def __init__(self, cache_dir: str, max_size_bytes: int, max_age_seconds: int):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+
+        # 同一次运行中相同 key 的请求只发送一次
+        self._in_flight = {}
+
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError as e:
+            logger.exception(f"Create review cache dir failed:{e}")
+            raise
+
+        logger.info(f"Init review cache success, cache dir:{self.cache_dir}")
+
+
+    @staticmethod
+    def make_key(function_body: str, prompt_level: str, prompt_text: str, model_name: str) -> str:
+        digest = hashlib.sha256()
+        for part in (model_name, prompt_level, prompt_text, function_body):
+            data = (part or "").encode("utf-8", errors="replace")
+            # 写入长度前缀，避免不同字段拼接后产生相同的字节序列
+            digest.update(len(data).to_bytes(8, "little"))
+            digest.update(data)
+        return digest.hexdigest()
+
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+
+    def get(self, key: str) -> str | None:
+        path = self._entry_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age_seconds:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            # 更新访问时间，淘汰时按最近使用排序
+            os.utime(path)
+            return entry.get("review")
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Read review cache entry failed:{path}, error:{e}")
+            return None
+
+
+    # 只检查条目是否存在且未过期，不读取内容也不更新访问时间
+    def contains(self, key: str) -> bool:
+        if key in self._in_flight:
+            return True
+        try:
+            return time.time() - os.path.getmtime(self._entry_path(key)) <= self.max_age_seconds
+        except OSError:
+            return False
+
+
+    def put(self, key: str, review: str):
+        path = self._entry_path(key)
+        try:
+            common_function.write_json_atomic(path, {"review": review, "created": time.time()})
+        except OSError as e:
+            logger.warning(f"Write review cache entry failed:{path}, error:{e}")
+
+
+    async def get_or_compute(self, key: str, compute, should_store=None) -> str:
+        # compute 为返回 review 文本的协程函数，只有缓存未命中时才会调用
+        # should_store 用于过滤不应落盘的结果（例如模型返回异常）
+        if (review := self.get(key)) is not None:
+            self.hits += 1
+            return review
+
+        while key in self._in_flight:
+            try:
+                review = await asyncio.shield(self._in_flight[key])
+                self.hits += 1
+                return review
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # 发起计算的一方被取消（例如所在的审查被更新的提交取代），由当前等待方重新计算
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            review = await compute()
+            future.set_result(review)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 等待方会收到同样的异常，这里避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+        if should_store is None or should_store(review):
+            self.put(key, review)
+        return review
+
+
+    def evict(self):
+        # 先淘汰过期条目，再按最近访问时间淘汰直到总大小低于上限
+        now = time.time()
+        entries = []
+        total_size = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith(".tmp") or now - stat.st_mtime > self.max_age_seconds:
+                    self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+        entries.sort()
+        evicted = 0
+        for _, size, path in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            self._remove(path)
+            total_size -= size
+            evicted += 1
+
+        logger.info(f"Review cache hits:{self.hits}, misses:{self.misses}, "
+                    f"evicted:{evicted}, size:{total_size} bytes")
+
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
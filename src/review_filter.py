@@ -0,0 +1,187 @@
+import os
+import re
+import aiofiles
+from ai_code_reviewer_logger import logger
+
+
+# 默认忽略的生成代码和第三方目录，REVIEW_IGNORE_DEFAULTS 为 0 时不使用
+DEFAULT_IGNORE_PATTERNS = (
+    "*.pb.h",
+    "*.pb.cc",
+    "*.pb.go",
+    "*_pb2.py",
+    "*_pb2_grpc.py",
+    "*.min.js",
+    "vendor/",
+    "third_party/",
+    "node_modules/",
+)
+
+# 生成代码的文件头标记：protoc、go generate、@generated 等，只在文件开头的注释中查找
+GENERATED_MARKER_RE = re.compile(
+    rb"@generated\b|\bDO NOT EDIT\b|Generated by the protocol buffer compiler|(?i:\bauto-?generated\b)"
+)
+
+# 文件头注释行的前缀，覆盖已支持语言的行注释、块注释和 Python 文档字符串
+COMMENT_LINE_PREFIXES = (b"//", b"#", b"/*", b"*", b'"""', b"'''")
+
+PREPROCESSOR_DIRECTIVE_RE = re.compile(rb"#[A-Za-z_]")
+
+# 可以跨行的块注释和文档字符串的起止标记
+BLOCK_COMMENT_MARKERS = ((b"/*", b"*/"), (b'"""', b'"""'), (b"'''", b"'''"))
+
+# 文件头注释最多检查的行数
+GENERATED_HEADER_LINES = 10
+
+
+# 将 gitignore 风格的 glob 转换为正则：
+# 不含 / 的模式匹配任意层级的文件名或目录名，含 / 的模式相对仓库根目录匹配，以 / 结尾的模式只匹配目录
+# * 和 ? 不跨越目录，** 匹配任意层级
+def glob_to_regex(pattern: str) -> str:
+    directory_only = pattern.endswith("/")
+    anchored = "/" in pattern.rstrip("/")
+    pattern = pattern.strip("/")
+
+    parts = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith("**/", index):
+            parts.append("(?:.*/)?")
+            index += 3
+            continue
+        if pattern.startswith("**", index):
+            parts.append(".*")
+            index += 2
+            continue
+        if char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[" and (close := pattern.find("]", index + 1)) != -1:
+            body = pattern[index + 1:close]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            parts.append(f"[{body}]")
+            index = close + 1
+            continue
+        else:
+            parts.append(re.escape(char))
+        index += 1
+
+    prefix = "" if anchored else "(?:.*/)?"
+    # 匹配到目录时，目录下的全部文件都被忽略；只匹配目录的模式要求后面还有路径
+    suffix = "/.*" if directory_only else "(?:/.*)?"
+    return f"{prefix}{''.join(parts)}{suffix}"
+
+
+class ReviewFilter:
+    """
+    解析之前的廉价过滤：忽略列表、文件大小、超长行（压缩代码）和生成代码的文件头
+    忽略列表来自仓库根目录的 .aireviewignore（gitignore 风格的 glob，每行一个，# 开头为注释），
+    启动时编译为一个正则，每个文件只需一次匹配；文件头只读取前 REVIEW_SNIFF_BYTES 个字节
+    check 返回跳过原因，不需要跳过时返回 None
+    """
+
+    def __init__(self, patterns: list, max_file_bytes: int, max_line_length: int, sniff_bytes: int):
+        self.patterns = patterns
+        self.matcher = None
+        if patterns:
+            self.matcher = re.compile("|".join(f"(?:{glob_to_regex(pattern)})" for pattern in patterns))
+        # 为 0 时不限制
+        self.max_file_bytes = max_file_bytes
+        self.max_line_length = max_line_length
+        self.sniff_bytes = sniff_bytes
+        logger.info(f"Init review filter success, patterns:{len(patterns)}")
+
+
+    @classmethod
+    def from_env(cls, repository_path: str):
+        patterns = list(DEFAULT_IGNORE_PATTERNS) if os.environ.get("REVIEW_IGNORE_DEFAULTS", "1") == "1" else []
+        ignore_file = os.environ.get("REVIEW_IGNORE_FILE") or os.path.join(repository_path, ".aireviewignore")
+        patterns.extend(cls.read_patterns(ignore_file))
+        return cls(
+            patterns,
+            int(os.environ.get("REVIEW_MAX_FILE_BYTES", str(2 * 1024 * 1024))),
+            int(os.environ.get("REVIEW_MAX_LINE_LENGTH", "1000")),
+            int(os.environ.get("REVIEW_SNIFF_BYTES", "8192"))
+        )
+
+
+    @staticmethod
+    def read_patterns(ignore_file: str) -> list:
+        try:
+            with open(ignore_file, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        except OSError as e:
+            logger.warning(f"Read review ignore file failed:{ignore_file}, error:{e}")
+            return []
+        patterns = []
+        for line in lines:
+            pattern = line.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            # 忽略列表编译为一个正则，不支持 gitignore 的 ! 取反，跳过并提示，避免静默地忽略文件
+            if pattern.startswith("!"):
+                logger.warning(f"Negated pattern is not supported, skip:{pattern}, file:{ignore_file}")
+                continue
+            # \! 和 \# 表示以 ! 或 # 开头的文件名
+            if pattern.startswith(("\\!", "\\#")):
+                pattern = pattern[1:]
+            patterns.append(pattern)
+        logger.info(f"Load review ignore file success:{ignore_file}, patterns:{len(patterns)}")
+        return patterns
+
+
+    def is_ignored(self, file_name: str) -> bool:
+        return self.matcher is not None and self.matcher.fullmatch(file_name.replace(os.sep, "/")) is not None
+
+
+    # 文件开头连续的注释行（允许空行），遇到第一行代码时结束，正文注释中的 "auto-generated" 等不会被误判
+    @staticmethod
+    def leading_comment(head: bytes) -> bytes:
+        lines = []
+        # 尚未结束的块注释或文档字符串的结束标记
+        block_end = None
+        for line in head.split(b"\n")[:GENERATED_HEADER_LINES]:
+            stripped = line.strip()
+            if block_end is not None:
+                if block_end in stripped:
+                    block_end = None
+            elif stripped:
+                # #include、#pragma 等预处理指令是代码
+                if not stripped.startswith(COMMENT_LINE_PREFIXES) or PREPROCESSOR_DIRECTIVE_RE.match(stripped):
+                    break
+                for start, end in BLOCK_COMMENT_MARKERS:
+                    if stripped.startswith(start) and end not in stripped[len(start):]:
+                        block_end = end
+                        break
+            lines.append(stripped)
+        return b"\n".join(lines)
+
+
+    # 只读取文件头判断是否为生成代码或压缩代码，读取的内容很小，不占用整文件读取的内存
+    def check_head(self, head: bytes) -> str | None:
+        if GENERATED_MARKER_RE.search(self.leading_comment(head)):
+            return "generated"
+        if self.max_line_length > 0:
+            lines = head.split(b"\n")
+            # 文件头的最后一行可能被截断，长度只会偏小
+            if max(len(line) for line in lines) > self.max_line_length:
+                return "long_lines"
+        return None
+
+
+    async def check(self, file_name: str, file_path: str) -> str | None:
+        if self.is_ignored(file_name):
+            return "ignored"
+        size = os.path.getsize(file_path)
+        if self.max_file_bytes > 0 and size > self.max_file_bytes:
+            return "too_large"
+        if self.sniff_bytes <= 0 or size == 0:
+            return None
+        async with aiofiles.open(file_path, "rb") as f:
+            head = await f.read(self.sniff_bytes)
+        return self.check_head(head)
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import time
+import common_function
+from ai_code_reviewer_logger import logger
+from review_unit import ReviewUnit
+
+
+class ReviewOutput:
+    """
+    离线模式的审查结果文件，不调用 GitHub，结果逐条追加写入 JSONL
+    每条记录带有由审查对象、文件、行号和函数体生成的 key，重新运行时跳过文件中已有的 key，中断后可以继续
+    没有审查意见的函数同样写入（review 为空），模型应答失败的函数不写入，重新运行时再次审查
+    SARIF 格式不能追加写入，结果先写入 <path>.jsonl，结束时再整体生成 SARIF 文件
+    """
+
+    formats = ("jsonl", "sarif")
+
+    # SARIF 中使用的规则 ID
+    sarif_rule_id = "ai-code-review"
+
+    def __init__(self, path: str, output_format: str = "jsonl"):
+        if output_format not in self.formats:
+            raise ValueError(f"Unsupported output format:{output_format}")
+        self.path = path
+        self.output_format = output_format
+        self.records_path = path if output_format == "jsonl" else f"{path}.jsonl"
+        # 已写入的记录 key
+        self.done = set()
+        self.written = 0
+        self._file = None
+
+
+    @staticmethod
+    def record_key(source: str, unit: ReviewUnit) -> str:
+        content = "\0".join((source, unit.file_name, str(unit.start_line), str(unit.line), unit.function_body))
+        return hashlib.sha256(content.encode("utf-8", errors="replace")).hexdigest()[:32]
+
+
+    def open(self):
+        directory = os.path.dirname(self.records_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        valid_bytes = 0
+        if os.path.exists(self.records_path):
+            with open(self.records_path, "rb") as f:
+                for line in f:
+                    # 被中断时最后一行可能只写了一半，丢弃并从该位置继续写
+                    try:
+                        self.done.add(json.loads(line)["key"])
+                    except (ValueError, KeyError):
+                        break
+                    valid_bytes += len(line)
+            os.truncate(self.records_path, valid_bytes)
+        self._file = open(self.records_path, "a", encoding="utf-8")
+        logger.info(f"Open review output success:{self.records_path}, existing records:{len(self.done)}")
+
+
+    def is_done(self, source: str, unit: ReviewUnit) -> bool:
+        return self.record_key(source, unit) in self.done
+
+
+    def write(self, source: str, unit: ReviewUnit, review: str, prompt_level: str, model: str):
+        record = {
+            "key": self.record_key(source, unit),
+            "source": source,
+            "file": unit.file_name,
+            "line": unit.line,
+            "start_line": unit.start_line,
+            "end_line": unit.end_line,
+            "prompt_level": prompt_level,
+            "model": model,
+            "review": review,
+            "created": time.time()
+        }
+        self.write_record(record)
+
+
+    # 写入一条完整的记录，合并分片结果时直接写入读取到的记录
+    def write_record(self, record: dict):
+        # 逐行写入并刷新，进程被终止时最多丢失正在写的一行
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.done.add(record["key"])
+        self.written += 1
+
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if self.output_format == "sarif":
+            self.write_sarif()
+        logger.info(f"Close review output success:{self.path}, new records:{self.written}")
+
+
+    def read_records(self):
+        with open(self.records_path, "r", encoding="utf-8") as f:
+            for line in f:
+                # 被中断的分片结果最后一行可能只写了一半
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Skip incomplete review record:{self.records_path}")
+                    break
+                yield record
+
+
+    # 由全部 JSONL 记录生成 SARIF 2.1.0 文件，只包含有审查意见的记录
+    def write_sarif(self):
+        results = []
+        for record in self.read_records():
+            if not record["review"].strip():
+                continue
+            results.append({
+                "ruleId": self.sarif_rule_id,
+                "level": "note",
+                "message": {"text": record["review"]},
+                "locations": [{
+                    "physicalLocation": {
+                        "artifactLocation": {"uri": record["file"]},
+                        "region": {"startLine": record["line"]}
+                    }
+                }],
+                "partialFingerprints": {"aiCodeReviewKey/v1": record["key"]},
+                "properties": {
+                    "source": record["source"],
+                    "functionStartLine": record["start_line"],
+                    "functionEndLine": record["end_line"],
+                    "promptLevel": record["prompt_level"],
+                    "model": record["model"]
+                }
+            })
+        document = {
+            "$schema": "https://json.schemastore.org/sarif-2.1.0.json",
+            "version": "2.1.0",
+            "runs": [{
+                "tool": {"driver": {
+                    "name": "ai_code_reviewer",
+                    "rules": [{"id": self.sarif_rule_id, "shortDescription": {"text": "AI code review suggestion"}}]
+                }},
+                "results": results
+            }]
+        }
+        common_function.write_json_atomic(self.path, document, indent=2)
+        logger.info(f"Write sarif success:{self.path}, results:{len(results)}")
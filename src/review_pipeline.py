@@ -0,0 +1,158 @@
+import asyncio
+import os
+import time
+from ai_code_reviewer_logger import logger
+from review_unit import ReviewUnit
+from run_metrics import metrics
+
+
+class MemoryBudget:
+    """
+    按字节计数的内存上限，用于在流水线各阶段之间施加背压
+    读取源码前按文件大小预留，提取出待审查单元后改为按单元文本大小计数，单元审查完成后释放
+    limit_bytes 为 0 时不限制
+    """
+
+    def __init__(self, limit_bytes: int):
+        self.limit_bytes = limit_bytes
+        self.used = 0
+        self.peak = 0
+        self.condition = asyncio.Condition()
+
+
+    # 等待可用额度并预留，返回实际预留的字节数；单次预留超过上限时按上限计算，避免永远等待
+    # amount 为 0 时（如无法获取文件大小）也要等到已用额度不超过上限
+    async def acquire(self, amount: int) -> int:
+        if self.limit_bytes <= 0:
+            return 0
+        amount = min(max(amount, 0), self.limit_bytes)
+        wait_start = time.monotonic()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used + amount <= self.limit_bytes)
+            self.used += amount
+            self.peak = max(self.peak, self.used)
+        metrics.observe("pipeline_memory_wait", time.monotonic() - wait_start)
+        return amount
+
+
+    # 将已预留的额度调整为新的大小，内存已经分配，增加时不等待（暂时超出上限，后续的预留会等待）
+    async def resize(self, reserved: int, amount: int) -> int:
+        if self.limit_bytes <= 0:
+            return 0
+        async with self.condition:
+            self.used += amount - reserved
+            self.peak = max(self.peak, self.used)
+            self.condition.notify_all()
+        return amount
+
+
+    async def release(self, amount: int):
+        if amount <= 0:
+            return
+        async with self.condition:
+            self.used -= amount
+            self.condition.notify_all()
+
+
+class ReviewPipeline:
+    """
+    大 PR 的流式审查：变更文件 -> 解析 -> 待审查单元 -> 大模型 -> 评论，各阶段之间使用有界队列
+    文件和单元的数量、以及在途源码和单元文本的总字节数都有上限，下游处理不过来时上游暂停，
+    峰值内存只与队列长度和内存上限有关，与 PR 的文件数无关
+    extract_units 读取并解析单个文件，返回待审查单元（源码和语法树在返回前释放）
+    review_unit 审查单个单元并记录评论，评论在全部单元审查完成后由调用方统一提交
+    """
+
+    def __init__(self, extract_units, review_unit, parse_workers: int, review_workers: int,
+                 queue_size: int, memory_limit_bytes: int):
+        if parse_workers <= 0 or review_workers <= 0 or queue_size <= 0:
+            raise ValueError("Pipeline workers and queue size must be greater than 0")
+        self.extract_units = extract_units
+        self.review_unit = review_unit
+        self.parse_workers = parse_workers
+        self.review_workers = review_workers
+        self.queue_size = queue_size
+        self.memory = MemoryBudget(memory_limit_bytes)
+
+
+    @classmethod
+    def from_env(cls, extract_units, review_unit):
+        return cls(
+            extract_units,
+            review_unit,
+            int(os.environ.get("PIPELINE_PARSE_WORKERS", str(os.cpu_count() or 1))),
+            int(os.environ.get("PIPELINE_REVIEW_WORKERS", "64")),
+            int(os.environ.get("PIPELINE_QUEUE_SIZE", "64")),
+            int(os.environ.get("PIPELINE_MEMORY_MB", "512")) * 1024 * 1024
+        )
+
+
+    @staticmethod
+    def unit_bytes(unit: ReviewUnit) -> int:
+        # 同一文件的单元共用同一个上下文字符串，这里按单元计数，偏保守
+        return len(unit.function_body) + len(unit.file_context)
+
+
+    @staticmethod
+    def file_bytes(diff_file_struct) -> int:
+        try:
+            return os.path.getsize(diff_file_struct.file_path)
+        except OSError:
+            return 0
+
+
+    # 依次放入变更文件，全部处理完成后返回文件数量
+    async def run(self, diff_file_structs) -> int:
+        file_queue = asyncio.Queue(self.queue_size)
+        unit_queue = asyncio.Queue(self.queue_size)
+        parsers = [asyncio.create_task(self.parse_worker(file_queue, unit_queue)) for _ in range(self.parse_workers)]
+        reviewers = [asyncio.create_task(self.review_worker(unit_queue)) for _ in range(self.review_workers)]
+        files = 0
+        try:
+            # 获取变更文件的生成器在队列满时暂停，GitHub files 接口的分页随之暂停
+            async for diff_file_struct in diff_file_structs:
+                await file_queue.put(diff_file_struct)
+                files += 1
+            for _ in parsers:
+                await file_queue.put(None)
+            await asyncio.gather(*parsers)
+            for _ in reviewers:
+                await unit_queue.put(None)
+            await asyncio.gather(*reviewers)
+        finally:
+            # 获取变更文件失败时结束全部工作协程
+            for task in parsers + reviewers:
+                task.cancel()
+            await asyncio.gather(*parsers, *reviewers, return_exceptions=True)
+        metrics.add("pipeline_peak_memory_bytes", self.memory.peak)
+        logger.info(f"Review pipeline finished, files:{files}, peak memory:{self.memory.peak} bytes")
+        return files
+
+
+    async def parse_worker(self, file_queue: asyncio.Queue, unit_queue: asyncio.Queue):
+        while (diff_file_struct := await file_queue.get()) is not None:
+            reserved = await self.memory.acquire(self.file_bytes(diff_file_struct))
+            units = []
+            try:
+                units = await self.extract_units(diff_file_struct)
+            except Exception as e:
+                logger.exception(f"Extract review units failed:{diff_file_struct.file_name}, error:{e}")
+            finally:
+                # 源码和语法树已经释放，只保留单元文本
+                reserved = await self.memory.resize(reserved, sum(self.unit_bytes(unit) for unit in units))
+            for unit in units:
+                # 按单元拆分预留额度，每个单元审查完成后各自释放
+                unit_reserved = min(reserved, self.unit_bytes(unit)) if self.memory.limit_bytes > 0 else 0
+                reserved -= unit_reserved
+                await unit_queue.put((unit, unit_reserved))
+            await self.memory.release(reserved)
+
+
+    async def review_worker(self, unit_queue: asyncio.Queue):
+        while (item := await unit_queue.get()) is not None:
+            unit, reserved = item
+            try:
+                # review_unit 自行处理单个函数的失败
+                await self.review_unit(unit)
+            finally:
+                await self.memory.release(reserved)
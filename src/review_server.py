@@ -0,0 +1,336 @@
+import argparse
+import asyncio
+import collections
+import hashlib
+import hmac
+import json
+import os
+import re
+import signal
+import urllib.parse
+from dataclasses import dataclass
+from ai_code_reviewer import CppCodeAnalyzer
+from ai_code_reviewer_logger import logger
+from local_diff import LocalGitDiff
+from repository_workspace import RepositoryWorkspace, ReviewJob
+from run_metrics import metrics
+from shared_resources import SharedResources
+
+
+class FairQueue:
+    """
+    审查任务队列，按仓库轮转、仓库内按 PR 先后取出任务，避免单个仓库的大量 PR 占满全部审查槽位
+    同一个 PR 在队列中最多只有一个任务，新的提交直接替换排队中的旧任务
+    """
+
+    def __init__(self):
+        # 仓库 -> {PR key: 任务}
+        self.repos = collections.OrderedDict()
+        self.condition = asyncio.Condition()
+
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self.repos.values())
+
+
+    # 加入任务，返回被替换的旧任务
+    async def put(self, job: ReviewJob):
+        async with self.condition:
+            jobs = self.repos.setdefault((job.owner, job.repo), collections.OrderedDict())
+            replaced = jobs.pop(job.key, None)
+            jobs[job.key] = job
+            self.condition.notify()
+            return replaced
+
+
+    # 移除某个 PR 排队中的任务，返回被移除的任务
+    async def remove(self, key: tuple):
+        async with self.condition:
+            jobs = self.repos.get(key[:2])
+            if jobs is None:
+                return None
+            job = jobs.pop(key, None)
+            if not jobs:
+                del self.repos[key[:2]]
+            return job
+
+
+    async def get(self) -> ReviewJob:
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.repos)
+            repo, jobs = self.repos.popitem(last=False)
+            _, job = jobs.popitem(last=False)
+            # 该仓库还有其他 PR 时排到队尾，下一次优先取其他仓库的任务
+            if jobs:
+                self.repos[repo] = jobs
+            return job
+
+
+@dataclass
+class RunningReview:
+    job: ReviewJob
+    task: asyncio.Task
+
+
+class ReviewServer:
+    """
+    常驻的 webhook 审查服务
+    启动时创建并预热解析器、连接池等共享资源，收到 pull_request 事件后放入公平队列，由固定数量的 worker 依次审查
+    同一个 PR 推送了新的提交时，排队中的旧任务被替换，正在进行的旧任务（包括在途的大模型请求）被取消，不会提交过期的评论
+    """
+
+    # 需要审查的 pull_request 事件
+    review_actions = {"opened", "synchronize", "reopened", "ready_for_review"}
+
+    # 仓库名和提交 SHA 会用于拼接本地路径和 git 命令参数，只接受合法的取值
+    name_re = re.compile(r"^(?!\.{1,2}$)[A-Za-z0-9_.-]+$")
+    sha_re = re.compile(r"^[0-9a-f]{40}([0-9a-f]{24})?$")
+
+    # webhook 请求体上限，与 GitHub 的 25MB 限制一致
+    max_body_bytes = 25 * 1024 * 1024
+
+    # 读取单个 HTTP 请求的超时时间（秒）
+    request_timeout = 30
+
+    def __init__(self, host: str, port: int, workers: int, allow_unsigned: bool = False):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self._webhook_secret = os.environ.get("GITHUB_WEBHOOK_SECRET", "")
+        # 未设置密钥时默认拒绝启动，只有显式允许（本地调试）时才接受未签名的 webhook
+        if not self._webhook_secret and not allow_unsigned:
+            raise RuntimeError("GITHUB_WEBHOOK_SECRET is not set, set it or allow unsigned webhooks explicitly "
+                               "with --allow-unsigned-webhooks / SERVER_ALLOW_UNSIGNED_WEBHOOKS=1")
+        self.allow_unsigned = allow_unsigned
+        self.queue = FairQueue()
+        self.running = {}
+        self.shared = None
+        self.workspace = RepositoryWorkspace(
+            os.environ.get("SERVER_WORKSPACE_DIR", "./.workspace"),
+            os.environ.get("GITHUB_TOKEN"),
+            os.environ.get("SERVER_CLONE_URL_TEMPLATE", "https://github.com/{owner}/{repo}.git")
+        )
+
+
+    async def serve(self):
+        self.shared = SharedResources.from_env()
+        self.shared.warm_up()
+        if not self._webhook_secret:
+            logger.warning("GITHUB_WEBHOOK_SECRET is not set and unsigned webhooks are allowed, "
+                           "webhook signatures will not be verified")
+
+        # 收到 SIGTERM 时与 Ctrl+C 一样正常退出，取消进行中的审查并释放资源
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except NotImplementedError:
+            pass
+
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        worker_tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        logger.info(f"Review server listening on {self.host}:{self.port}, workers:{self.workers}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in worker_tasks:
+                task.cancel()
+            await asyncio.gather(*worker_tasks, return_exceptions=True)
+            await self.shared.close()
+            metrics.write()
+            logger.info("Review server stopped")
+
+
+    # 解析 webhook 并入队；同一个 PR 的新提交会取代排队中或正在审查的旧提交
+    async def enqueue(self, job: ReviewJob):
+        running = self.running.get(job.key)
+        if running is not None and running.job.head_sha == job.head_sha:
+            logger.info(f"Review already running, ignore duplicate delivery:{job.name}")
+            return
+        replaced = await self.queue.put(job)
+        if replaced is not None and replaced.head_sha != job.head_sha:
+            metrics.add("server_reviews_superseded")
+            logger.info(f"Pending review superseded:{replaced.name} -> {job.name}")
+        if running is not None:
+            metrics.add("server_reviews_superseded")
+            logger.info(f"Cancel running review superseded by newer commit:{running.job.name} -> {job.name}")
+            running.task.cancel()
+        metrics.add("server_reviews_queued")
+
+
+    async def cancel(self, key: tuple):
+        if (job := await self.queue.remove(key)) is not None:
+            logger.info(f"Pending review removed:{job.name}")
+        if (running := self.running.get(key)) is not None:
+            logger.info(f"Cancel running review:{running.job.name}")
+            running.task.cancel()
+
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            task = asyncio.create_task(self.review(job))
+            entry = RunningReview(job, task)
+            self.running[job.key] = entry
+            try:
+                await task
+                metrics.add("server_reviews_finished")
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    task.cancel()
+                    raise
+                metrics.add("server_reviews_cancelled")
+                logger.info(f"Review cancelled:{job.name}")
+            except Exception as e:
+                metrics.add("server_reviews_failed")
+                logger.exception(f"Review failed:{job.name}, error:{e}")
+            finally:
+                if self.running.get(job.key) is entry:
+                    del self.running[job.key]
+
+
+    async def review(self, job: ReviewJob):
+        logger.info(f"Start review:{job.name}")
+        worktree = await self.workspace.checkout(job)
+        analyzer = None
+        try:
+            with metrics.span("server_review"):
+                analyzer = CppCodeAnalyzer(job.pull_request_id, job.owner, job.repo, self.shared)
+                # 直接在工作树中计算 base...head 的变更，不调用 GitHub files 接口
+                analyzer.github_assistant.repository_path = worktree
+                analyzer.github_assistant.set_commit_sha(job.head_sha)
+                analyzer.local_diff = LocalGitDiff(worktree, job.base_sha, job.head_sha)
+                await analyzer.run()
+        finally:
+            if analyzer is not None:
+                await analyzer.close()
+            await self.workspace.remove_worktree(job, worktree)
+
+
+    def verify_signature(self, headers: dict, body: bytes) -> bool:
+        if not self._webhook_secret:
+            return self.allow_unsigned
+        expected = "sha256=" + hmac.new(self._webhook_secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, headers.get("x-hub-signature-256", ""))
+
+
+    @classmethod
+    def parse_job(cls, payload: dict) -> ReviewJob:
+        pull_request = payload["pull_request"]
+        repository = payload["repository"]
+        job = ReviewJob(
+            repository["owner"]["login"],
+            repository["name"],
+            int(pull_request["number"]),
+            pull_request["head"]["sha"],
+            pull_request["base"]["sha"]
+        )
+        if not (cls.name_re.match(job.owner) and cls.name_re.match(job.repo)):
+            raise ValueError(f"invalid repository:{job.owner}/{job.repo}")
+        if not (cls.sha_re.match(job.head_sha) and cls.sha_re.match(job.base_sha)):
+            raise ValueError("invalid commit sha")
+        return job
+
+
+    async def handle_webhook(self, headers: dict, body: bytes) -> tuple[int, dict]:
+        if not self.verify_signature(headers, body):
+            return 401, {"message": "invalid signature"}
+        event = headers.get("x-github-event", "")
+        if event == "ping":
+            return 200, {"message": "pong"}
+        if event != "pull_request":
+            return 202, {"message": f"ignored event:{event}"}
+
+        try:
+            payload = json.loads(body)
+            action = payload.get("action")
+            job = self.parse_job(payload)
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {"message": f"invalid payload:{e}"}
+
+        if action == "closed":
+            await self.cancel(job.key)
+            return 202, {"message": "cancelled"}
+        if action not in self.review_actions or payload["pull_request"].get("draft"):
+            return 202, {"message": f"ignored action:{action}"}
+        await self.enqueue(job)
+        return 202, {"message": "queued", "review": job.name}
+
+
+    async def route(self, method: str, path: str, headers: dict, body: bytes) -> tuple[int, object]:
+        path = urllib.parse.urlsplit(path).path
+        if method == "POST" and path == "/webhook":
+            return await self.handle_webhook(headers, body)
+        if method == "GET" and path == "/healthz":
+            return 200, {
+                "queued": len(self.queue),
+                "running": [entry.job.name for entry in self.running.values()]
+            }
+        if method == "GET" and path == "/metrics":
+            return 200, metrics.to_prometheus()
+        return 404, {"message": "not found"}
+
+
+    # 只实现 webhook 需要的最小 HTTP/1.1 子集，每个连接处理一个请求
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        status, payload = 500, {"message": "internal error"}
+        try:
+            async with asyncio.timeout(self.request_timeout):
+                request_line = (await reader.readline()).decode("latin-1").strip()
+                method, path, _ = request_line.split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                if length > self.max_body_bytes:
+                    status, payload = 413, {"message": "payload too large"}
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = await self.route(method, path, headers, body)
+        except (ValueError, asyncio.IncompleteReadError, TimeoutError) as e:
+            status, payload = 400, {"message": f"bad request:{e}"}
+        except Exception as e:
+            logger.exception(f"Handle request failed:{e}")
+
+        if isinstance(payload, str):
+            content, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            content, content_type = json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json"
+        reason = {200: "OK", 202: "Accepted", 400: "Bad Request", 401: "Unauthorized",
+                  404: "Not Found", 413: "Payload Too Large"}.get(status, "Internal Server Error")
+        try:
+            writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(content)}\r\nConnection: close\r\n\r\n".encode("latin-1") + content)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ai_code_reviewer webhook server")
+    parser.add_argument("--host", default=os.environ.get("SERVER_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("SERVER_PORT", "8080")))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("SERVER_MAX_CONCURRENT_REVIEWS", "2")),
+                        help="number of pull requests reviewed concurrently")
+    parser.add_argument("--allow-unsigned-webhooks", action="store_true",
+                        default=os.environ.get("SERVER_ALLOW_UNSIGNED_WEBHOOKS", "0") == "1",
+                        help="accept webhooks without signature when GITHUB_WEBHOOK_SECRET is not set (local debugging only)")
+    args = parser.parse_args()
+
+    missing_vars = [var for var in ("LLM_API_KEY", "LLM_API_URL", "GITHUB_TOKEN", "PROMPT_LEVEL")
+                    if not os.environ.get(var)]
+    if missing_vars:
+        raise RuntimeError(f":Missing environment variables: {', '.join(missing_vars)}")
+    if args.workers <= 0:
+        raise ValueError("Server workers must be greater than 0")
+
+    try:
+        asyncio.run(ReviewServer(args.host, args.port, args.workers, args.allow_unsigned_webhooks).serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+from dataclasses import dataclass, field
+
+
+@dataclass
+class ReviewUnit:
+    # 文件内的序号，用于保证评论提交顺序稳定
+    index: int
+    file_name: str
+    # 评论挂载的行号（函数内第一处变更行）
+    line: int
+    function_body: str
+    # 函数内全部变更行号（有序）
+    changed_lines: list = field(default_factory=list)
+    # 函数的起止行号
+    start_line: int = 0
+    end_line: int = 0
+    # 函数在源文件中的字节范围
+    start_byte: int = 0
+    end_byte: int = 0
+    # 所在文件的导入、类声明和函数签名，同一文件的全部单元共用
+    file_context: str = ""
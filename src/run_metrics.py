@@ -0,0 +1,135 @@
+import collections
+import json
+import math
+import os
+import re
+import time
+from contextlib import contextmanager
+from ai_code_reviewer_logger import logger
+
+
+class RunMetrics:
+    """
+    单次运行的轻量指标：各阶段耗时（span）、排队等待时间以及 token 数、重试次数、传输字节数等计数
+    运行结束后导出为 JSON 和 Prometheus 文本格式，便于作为 artifact 上传
+    """
+
+    # 导出的分位数
+    quantiles = (0.5, 0.95, 0.99)
+
+    # 指标文件和 profile 文件的输出目录
+    directory = os.environ.get("METRICS_DIR", "./metrics")
+
+    # 每个耗时指标保留的最近样本数，常驻服务模式下内存不会随运行时间增长，分位数按最近的样本计算
+    max_samples = 10000
+
+    def __init__(self):
+        # 名称 -> 最近的耗时样本（秒）
+        self.timings = {}
+        # 名称 -> [累计次数, 累计耗时]
+        self.totals = {}
+        self.counters = {}
+        self.started_at = time.time()
+
+
+    def observe(self, name: str, seconds: float):
+        if name not in self.timings:
+            self.timings[name] = collections.deque(maxlen=self.max_samples)
+            self.totals[name] = [0, 0.0]
+        self.timings[name].append(seconds)
+        self.totals[name][0] += 1
+        self.totals[name][1] += seconds
+
+
+    def add(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+    # 记录代码块的耗时，异常退出时同样记录，并额外累加 {name}_errors 计数（取消不计入错误）
+    @contextmanager
+    def span(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.add(f"{name}_errors")
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start_time)
+
+
+    # nearest-rank 分位数：第 ceil(q * n) 个样本，先舍去浮点误差，避免 q * n 恰为整数时多进一位
+    @staticmethod
+    def percentile(ordered: list, q: float) -> float:
+        index = max(0, min(len(ordered) - 1, math.ceil(round(q * len(ordered), 9)) - 1))
+        return ordered[index]
+
+
+    def timing_stats(self, name: str) -> dict:
+        ordered = sorted(self.timings[name])
+        count, total = self.totals[name]
+        stats = {"count": count, "sum": total, "max": ordered[-1]}
+        for q in self.quantiles:
+            stats[f"p{int(q * 100)}"] = self.percentile(ordered, q)
+        return stats
+
+
+    def to_dict(self, summary: dict = None) -> dict:
+        result = {
+            "started_at": self.started_at,
+            "wall_time": time.time() - self.started_at,
+            "timings": {name: self.timing_stats(name) for name, values in sorted(self.timings.items()) if values},
+            "counters": dict(sorted(self.counters.items()))
+        }
+        if summary is not None:
+            result["summary"] = summary
+        return result
+
+
+    # Prometheus 文本格式，耗时导出为 summary 类型，计数导出为 counter 类型，运行汇总导出为 gauge 类型
+    def to_prometheus(self, summary: dict = None, prefix: str = "ai_reviewer") -> str:
+        lines = [f"# TYPE {prefix}_wall_time_seconds gauge",
+                 f"{prefix}_wall_time_seconds {time.time() - self.started_at}"]
+        for name, values in sorted(self.timings.items()):
+            if not values:
+                continue
+            metric = f"{prefix}_{self.metric_name(name)}_seconds"
+            stats = self.timing_stats(name)
+            lines.append(f"# TYPE {metric} summary")
+            for q in self.quantiles:
+                lines.append(f'{metric}{{quantile="{q}"}} {stats[f"p{int(q * 100)}"]}')
+            lines.append(f"{metric}_sum {stats['sum']}")
+            lines.append(f"{metric}_count {stats['count']}")
+        for name, value in sorted(self.counters.items()):
+            metric = f"{prefix}_{self.metric_name(name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        for name, value in sorted(((summary or {}).get("counters") or {}).items()):
+            if isinstance(value, (int, float)):
+                metric = f"{prefix}_run_{self.metric_name(name)}"
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+    @staticmethod
+    def metric_name(name: str) -> str:
+        return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+    # 写出 metrics.json 和 metrics.prom，写入失败不影响审查结果
+    def write(self, summary: dict = None):
+        directory = self.directory
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, "metrics.json"), "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(summary), f, ensure_ascii=False, indent=2)
+            with open(os.path.join(directory, "metrics.prom"), "w", encoding="utf-8") as f:
+                f.write(self.to_prometheus(summary))
+            logger.info(f"Write run metrics success, directory:{directory}")
+        except OSError as e:
+            logger.exception(f"Write run metrics failed:{e}")
+
+
+# 全局指标对象，与 logger 一样在各模块中直接导入使用
+metrics = RunMetrics()
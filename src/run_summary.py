@@ -0,0 +1,49 @@
+import json
+from ai_code_reviewer_logger import logger
+
+
+class RunSummary:
+    """
+    单次运行的汇总信息：各类计数、token 消耗以及被跳过的函数
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.skipped = []
+
+
+    def add(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def skip(self, file_name: str, line: int, reason: str):
+        self.skipped.append({"file": file_name, "line": line, "reason": reason})
+        self.add(f"skipped_{reason}")
+
+
+    # 汇总大模型请求的 token 消耗，cached_prompt_tokens 从应答的 usage 中读取命中前缀缓存的 token 数
+    def add_llm_usage(self, request_timings: list, cached_prompt_tokens, price_per_1k_tokens: float = 0):
+        for timing in request_timings:
+            usage = timing.get("usage") or {}
+            self.add("llm_requests")
+            self.add("prompt_tokens", usage.get("prompt_tokens", 0))
+            self.add("completion_tokens", usage.get("completion_tokens", 0))
+            self.add("cached_prompt_tokens", cached_prompt_tokens(usage))
+        if price_per_1k_tokens > 0:
+            total_tokens = self.counters.get("prompt_tokens", 0) + self.counters.get("completion_tokens", 0)
+            self.counters["estimated_cost"] = round(total_tokens / 1000 * price_per_1k_tokens, 4)
+
+
+    # 合并另一次运行的计数和跳过的函数，离线模式下汇总多个审查对象
+    def merge(self, other: "RunSummary"):
+        for name, value in other.counters.items():
+            self.add(name, value)
+        self.skipped.extend(other.skipped)
+
+
+    def to_dict(self) -> dict:
+        return {"counters": dict(sorted(self.counters.items())), "skipped": self.skipped}
+
+
+    def report(self):
+        logger.info(f"Run summary:{json.dumps(self.to_dict(), ensure_ascii=False)}")
@@ -0,0 +1,117 @@
+import multiprocessing
+import os
+import httpx
+from concurrent.futures import ProcessPoolExecutor
+from ai_code_reviewer_logger import logger
+from ai_module import DeepSeek
+from github_assistant import GithubAssistant
+from github_cache import GithubResponseCache
+from review_cache import ReviewCache
+from llm_scheduler import LLMScheduler
+from function_extractor import FunctionExtractor, init_worker
+
+
+class SharedResources:
+    """
+    可以在多次审查之间复用的资源：大模型客户端、GitHub 连接池和应答缓存、语法解析器、大模型调度器、review 缓存和解析进程池
+    单次运行时由 CppCodeAnalyzer 自行创建，常驻服务模式下在启动时创建一次并保持预热
+    """
+
+    def __init__(
+        self,
+        ai_module: DeepSeek,
+        github_client: httpx.AsyncClient,
+        extractor: FunctionExtractor,
+        llm_scheduler: LLMScheduler,
+        review_cache: ReviewCache,
+        parse_workers: int = 0,
+        github_response_cache: GithubResponseCache = None
+    ):
+        self.ai_module = ai_module
+        self.github_client = github_client
+        self.extractor = extractor
+        self.llm_scheduler = llm_scheduler
+        self.review_cache = review_cache
+        self.parse_workers = parse_workers
+        self.github_response_cache = github_response_cache
+        self._parse_pool = None
+
+
+    @classmethod
+    def from_env(cls):
+        # 初始化ai模型(目前只支持deepseek)
+        ai_module = DeepSeek(os.environ.get("LLM_API_URL"), os.environ.get("LLM_API_KEY"))
+
+        # GitHub 连接池，同一个服务进程中的所有审查共用；离线审查本地提交范围时可以不配置 token
+        github_token = os.environ.get("GITHUB_TOKEN")
+        github_client = GithubAssistant.create_client(github_token) if github_token else None
+
+        # 语法解析和函数提取：函数体附带的上下文行数，超长函数按变更 hunk 切片
+        extractor = FunctionExtractor(
+            int(os.environ.get("FUNCTION_CONTEXT_LINES", "0")),
+            int(os.environ.get("LLM_MAX_FUNCTION_TOKENS", "6000")),
+            int(os.environ.get("LLM_CHUNK_CONTEXT_LINES", "20")),
+            int(os.environ.get("LLM_FILE_CONTEXT_TOKENS", "800"))
+        )
+
+        # 大模型调用工作池，并发度和速率限制独立于文件解析
+        llm_scheduler = LLMScheduler(
+            int(os.environ.get("LLM_CONCURRENCY", "8")),
+            int(os.environ.get("LLM_REQUESTS_PER_MINUTE", "0")),
+            int(os.environ.get("LLM_TOKENS_PER_MINUTE", "0"))
+        )
+
+        # review 结果缓存，相同的函数体不重复调用大模型
+        review_cache = ReviewCache(
+            os.environ.get("REVIEW_CACHE_DIR", "./.review_cache"),
+            int(os.environ.get("REVIEW_CACHE_MAX_SIZE_MB", "200")) * 1024 * 1024,
+            int(os.environ.get("REVIEW_CACHE_MAX_AGE_DAYS", "30")) * 24 * 3600
+        )
+
+        # 可选的解析进程池，workers 为 0 时不启用
+        parse_workers = int(os.environ.get("PARSE_PROCESS_WORKERS", "0"))
+        
+        # GitHub GET 请求的条件请求缓存，放在 review 缓存目录下一起保存和淘汰
+        github_response_cache = None
+        if os.environ.get("GITHUB_HTTP_CACHE", "1") == "1":
+            github_response_cache = GithubResponseCache(os.path.join(review_cache.cache_dir, "github"))
+        return cls(ai_module, github_client, extractor, llm_scheduler, review_cache, parse_workers,
+                   github_response_cache)
+
+
+    # 懒加载解析进程池，每个工作进程启动时预热全部语法
+    @property
+    def parse_pool(self) -> ProcessPoolExecutor:
+        if self._parse_pool is None:
+            # 主进程已有日志线程和线程池，fork 会把其他线程持有的锁带入子进程而死锁，使用 spawn 启动全新的解释器
+            context = multiprocessing.get_context("spawn")
+            self._parse_pool = ProcessPoolExecutor(
+                max_workers=self.parse_workers,
+                mp_context=context,
+                initializer=init_worker,
+                initargs=(self.extractor.function_context_lines,
+                          self.extractor.max_function_tokens,
+                          self.extractor.chunk_context_lines,
+                          self.extractor.file_context_tokens)
+            )
+            logger.info(f"Init parse process pool success, workers:{self.parse_workers}")
+        return self._parse_pool
+
+
+    # 提前加载语法、查询和解析进程池，常驻服务启动时调用
+    def warm_up(self):
+        self.extractor.warm_up()
+        if self.parse_workers > 0:
+            # ProcessPoolExecutor 按需启动工作进程，提交空任务让全部工作进程提前完成初始化
+            for future in [self.parse_pool.submit(os.getpid) for _ in range(self.parse_workers)]:
+                future.result()
+        logger.info("Warm up shared resources success")
+
+
+    async def close(self):
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown(wait=False, cancel_futures=True)
+        self.review_cache.evict()
+        if self.github_client is not None:
+            await self.github_client.aclose()
+        await self.ai_module.close()
@@ -0,0 +1,117 @@
+import math
+
+
+# 本地估算 token 数，无需加载分词器
+# ASCII 字符按平均每 token 约 4 个字符计算，中日韩等非 ASCII 字符按每个字符约 1 个 token 计算
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return math.ceil((len(text) - non_ascii) / 4) + non_ascii
+
+
+class TokenBudget:
+    """
+    单个 PR 的 token 上限（输入和输出合计），max_tokens 为 0 表示不限制
+    每个请求按估算输入加最大输出 token 数预留，请求完成后释放预留，改为按模型返回的实际用量计算
+    """
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        # 在途请求的预留额度
+        self.reserved = 0
+        # 已完成请求的实际用量
+        self.used = 0
+
+
+    @classmethod
+    def from_limits(cls, max_tokens: int, max_cost: float, price_per_1k_tokens: float):
+        # 同时配置了 token 上限和费用上限时取较严格的一个，费用按输入和输出 token 合计计算
+        limits = [max_tokens] if max_tokens > 0 else []
+        if max_cost > 0 and price_per_1k_tokens > 0:
+            limits.append(int(max_cost / price_per_1k_tokens * 1000))
+        return cls(min(limits)) if limits else None
+
+
+    def try_reserve(self, tokens: int) -> bool:
+        if self.max_tokens > 0 and self.used + self.reserved + tokens > self.max_tokens:
+            return False
+        self.reserved += tokens
+        return True
+
+
+    # 请求完成后释放预留，used 为到目前为止的实际用量
+    def release(self, tokens: int, used: int):
+        self.reserved -= tokens
+        self.used = used
+
+
+    # 按模型返回的 usage 累计输入和输出 token，推理模型的推理 token 包含在 completion_tokens 中
+    @staticmethod
+    def tokens_used(request_timings: list) -> int:
+        total = 0
+        for timing in request_timings:
+            usage = timing.get("usage") or {}
+            total += (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+        return total
+
+
+# 将超长函数切分为若干片段，每个片段只包含变更行及其上下文
+# lines 为函数的源码行，start_line 为 lines[0] 的行号，changed_lines 为有序的变更行号
+# 返回 [(片段范围内的变更行, 片段文本), ...]
+def split_oversized_function(lines: list, start_line: int, changed_lines: list,
+                             max_tokens: int, context_lines: int) -> list:
+    end_line = start_line + len(lines) - 1
+
+    # 以变更行为中心扩展上下文，重叠或相邻的区间合并为一个 hunk
+    ranges = []
+    for line in changed_lines:
+        low = max(start_line, line - context_lines)
+        high = min(end_line, line + context_lines)
+        if ranges and low <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], high)
+        else:
+            ranges.append([low, high])
+
+    line_tokens = [estimate_tokens(text) + 1 for text in lines]
+
+    # 过大的 hunk 切分为相互重叠的窗口
+    overlap = max(1, context_lines // 2)
+    windows = []
+    for low, high in ranges:
+        window_start = low
+        while window_start <= high:
+            window_end = window_start
+            tokens = line_tokens[window_start - start_line]
+            while window_end < high and tokens + line_tokens[window_end + 1 - start_line] <= max_tokens:
+                window_end += 1
+                tokens += line_tokens[window_end - start_line]
+            windows.append([window_start, window_end, tokens])
+            if window_end >= high:
+                break
+            window_start = max(window_start + 1, window_end - overlap + 1)
+
+    # 相邻的小窗口在预算内合并，减少请求数
+    merged = []
+    for window in windows:
+        if merged and merged[-1][1] < window[0]:
+            span_tokens = sum(line_tokens[merged[-1][0] - start_line:window[1] - start_line + 1])
+            if span_tokens <= max_tokens:
+                merged[-1][1] = window[1]
+                merged[-1][2] = span_tokens
+                continue
+        merged.append(window)
+
+    # 函数签名作为每个片段的开头，便于模型理解上下文
+    signature = lines[0] if lines else ""
+    chunks = []
+    for low, high, _ in merged:
+        anchors = [line for line in changed_lines if low <= line <= high]
+        if not anchors:
+            continue
+        body = "\n".join(lines[low - start_line:high - start_line + 1])
+        header = f"[函数片段，第 {low}-{high} 行]"
+        if low > start_line:
+            header = f"{header}\n{signature}\n..."
+        chunks.append((anchors, f"{header}\n{body}"))
+    return chunks